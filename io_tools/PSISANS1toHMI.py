@@ -10,137 +10,259 @@ __maintainer__ = "Joachim Kohlbrecher"
 __email__ = "joachim.kohlbrecher@psi.ch"
 __status__ = "Production"
 
-from SASformats import SANSdata, readBerSANStrans
+from SASformats import SANSdata, readBerSANStrans, TransmissionStore, WavelengthCalibration
 import os
 import sys
 import re
 import pprint
-import tkinter
+import glob
+import time
+import argparse
+import concurrent.futures
+import h5py
+import numpy as np
 
-def rawhdf2hmi(FullFileNameHDF, FullFileNameHMI, Ignore=None, Tfiles=None, thickness=None, rwl='', replaceSN=None):
+def rawhdf2hmi(FullFileNameHDF, FullFileNameHMI, Ignore=None, Tfiles=None, thickness=None, rwl='', replaceSN=None, Tstore=None,
+               calibration=None):
+    """
+    Converts the SANS-1 raw data file FullFileNameHDF into the BerSANS file
+    FullFileNameHMI. Tfiles maps wavelengths onto transmission files, the one
+    closest to the wavelength of the run within 5% is used. Instead of the
+    file names a TransmissionStore Tstore with the already parsed
+    transmission files can be given. Unless the wavelength is overwritten by
+    rwl, the WavelengthCalibration calibration replaces %Setup,Lambda by the
+    calibrated wavelength of the rotation speed %Setup,LambdaC.
+    """
     if Ignore is None:
         Ignore = []
     if Tfiles is None:
         Tfiles = {}
     if thickness is None:
         thickness = {}
+    # TOF runs, which may be several GB large, are rejected before SANSdata
+    # reads and sums their counts
+    if is_tof_run(FullFileNameHDF):
+        raise RuntimeError('TOF runs can\'t be converted into BerSANS files.')
     Data = SANSdata(FullFileNameHDF)
+    if Data.BerSANS['%File,Type'] != 'SANSDRawhdf':
+        raise RuntimeError('input file needs to be raw data from SANS-1.')
     wlHDF = float(Data.BerSANS["%Setup,Lambda"])
-    transmissionfile = ""
-    for key, val in Tfiles.items():
-        if abs(float(key)-wlHDF)/wlHDF < 0.05:
-            transmissionfile = val
-            print(f"Tfiles: {key}:{val}")
+    if Tstore is None:
+        Tstore = TransmissionStore(Tfiles)
+    transmissionfile = Tstore.filename(wlHDF)
+    if transmissionfile != "":
+        print(f"Tfiles: {Tstore.wavelengths[Tstore.find(wlHDF)]}:{transmissionfile}")
+    transD = Tstore.transmissions(wlHDF)
     if rwl != '':
         Data.BerSANS.update({"%Setup,Lambda":float(rwl)})
-    transD = {}
-    if os.path.isfile(transmissionfile):
-        transD = readBerSANStrans(transmissionfile)
+    elif calibration is not None:
+        wl, dwl = calibration.wavelength(float(Data.BerSANS["%Setup,LambdaC"]))
+        Data.BerSANS.update({"%Setup,Lambda":round(float(wl), 4)})
     #print(f"filename for transmission {transmissionfile}")
-    if Data.BerSANS['%File,Type'] != 'SANSDRawhdf':
-        raise RuntimeError('input file needs to be raw data from SANS-1.')
-    BERSANS = open(FullFileNameHMI, 'w', encoding="utf-8")
-    resFile = {
-        key: val 
-        for key, val in Data.BerSANS.items() 
-        if re.search("^%File", key)
-    }
-    resSetup = {
-        key: val 
-        for key, val in Data.BerSANS.items() 
-        if re.search("^%Setup", key)
-    }
-    resSample = {
-        key: val 
-        for key, val in Data.BerSANS.items() 
-        if re.search("^%Sample", key)
-    }
-    resCounter = {
-        key: val 
-        for key, val in Data.BerSANS.items() 
-        if re.search("^%Counter", key)
-    }
-    resHistory = {
-        key: val 
-        for key, val in Data.BerSANS.items() 
-        if re.search("^%History", key)
-    }
-    BERSANS.write('%File\n')
-    for key, val in resFile.items():
-        f = key.split(",")
+    sections = BerSANSsections(Data.BerSANS)
+    out = []
+    out.append('%File\n')
+    for name, val in sections['%File']:
         if val=='SANSDRawhdf':
             val = 'SANSDRaw'
-        if len(f) > 1:
-            if f[1]=='FileName':
-                fn=os.path.basename(FullFileNameHMI)
-                f = fn.split('.')
-                BERSANS.write(f'FileName={f[0]}\n')
-                RFN = f[0]
-            else:
-                BERSANS.write(f'{f[1]}={val}\n')
-    BERSANS.write('%Setup\n')
-    for key, val in resSetup.items():
-        f = key.split(",")
-        if len(f) > 1:
-            BERSANS.write(f'{f[1]}={val}\n')
-    BERSANS.write('%Sample\n')
-    for key, val in resSample.items():
-        f = key.split(",")
-        if len(f) > 1:
-            if f[1] == "SampleName":
-                sRSN = f'{Data.BerSANS["%Sample,SampleName"]}'
-                print(f'{resFile["%File,FileName"]}:  {f[1]}={val}\n')
-                if (replaceSN==None) or (not isinstance(replaceSN,dict)):
-                    BERSANS.write(f'{f[1]}={val}\n')
-                else:
-                    if resFile["%File,FileName"] in replaceSN.keys():
-                        BERSANS.write(f'{f[1]}={replaceSN[resFile["%File,FileName"]]}\n')
-                        SRSN=replaceSN[resFile["%File,FileName"]]
-                    else:
-                        BERSANS.write(f'{f[1]}={val}\n')
-            else:
-                BERSANS.write(f'{f[1]}={val}\n')
-
-              
-    BERSANS.write('%Counter\n')
-    for key, val in resCounter.items():
-        f = key.split(",")
-        if len(f) > 1:
-            BERSANS.write(f'{f[1]}={val}\n')
-    BERSANS.write('%History\n')
-    for key, val in resHistory.items():
-        f = key.split(",")
-        if len(f) > 1:
-            BERSANS.write(f'{f[1]}={val}\n')
+        if name=='FileName':
+            RFN = os.path.basename(FullFileNameHMI).split('.')[0]
+            out.append(f'FileName={RFN}\n')
+        else:
+            out.append(f'{name}={val}\n')
+    out.append('%Setup\n')
+    for name, val in sections['%Setup']:
+        out.append(f'{name}={val}\n')
+    out.append('%Sample\n')
+    for name, val in sections['%Sample']:
+        if name == "SampleName":
+            print(f'{Data.BerSANS["%File,FileName"]}:  {name}={val}\n')
+            if isinstance(replaceSN,dict) and Data.BerSANS["%File,FileName"] in replaceSN.keys():
+                val = replaceSN[Data.BerSANS["%File,FileName"]]
+        out.append(f'{name}={val}\n')
+    out.append('%Counter\n')
+    for name, val in sections['%Counter']:
+        out.append(f'{name}={val}\n')
+    out.append('%History\n')
+    for name, val in sections['%History']:
+        out.append(f'{name}={val}\n')
     sRSN = f'{Data.BerSANS["%Sample,SampleName"]}'
     if sRSN in transD.keys():    
-#    if f'{Data.BerSANS["%Sample,SampleName"]}' in transD.keys():
-#        BERSANS.write(f'Transmission={transD[Data.BerSANS["%Sample,SampleName"]]}\n') 
-        BERSANS.write(f'Transmission={transD[sRSN]}\n')
+        out.append(f'Transmission={transD[sRSN]}\n')
     if "%History,Attenuation" not in Data.BerSANS.keys():
-        BERSANS.write('Attenuation=1\n') 
+        out.append('Attenuation=1\n') 
     if "%History,Probability" not in Data.BerSANS.keys():
-        BERSANS.write('Probability=0\n') 
+        out.append('Probability=0\n') 
     if "%History,Scaling" not in Data.BerSANS.keys():
         if Data.BerSANS["%Sample,SampleName"] in thickness.keys():
-            BERSANS.write(f'Scaling={float(thickness[Data.BerSANS["%Sample,SampleName"]])/10.}\n')
+            out.append(f'Scaling={float(thickness[Data.BerSANS["%Sample,SampleName"]])/10.}\n')
         elif re.search('1mm',Data.BerSANS["%Sample,SampleName"]):
-            BERSANS.write('Scaling=0.1\n')
+            out.append('Scaling=0.1\n')
         elif re.search('2mm',Data.BerSANS["%Sample,SampleName"]):
-            BERSANS.write('Scaling=0.2\n')
+            out.append('Scaling=0.2\n')
         elif re.search('4mm',Data.BerSANS["%Sample,SampleName"]):
-            BERSANS.write('Scaling=0.4\n')
+            out.append('Scaling=0.4\n')
         else:
-            BERSANS.write('Scaling=0.2\n')
-    BERSANS.write('%Counts\n')
+            out.append('Scaling=0.2\n')
+    out.append('%Counts\n')
     try:
         DetData = Data.BerSANS['%Counts,DetCounts']
     except Exception:
         raise RuntimeError(f'no data available')
-    for j in range(int(Data.BerSANS['%File,DataSizeY'])):
-        for i in range(int(Data.BerSANS['%File,DataSizeX'])//8):
-            BERSANS.write(f'{DetData[j,i*8+0]},{DetData[j,i*8+1]},{DetData[j,i*8+2]},{DetData[j,i*8+3]},'+
-                          f'{DetData[j,i*8+4]},{DetData[j,i*8+5]},{DetData[j,i*8+6]},{DetData[j,i*8+7]}\n')
+    out.append(format_DetCounts(DetData, int(Data.BerSANS['%File,DataSizeX']), int(Data.BerSANS['%File,DataSizeY'])))
+    with open(FullFileNameHMI, 'w', encoding="utf-8") as BERSANS:
+        BERSANS.write("".join(out))
+
+def is_tof_run(FullFileNameHDF):
+    """
+    True if FullFileNameHDF is a hdf file with TOF resolved detector counts,
+    only the shape of the counts dataset is read.
+    """
+    if not h5py.is_hdf5(FullFileNameHDF):
+        return False
+    with h5py.File(FullFileNameHDF, 'r') as HDF:
+        dset = HDF.get('entry1/SANS/detector/counts')
+        return dset is not None and dset.ndim == 3
+
+def BerSANSsections(BerSANS):
+    """
+    Groups the entries '%Section,Name' of a BerSANS dict in one pass into
+    {'%Section': [(Name, value), ...]}, keeping their order.
+    """
+    sections = {'%File': [], '%Setup': [], '%Sample': [], '%Counter': [], '%History': []}
+    for key, val in BerSANS.items():
+        f = key.split(",")
+        if len(f) > 1:
+            sections.setdefault(f[0], []).append((f[1], val))
+    return sections
+
+def format_DetCounts(DetData, DataSizeX, DataSizeY):
+    """
+    Formats the detector matrix as BerSANS %Counts block with 8 comma
+    separated values per line, using one format string for the whole matrix.
+    """
+    nperline = 8
+    values = np.asarray(DetData)[:DataSizeY, :DataSizeX//nperline*nperline]
+    if values.dtype.kind in 'iub' or values.dtype == np.float64:
+        # python int and float are printed like the numpy scalars
+        values = values.ravel().tolist()
+    else:
+        values = list(values.ravel())
+    line = ",".join(["{}"]*nperline) + "\n"
+    return (line*(len(values)//nperline)).format(*values)
+
+_batch_options = {}
+
+def _init_batch(options):
+    global _batch_options
+    _batch_options = options
+
+def _convert_one(FullFileNameHDF, FullFileNameHMI):
+    start = time.perf_counter()
+    try:
+        rawhdf2hmi(FullFileNameHDF, FullFileNameHMI, **_batch_options)
+    except Exception as exc:
+        return FullFileNameHDF, FullFileNameHMI, 'failed', time.perf_counter()-start, f'{type(exc).__name__}: {exc}'
+    return FullFileNameHDF, FullFileNameHMI, 'converted', time.perf_counter()-start, ''
+
+def batch_file_names(Data_path, year=None, from_number=None, to_number=None, pattern=None, Out_path=None):
+    """
+    Returns a list of (hdf file, BerSANS file) pairs, either for the run
+    numbers from_number..to_number of year, i.e. sans{year}n{number:06d}.hdf,
+    or for all files in Data_path matching the glob pattern. The BerSANS
+    files D{number:07d}.001 are placed in Out_path (default Data_path).
+    """
+    if Out_path is None:
+        Out_path = Data_path
+    if pattern is not None:
+        HDFfiles = sorted(glob.glob(os.path.join(Data_path, pattern)))
+    else:
+        HDFfiles = [os.path.join(Data_path, f"sans{year}n%06d.hdf" % number)
+                    for number in range(from_number, to_number+1)]
+    pairs = []
+    for FullFileNameHDF in HDFfiles:
+        number = int(re.findall(r'\d+', os.path.basename(FullFileNameHDF))[-1])
+        pairs.append((FullFileNameHDF, os.path.join(Out_path, "D%07d.001" % number)))
+    return pairs
+
+def batch_rawhdf2hmi(pairs, Tfiles=None, thickness=None, rwl='', replaceSN=None, processes=None, force=False,
+                     calibration=None):
+    """
+    Converts the (hdf file, BerSANS file) pairs, e.g. from batch_file_names,
+    with rawhdf2hmi in a pool of processes worker processes (default: number
+    of cores). The transmission files in Tfiles are read once and shared with
+    all workers, as is the wavelength calibration. Pairs whose BerSANS file is newer than the hdf file and the
+    transmission files are skipped unless force is True.
+    Returns a list of (hdf file, BerSANS file, status, seconds, message) with
+    status 'converted', 'skipped', 'missing' or 'failed'.
+    """
+    if Tfiles is None:
+        Tfiles = {}
+    Tstore = TransmissionStore(Tfiles)
+    newest_input = max([os.path.getmtime(val) for val in Tfiles.values() if os.path.isfile(val)], default=0)
+    options = {'Tstore': Tstore, 'thickness': thickness, 'rwl': rwl, 'replaceSN': replaceSN,
+               'calibration': calibration}
+
+    summary = []
+    todo = []
+    for FullFileNameHDF, FullFileNameHMI in pairs:
+        if not os.path.isfile(FullFileNameHDF):
+            summary.append((FullFileNameHDF, FullFileNameHMI, 'missing', 0.0, ''))
+        elif (not force and os.path.isfile(FullFileNameHMI)
+              and os.path.getmtime(FullFileNameHMI) >= max(os.path.getmtime(FullFileNameHDF), newest_input)):
+            summary.append((FullFileNameHDF, FullFileNameHMI, 'skipped', 0.0, ''))
+        else:
+            todo.append((FullFileNameHDF, FullFileNameHMI))
+    if processes == 1:
+        _init_batch(options)
+        summary.extend(_convert_one(*pair) for pair in todo)
+    elif todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                    initializer=_init_batch,
+                                                    initargs=(options,)) as executor:
+            futures = [executor.submit(_convert_one, *pair) for pair in todo]
+            summary.extend(future.result() for future in futures)
+    order = {pair[0]: i for i, pair in enumerate(pairs)}
+    summary.sort(key=lambda entry: order[entry[0]])
+    return summary
+
+def print_batch_summary(summary):
+    for FullFileNameHDF, FullFileNameHMI, status, seconds, message in summary:
+        print(f'{os.path.basename(FullFileNameHDF)} -> {os.path.basename(FullFileNameHMI)}: {status:9s} {seconds:7.3f}s {message}')
+    counts = {}
+    for entry in summary:
+        counts[entry[2]] = counts.get(entry[2], 0) + 1
+    print(', '.join(f'{n} {status}' for status, n in counts.items()))
+    print(f'total conversion time {sum(entry[3] for entry in summary):.3f}s')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='convert SANS-1 hdf raw data files into BerSANS files')
+    parser.add_argument('Data_path', help='directory of the hdf files')
+    parser.add_argument('--year', help='year of the run numbers, i.e. sans{year}n{number:06d}.hdf')
+    parser.add_argument('--from', dest='from_number', type=int, help='first run number')
+    parser.add_argument('--to', dest='to_number', type=int, help='last run number')
+    parser.add_argument('--glob', dest='pattern', help='glob pattern of the hdf files instead of a run range')
+    parser.add_argument('--out', dest='Out_path', help='directory of the BerSANS files (default Data_path)')
+    parser.add_argument('--tfile', nargs=2, action='append', default=[], metavar=('LAMBDA', 'FILE'),
+                        help='transmission file for a wavelength, can be repeated')
+    parser.add_argument('--rwl', default='', help='overwrite the wavelength')
+    parser.add_argument('--calibration', help='wavelength calibration file of the velocity selector')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='also convert files which are up to date')
+    args = parser.parse_args(argv)
+    if args.pattern is None and None in (args.year, args.from_number, args.to_number):
+        parser.error('either --glob or --year, --from and --to are required')
+    pairs = batch_file_names(args.Data_path, year=args.year, from_number=args.from_number,
+                             to_number=args.to_number, pattern=args.pattern, Out_path=args.Out_path)
+    Tfiles = {float(wl): fn for wl, fn in args.tfile}
+    calibration = None if args.calibration is None else WavelengthCalibration.load(args.calibration)
+    summary = batch_rawhdf2hmi(pairs, Tfiles=Tfiles, rwl=args.rwl, processes=args.processes, force=args.force,
+                               calibration=calibration)
+    print_batch_summary(summary)
+    return 0 if all(entry[2] != 'failed' for entry in summary) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 """
 try:
@@ -4,6 +4,7 @@ import h5py
 import errno
 import os, sys
 import re
+import itertools
 class ASCIIData:
     def __init__(self):
         self.InputFormat = "xye"
@@ -24,6 +25,25 @@ class ASCIIData:
         self.res_available = 0
         self.zero_int_chkb = False
 
+# unit and xscale for each in_out conversion
+in_out_map = {
+    "nm^-1->Ångström^-1": ("Ångström^-1", 0.1),
+    "Ångström^-1->nm^-1": ("nm^-1", 10),
+    "Ångström^-1->Ångström^-1": ("Ångström^-1", 1.0),
+    "nm^-1->nm^-1": ("nm^-1", 1.0),
+    "nm->Ångström": ("Ångström", 10),
+    "Ångström->nm": ("nm", 0.1),
+    "Ångström->Ångström": ("Ångström", 1.0),
+    "nm->nm": ("nm", 1.0),
+    "ms->s": ("s", 1e-3),
+    "s->s": ("s", 1.0),
+    "s->ms": ("ms", 1000.0),
+    "ms->ms": ("ms", 1.0),
+    "mus->mus": ("mus", 1.0),
+    "mus->s": ("s", 1e-6),
+    "s->mus": ("mus", 1e6),
+}
+
 def create_ASCIIData():
     return ASCIIData()
 
@@ -32,23 +52,6 @@ def read_Ascii(filename, data=None, *args):
         data = create_ASCIIData()
 
     # Set unit and xscale based on in_out
-    in_out_map = {
-        "nm^-1->Ångström^-1": ("Ångström^-1", 0.1),
-        "Ångström^-1->nm^-1": ("nm^-1", 10),
-        "Ångström^-1->Ångström^-1": ("Ångström^-1", 1.0),
-        "nm^-1->nm^-1": ("nm^-1", 1.0),
-        "nm->Ångström": ("Ångström", 10),
-        "Ångström->nm": ("nm", 0.1),
-        "Ångström->Ångström": ("Ångström", 1.0),
-        "nm->nm": ("nm", 1.0),
-        "ms->s": ("s", 1e-3),
-        "s->s": ("s", 1.0),
-        "s->ms": ("ms", 1000.0),
-        "ms->ms": ("ms", 1.0),
-        "mus->mus": ("mus", 1.0),
-        "mus->s": ("s", 1e-6),
-        "s->mus": ("mus", 1e6),
-    }
     data.unit, data.xscale = in_out_map.get(data.in_out, ("xxx", 1))
 
     data.InputFormat = data.InputFormat.lower()
@@ -73,101 +76,219 @@ def read_Ascii(filename, data=None, *args):
     data.Comment = []
 
     with open(filename, "r") as f:
-        lineno = 0
         # Skip header lines
         for _ in range(data.LineSkip):
             line = f.readline()
             if not line:
                 return 2, data
-            lineno += 1
             data.Comment.append(line.rstrip())
+        # Replace multiple spaces with single space, drop empty lines
+        lines = [" ".join(line.split()) for line in f.read().split("\n")]
+        lines = [line for line in lines if line]
 
-        fieldseparator = "\t ;"
-        fieldseparator_comma = "\t ;,"
-
-        for line in f:
-            line = " ".join(line.split())  # Replace multiple spaces with single space
-            line = line.strip()
-            if not line:
-                continue
-            lineno += 1
-
-            # Determine field separator
-            firstcomma = line.find(",")
-            firstdot = line.find(".")
-            if firstcomma >= 0 and firstdot >= 0 and firstdot < firstcomma:
-                tmpsplitline = [x for x in split_multi(line, fieldseparator_comma)]
-            else:
-                tmpsplitline = [x for x in split_multi(line, fieldseparator)]
-
-            # Remove empty fields and replace comma with dot for decimals
-            splitline = [i.replace(",", ".").strip() for i in tmpsplitline if i.strip()]
-
-            e_ok = x_ok = y_ok = r_ok = 1
-            e = -1
-            res = 0.0
-            x = 0.0
-            y = 0.0
-
-            if len(data.InputFormat) <= len(splitline):
-                for i, fmt in enumerate(data.InputFormat):
-                    try:
-                        if fmt == "e":
-                            e = float(splitline[i])
-                        elif fmt == "x":
-                            x = float(splitline[i])
-                        elif fmt == "y":
-                            y = float(splitline[i])
-                        elif fmt == "r":
-                            res = float(splitline[i])
-                    except Exception:
-                        if fmt == "e":
-                            e_ok = 0
-                        elif fmt == "x":
-                            x_ok = 0
-                        elif fmt == "y":
-                            y_ok = 0
-                        elif fmt == "r":
-                            r_ok = 0
-
-                # Optionally skip zero intensity
-                if hasattr(data, "zero_int_chkb") and data.zero_int_chkb and y == 0:
-                    continue
-                if e == 0 and not args:
-                    e_ok = 0
-
-                if "r" in data.InputFormat:
-                    data.res_available = 1
-                else:
-                    data.res_available = 0
-                    res = 0.0
-
-                if data.nonneg and y_ok:
-                    nonneg = 0 if y < 0.0 else 1
-                else:
-                    nonneg = 1
-
-                if e_ok and x_ok and y_ok and r_ok and nonneg:
-                    data.x.append(x * data.xscale)
-                    data.y.append(y)
-                    data.e.append(e)
-                    data.res.append(res * data.xscale)
-                    data.npoints += 1
-                else:
-                    data.Comment.append(line)
-            else:
-                data.Comment.append(line)
+    x, y, e, res, comment = _parse_ascii_block(lines, data, args)
+    data.x = x * data.xscale
+    data.y = y
+    data.e = e
+    data.res = res * data.xscale
+    data.npoints = len(data.x)
+    data.Comment.extend(comment)
 
     if data.error == 0:
         # Generate artificial error data if none was provided
         try:
-            data.e = sasfit_guess_err(3, 2, data.x, data.y)
+            data.e = np.asarray(sasfit_guess_err(3, 2, data.x, data.y), dtype=float)
         except Exception as msg:
             raise RuntimeError(msg)
         data.error = 1
 
     return 1, data
 
+def iter_Ascii(filename, data=None, *args, chunksize=65536):
+    """
+    Generator version of read_Ascii for files too large to be held in memory.
+    The file is read in blocks of chunksize lines and for each block the
+    arrays (x, y, e, res) of the accepted points are yielded, using the same
+    InputFormat, in_out unit conversion, nonneg and zero_int_chkb filtering
+    as read_Ascii. data.Comment and data.npoints are updated while reading,
+    data.x, data.y, data.e and data.res are left empty.
+    If InputFormat has no e column the errors are estimated with
+    sasfit_guess_err(3, 2, ...). The fit windows are carried over between
+    blocks, so the last points of a block are only yielded together with the
+    next one once their window is complete.
+    A generator can't return the status of read_Ascii, instead the cases in
+    which read_Ascii returns 0 or 2 raise an exception on the first next():
+    RuntimeError if InputFormat lacks x or y, FileNotFoundError for a
+    missing file and EOFError if the file ends within the LineSkip header
+    lines. Like read_Ascii, RuntimeError is raised if there are too few
+    points to estimate the errors.
+    """
+    if data is None:
+        data = create_ASCIIData()
+    data.unit, data.xscale = in_out_map.get(data.in_out, ("xxx", 1))
+    data.InputFormat = data.InputFormat.lower()
+    if not ("x" in data.InputFormat and "y" in data.InputFormat):
+        raise RuntimeError(f'InputFormat "{data.InputFormat}" needs to contain x and y')
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+    guess = "e" not in data.InputFormat
+    data.error = 0 if guess else 1
+    data.FileName = filename
+    data.npoints = 0
+    data.x = []
+    data.y = []
+    data.e = []
+    data.res = []
+    data.Comment = []
+
+    sw, po = 3, 2
+    nd = 2 * sw + 1
+    # points waiting for the end of their error window and up to 2*sw
+    # already yielded points in front of them
+    hold = (np.empty(0), np.empty(0), np.empty(0))
+    ctx = (np.empty(0), np.empty(0))
+    last_err = None
+    with open(filename, "r") as f:
+        # Skip header lines
+        for _ in range(data.LineSkip):
+            line = f.readline()
+            if not line:
+                raise EOFError(f'{filename} ends within the {data.LineSkip} header lines')
+            data.Comment.append(line.rstrip())
+        while True:
+            block = list(itertools.islice(f, chunksize))
+            if not block:
+                break
+            # Replace multiple spaces with single space, drop empty lines
+            lines = [" ".join(line.split()) for line in block]
+            lines = [line for line in lines if line]
+            x, y, e, res, comment = _parse_ascii_block(lines, data, args)
+            x = x * data.xscale
+            res = res * data.xscale
+            data.npoints += len(x)
+            data.Comment.extend(comment)
+            if not guess:
+                if len(x) > 0:
+                    yield x, y, e, res
+                continue
+            hx, hy, hres = (np.concatenate(p) for p in zip(hold, (x, y, res)))
+            wx = np.concatenate((ctx[0], hx))
+            wy = np.concatenate((ctx[1], hy))
+            nready = len(hx) - sw
+            if len(wx) < nd or nready <= 0:
+                hold = (hx, hy, hres)
+                continue
+            werr = np.sqrt(_guess_err_chisq(np.lib.stride_tricks.sliding_window_view(wx, nd),
+                                            np.lib.stride_tricks.sliding_window_view(wy, nd),
+                                            po + 1) / (nd - po - 1))
+            # error of each point in hx, the first sw points of the file get
+            # the error of the first complete window
+            idx = np.arange(len(ctx[0]), len(ctx[0]) + nready) - sw
+            err = werr[np.clip(idx, 0, None)]
+            last_err = err[-1]
+            ctx = (wx[:len(ctx[0]) + nready][-2 * sw:], wy[:len(ctx[0]) + nready][-2 * sw:])
+            hold = (hx[nready:], hy[nready:], hres[nready:])
+            yield hx[:nready], hy[:nready], err, hres[:nready]
+    if guess:
+        if last_err is None:
+            raise RuntimeError("not enough data points available")
+        data.error = 1
+        if len(hold[0]) > 0:
+            yield hold[0], hold[1], np.full(len(hold[0]), last_err), hold[2]
+
+# translation tables for the field separator and decimal convention of a line:
+# ';' is always a separator, ',' is either a separator too (if a '.' comes
+# before the first ',') or a decimal comma
+_ASCII_SEP = str.maketrans(";", " ")
+_ASCII_SEP_COMMA = str.maketrans(";,", "  ")
+_ASCII_DECIMAL_COMMA = str.maketrans(";,", " .")
+_ASCII_DEFAULTS = {"x": 0.0, "y": 0.0, "e": -1.0, "r": 0.0}
+
+def _ascii_split(lines):
+    """
+    Translate whitespace-normalized lines such that all field separators
+    become blanks and decimal commas become dots. The convention is detected
+    once for the whole block and only decided line by line if the block mixes
+    both conventions.
+    """
+    if not any("," in line for line in lines):
+        return "\n".join(lines).translate(_ASCII_SEP).split("\n")
+    sepcomma = [0 <= line.find(".") < line.find(",") for line in lines]
+    if all(sepcomma):
+        return "\n".join(lines).translate(_ASCII_SEP_COMMA).split("\n")
+    if not any(sepcomma):
+        return "\n".join(lines).translate(_ASCII_DECIMAL_COMMA).split("\n")
+    return [line.translate(_ASCII_SEP_COMMA if sc else _ASCII_DECIMAL_COMMA)
+            for line, sc in zip(lines, sepcomma)]
+
+def _ascii_columns(tlines, usecols):
+    """
+    Convert the columns usecols of the translated lines tlines to float64.
+    The whole block is parsed by NumPy in one pass. Only if this fails the
+    fields are converted one by one, as float() accepts a few more spellings
+    than np.loadtxt and unreadable fields need to be flagged.
+    Returns the values and a mask of successfully converted fields.
+    """
+    shape = (len(tlines), len(usecols))
+    try:
+        values = np.loadtxt(tlines, usecols=usecols, comments=None, ndmin=2, dtype=np.float64)
+        return values, np.ones(shape, dtype=bool)
+    except ValueError:
+        pass
+    values = np.zeros(shape)
+    ok = np.ones(shape, dtype=bool)
+    for i, line in enumerate(tlines):
+        fields = line.split()
+        for j, col in enumerate(usecols):
+            try:
+                values[i, j] = float(fields[col])
+            except ValueError:
+                ok[i, j] = False
+    return values, ok
+
+def _parse_ascii_block(lines, data, args=()):
+    """
+    Parse a block of whitespace-normalized, non-empty lines according to
+    data.InputFormat, data.nonneg and data.zero_int_chkb.
+    Returns the arrays x, y, e, res (not yet scaled by data.xscale) of the
+    accepted lines and the list of rejected lines which go into the comments.
+    Sets data.res_available if the block contains data lines.
+    """
+    fmt = data.InputFormat
+    tlines = _ascii_split(lines)
+    nfields = np.fromiter(map(len, map(str.split, tlines)), dtype=int, count=len(tlines))
+    candidate = np.flatnonzero(nfields >= len(fmt))
+    ncand = len(candidate)
+
+    cols = {c: np.full(ncand, v) for c, v in _ASCII_DEFAULTS.items()}
+    ok = {c: np.ones(ncand, dtype=bool) for c in _ASCII_DEFAULTS}
+    usecols = [i for i, c in enumerate(fmt) if c in _ASCII_DEFAULTS]
+    if ncand > 0 and usecols:
+        values, vok = _ascii_columns([tlines[i] for i in candidate], usecols)
+        for j, i in enumerate(usecols):
+            c = fmt[i]
+            cols[c] = np.where(vok[:, j], values[:, j], cols[c])
+            ok[c] &= vok[:, j]
+    if "r" not in fmt:
+        cols["r"] = np.zeros(ncand)
+
+    # Optionally skip zero intensity
+    keep = np.ones(ncand, dtype=bool)
+    if data.zero_int_chkb:
+        keep = cols["y"] != 0
+    if np.any(keep):
+        data.res_available = 1 if "r" in fmt else 0
+    accept = keep & ok["x"] & ok["y"] & ok["e"] & ok["r"]
+    if not args:
+        accept &= cols["e"] != 0
+    if data.nonneg:
+        accept &= ~(ok["y"] & (cols["y"] < 0.0))
+
+    rejected = np.ones(len(lines), dtype=bool)
+    rejected[candidate[accept | ~keep]] = False
+    comment = [lines[i] for i in np.flatnonzero(rejected)]
+    return cols["x"][accept], cols["y"][accept], cols["e"][accept], cols["r"][accept], comment
+
 def split_multi(s, seps):
     import re
     # Split string s by any of the characters in seps
@@ -181,6 +302,7 @@ def sasfit_guess_err(sw, po, x, y):
     x: list or np.array of x values
     y: list or np.array of y values
     Returns: list of estimated errors for each y value
+    All windows are fitted at once, see _guess_err_chisq.
     """
     x = np.asarray(x, dtype=float)
     y = np.asarray(y, dtype=float)
@@ -196,29 +318,49 @@ def sasfit_guess_err(sw, po, x, y):
         raise ValueError("not enough data points available")
 
     err = np.zeros(ndata)
-    for i in range(sw, ndata - sw):
-        # Select window
-        idx = np.arange(i - sw, i + sw + 1)
-        xw = x[idx]
-        yw = y[idx]
-        # Design matrix for polynomial fit
-        X = np.vander(xw, N=ncoeffs, increasing=True)
-        # Weighted least squares (weights are all 1)
-        coeffs, residuals, rank, s = np.linalg.lstsq(X, yw, rcond=None)
-        # Calculate residuals
-        yfit = X @ coeffs
-        chisq = np.sum((yw - yfit) ** 2)
-        dof = nd - ncoeffs
-        if dof > 0:
-            err[i] = np.sqrt(chisq / dof)
-        else:
-            err[i] = 0.0
+    dof = nd - ncoeffs
+    if dof > 0:
+        xw = np.lib.stride_tricks.sliding_window_view(x, nd)
+        yw = np.lib.stride_tricks.sliding_window_view(y, nd)
+        err[sw:ndata - sw] = np.sqrt(_guess_err_chisq(xw, yw, ncoeffs) / dof)
 
     # Fill the edges with the nearest computed error
     err[:sw] = err[sw]
     err[ndata - sw:] = err[ndata - sw - 1]
     return err.tolist()
-    
+
+def _guess_err_chisq(xw, yw, ncoeffs, blocksize=65536):
+    """
+    Residual sum of squares of a least squares polynomial fit of degree
+    ncoeffs-1 to each row of the windows xw, yw.
+    The residuals do not change under shifting and scaling of x, so every
+    window is mapped onto [-1,1] around its centre. For equidistant x all
+    windows then share the same design matrix and the residuals are obtained
+    with a single precomputed projection, otherwise the windows are fitted
+    in stacked blocks of blocksize windows.
+    """
+    nd = xw.shape[1]
+    rcond = np.finfo(float).eps * nd
+    dx = xw - xw[:, nd // 2, None]
+    scale = np.max(np.abs(dx), axis=1, keepdims=True)
+    scale[scale == 0] = 1.0
+    t = dx / scale
+    if np.allclose(t, t[0], rtol=0, atol=1e-10):
+        U, s, _ = np.linalg.svd(np.vander(t[0], N=ncoeffs, increasing=True), full_matrices=False)
+        U = U[:, s > rcond * s[0]]
+        R = np.eye(nd) - U @ U.T
+        return np.sum((yw @ R.T) ** 2, axis=1)
+    chisq = np.empty(len(xw))
+    powers = np.arange(ncoeffs)
+    for start in range(0, len(xw), blocksize):
+        tb = t[start:start + blocksize]
+        yb = yw[start:start + blocksize]
+        U, s, _ = np.linalg.svd(tb[:, :, None] ** powers, full_matrices=False)
+        U = U * (s > rcond * s[:, :1])[:, None, :]
+        yfit = np.einsum('nij,nj->ni', U, np.einsum('nij,ni->nj', U, yb))
+        chisq[start:start + blocksize] = np.sum((yb - yfit) ** 2, axis=1)
+    return chisq
+
 def readBerSANStrans(BerSANStransfile):
     events = {}
     with open(BerSANStransfile) as file:
@@ -230,10 +372,468 @@ def readBerSANStrans(BerSANStransfile):
             events[f[1].strip()] = f[2].strip()
     return events
 
+class TransmissionStore:
+    __doc__ = """
+    TransmissionStore(Tfiles=None, rtol=0.05, maxfiles=64) keeps the BerSANS
+    transmission files of Tfiles = {wavelength: filename}. Each file is parsed
+    only once by readBerSANStrans and reparsed only if its modification time
+    changes. The parsed tables of the maxfiles most recently used files are
+    kept, clear() drops all of them.
+    The wavelengths are kept sorted, so that the file for a wavelength is
+    found by bisection: the closest wavelength within the relative
+    tolerance rtol is used.
+
+        store = TransmissionStore({0.5: 'trans5A.txt', 0.8: 'trans8A.txt'})
+        store.transmissions(0.81)          # {SampleName: transmission}
+        store.lookup(['H2O', 'Sample 1'], [0.5, 0.8])
+    """
+    def __init__(self, Tfiles=None, rtol=0.05, maxfiles=64):
+        self.rtol = rtol
+        self.maxfiles = maxfiles
+        self.wavelengths = []
+        self.filenames = []
+        self.tables = {}
+        if Tfiles is not None:
+            self.add(Tfiles)
+
+    def add(self, Tfiles):
+        """
+        Adds {wavelength: filename}, existing files are parsed immediately.
+        A file for an already known wavelength replaces the old one.
+        """
+        for wl, filename in Tfiles.items():
+            wl = float(wl)
+            i = np.searchsorted(self.wavelengths, wl)
+            if i < len(self.wavelengths) and self.wavelengths[i] == wl:
+                self.filenames[i] = filename
+            else:
+                self.wavelengths.insert(i, wl)
+                self.filenames.insert(i, filename)
+            if os.path.isfile(filename):
+                self.table(filename)
+
+    def table(self, filename):
+        """
+        Returns the parsed transmission file {SampleName: transmission} as a
+        new dict, so that changing it doesn't affect the cached table.
+        """
+        mtime = os.path.getmtime(filename)
+        key = os.path.abspath(filename)
+        cached = self.tables.pop(key, None)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, readBerSANStrans(filename))
+        # the most recently used table is the last one
+        self.tables[key] = cached
+        while len(self.tables) > self.maxfiles:
+            del self.tables[next(iter(self.tables))]
+        return dict(cached[1])
+
+    def clear(self):
+        """
+        Drops all parsed tables, they are read again on their next use.
+        """
+        self.tables.clear()
+
+    def find(self, wavelength):
+        """
+        Returns the index of the closest wavelength within rtol or None.
+        """
+        wavelength = float(wavelength)
+        i = np.searchsorted(self.wavelengths, wavelength)
+        best = None
+        for j in (i-1, i):
+            if 0 <= j < len(self.wavelengths):
+                if abs(self.wavelengths[j]-wavelength)/wavelength < self.rtol:
+                    if best is None or abs(self.wavelengths[j]-wavelength) < abs(self.wavelengths[best]-wavelength):
+                        best = j
+        return best
+
+    def filename(self, wavelength):
+        """
+        Returns the transmission file for wavelength or '' if there is none.
+        """
+        i = self.find(wavelength)
+        return '' if i is None else self.filenames[i]
+
+    def transmissions(self, wavelength):
+        """
+        Returns {SampleName: transmission} for wavelength, an empty dict if
+        there is no (existing) transmission file for it.
+        """
+        filename = self.filename(wavelength)
+        if not os.path.isfile(filename):
+            return {}
+        return self.table(filename)
+
+    def lookup(self, sample_names, wavelengths):
+        """
+        Returns the transmissions of the samples at the corresponding
+        wavelengths as list of strings, None for unknown samples. The
+        transmission files are located once per distinct wavelength.
+        """
+        tables = {}
+        result = []
+        for name, wl in zip(sample_names, wavelengths):
+            wl = float(wl)
+            if wl not in tables:
+                tables[wl] = self.transmissions(wl)
+            result.append(tables[wl].get(f'{name}'))
+        return result
+
+# parsed transmission files of SANSdata.BerSANStrans, at most the last 64
+# files are kept, transmission_store.clear() frees them
+transmission_store = TransmissionStore()
+
+class WavelengthCalibration:
+    __doc__ = """
+    WavelengthCalibration(table, coefficients, covariance) is the wavelength
+    calibration of the velocity selector, lambda = a + b/rpm with the
+    rotation speed rpm (%Setup,LambdaC) and lambda in nm. table is a
+    structured array with the fields calibration_fields, one row per
+    measured rotation speed, coefficients (a, b) and covariance their
+    covariance matrix, as obtained by fit(table). npaths is the number of
+    flight paths the wavelength of a row was determined from, for npaths=1
+    it includes the time offset of the chopper. The calibration is stored
+    by save() as text file and read by load(), e.g. for the conversion of
+    raw data with rawhdf2hmi:
+
+        cal = WavelengthCalibration.load('lambda_calibration.txt')
+        cal.wavelength(18000)              # (lambda, error)
+    """
+    calibration_fields = [('rpm', np.float64), ('lambda', np.float64), ('lambda_err', np.float64),
+                          ('DL/L', np.float64), ('DL/L_err', np.float64), ('nruns', np.int64),
+                          ('npaths', np.int64)]
+
+    def __init__(self, table, coefficients, covariance):
+        self.table = np.sort(np.asarray(table, dtype=self.calibration_fields), order='rpm')
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.covariance = np.asarray(covariance, dtype=np.float64)
+
+    @staticmethod
+    def line_fit(x, y, sigma):
+        """
+        Weighted least squares fit of y = a + b*x with the errors sigma.
+        Returns (a, b), their covariance matrix and chi^2.
+        x and y are taken relative to their weighted means, which keeps the
+        fit exact even if the errors differ by many orders of magnitude.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        w = 1.0/np.asarray(sigma, dtype=np.float64)**2
+        W = np.sum(w)
+        xm = np.sum(w*x)/W
+        ym = np.sum(w*y)/W
+        Sxx = np.sum(w*(x-xm)**2)
+        slope = np.sum(w*(x-xm)*(y-ym))/Sxx
+        coefficients = np.array([ym-slope*xm, slope])
+        covariance = np.array([[1.0/W+xm**2/Sxx, -xm/Sxx],
+                               [-xm/Sxx, 1.0/Sxx]])
+        chi2 = float(np.sum(w*(y-ym-slope*(x-xm))**2))
+        return coefficients, covariance, chi2
+
+    @classmethod
+    def fit(cls, table):
+        """
+        Weighted regression of lambda versus 1/rpm of all rows of table with
+        a finite lambda and lambda_err. The covariance is scaled by the
+        reduced chi^2 if there are more than two rotation speeds.
+        """
+        table = np.asarray(table, dtype=cls.calibration_fields)
+        valid = np.isfinite(table['lambda']) & np.isfinite(table['lambda_err']) & (table['lambda_err'] > 0)
+        if np.count_nonzero(valid) < 2:
+            raise RuntimeError('at least two rotation speeds with a wavelength are needed for the calibration')
+        used = table[valid]
+        coefficients, covariance, chi2 = cls.line_fit(1.0/used['rpm'], used['lambda'], used['lambda_err'])
+        if len(used) > 2:
+            covariance = covariance*chi2/(len(used)-2)
+        return cls(table, coefficients, covariance)
+
+    def wavelength(self, rpm):
+        """
+        Returns the calibrated wavelength in nm and its error for the
+        rotation speed rpm (scalar or array).
+        """
+        g = np.stack(np.broadcast_arrays(1.0, 1.0/np.asarray(rpm, dtype=np.float64)))
+        wl = self.coefficients @ g
+        err = np.sqrt(np.einsum('i...,ij,j...->...', g, self.covariance, g))
+        return wl, err
+
+    def resolution(self, rpm):
+        """
+        Returns the relative wavelength spread DL/L at rpm, interpolated
+        linearly between the measured rotation speeds.
+        """
+        valid = np.isfinite(self.table['DL/L'])
+        return np.interp(rpm, self.table['rpm'][valid], self.table['DL/L'][valid])
+
+    def save(self, filename):
+        """
+        Writes the coefficients, their covariance and the table as text file.
+        """
+        names = [name for name, dtype in self.calibration_fields]
+        header = "\n".join(["WavelengthCalibration lambda = a + b/rpm",
+                            "coefficients " + " ".join(f"{v:.10g}" for v in self.coefficients),
+                            "covariance " + " ".join(f"{v:.10g}" for v in self.covariance.ravel()),
+                            " ".join(names)])
+        np.savetxt(filename, np.column_stack([self.table[name] for name in names]),
+                   fmt='%.10g', header=header, encoding='utf-8')
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads a calibration written by save(), columns missing in older
+        files are 0.
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        header = {}
+        names = []
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                fields = line[1:].split()
+                if fields and fields[0] in ('coefficients', 'covariance'):
+                    header[fields[0]] = np.array(fields[1:], dtype=np.float64)
+                elif fields and fields[0] == 'rpm':
+                    names = fields
+        if 'coefficients' not in header or 'covariance' not in header:
+            raise RuntimeError(f'{filename} is not a wavelength calibration file')
+        values = np.loadtxt(filename, ndmin=2, encoding='utf-8')
+        table = np.zeros(len(values), dtype=cls.calibration_fields)
+        for i, name in enumerate(names):
+            if name in table.dtype.names:
+                table[name] = values[:, i]
+        return cls(table, header['coefficients'], header['covariance'].reshape(2, 2))
+
+def _utf8(value, values):
+    return value.decode('UTF-8')
+
+_SANS1time = 'entry1/SANS/detector/counting_time'
+
+def _sans1_beam(value, values):
+    return value/100.0/max([0.1, values[(_SANS1time, 0)]])
+
+def _sans1_deadtime(value, values):
+    return SANSdata.deadtimecorrection(value, max([0.1, values[(_SANS1time, 0)]]), 3.3e-6)
+
+def _sans1_monitor(value, values):
+    return max([_sans1_deadtime(value, values), 1])
+
+# mapping of the NeXus entries of SANS-1 onto BerSANS keys in the order they
+# appear in the BerSANS file:
+# (HDF path, element or @attribute, BerSANS key, conversion(value, values), rounding digits)
+SANS1hdfmap = [
+    ('entry1/SANS/name',                        0, "%File,Instrument",          _utf8, None),
+    ('entry1/SANS/SINQ/name',                   0, "%File,Source",              _utf8, None),
+    ('entry1/user/name',                        0, "%File,User",                _utf8, None),
+    ('entry1/proposal_user/email',              0, "%File,Email",               _utf8, None),
+    ('entry1/proposal_id',                      0, "%File,ProposalID",          _utf8, None),
+    ('entry1/proposal_title',                   0, "%File,ProposalTitle",       _utf8, None),
+    ('entry1/title',                            0, "%File,Title=",              _utf8, None),
+    ('entry1/start_time',                       0, "%File,FromDate",            lambda v, d: _utf8(v, d)[:10], None),
+    ('entry1/start_time',                       0, "%File,FromTime",            lambda v, d: _utf8(v, d)[11:], None),
+    ('entry1/end_time',                         0, "%File,ToDate",              lambda v, d: _utf8(v, d)[:10], None),
+    ('entry1/end_time',                         0, "%File,ToTime",              lambda v, d: _utf8(v, d)[11:], None),
+    ('entry1/SANS/detector/x_pixel_size',       0, "%Detector,PixelSizeX",      None, None),
+    ('entry1/SANS/detector/x_pixel_size', '@units', "%Detector,PixelSizeXUnit", _utf8, None),
+    ('entry1/SANS/detector/y_pixel_size',       0, "%Detector,PixelSizeY",      None, None),
+    ('entry1/SANS/detector/y_pixel_size', '@units', "%Detector,PixelSizeYUnit", _utf8, None),
+    ('entry1/SANS/detector/x_position',         0, "%Detector,Distance",        lambda v, d: v/1000, 4),
+    ('entry1/sample/name',                      0, "%Sample,SampleName",        lambda v, d: _utf8(v, d).strip(), None),
+    ('entry1/sample/environment',               0, "%Sample,Environment",       _utf8, None),
+    ('entry1/sample/T',                        -1, "%Sample,Temperature",       None, 2),
+    ('entry1/sample/T',                        -1, "%Sample,Temp1",             None, 2),
+    ('entry1/sample/temperature',              -1, "%Sample,Temp2",             None, 2),
+    ('entry1/sample/magnetic_field',            0, "%Sample,Magnet",            None, 4),
+    ('entry1/sample/x_position',                0, "%Sample,XPos=",             None, 3),
+    ('entry1/sample/x_null',                    0, "%Sample,XPosNull=",         None, 3),
+    ('entry1/sample/y_position',                0, "%Sample,YPos",              None, 3),
+    ('entry1/sample/y_null',                    0, "%Sample,YPosNull",          None, 3),
+    ('entry1/sample/z_position',                0, "%Sample,ZPos",              None, 3),
+    ('entry1/sample/z_null',                    0, "%Sample,ZPosNull",          None, 3),
+    ('entry1/sample/omega',                     0, "%Sample,A3",                None, 3),
+    ('entry1/sample/omega_null',                0, "%Sample,A3Null",            None, 3),
+    ('entry1/sample/omega',                     0, "%Sample,Omega",             None, 3),
+    ('entry1/sample/omega_null',                0, "%Sample,OmegaNull",         None, 3),
+    ('entry1/sample/goniometer_theta',          0, "%Sample,SG",                None, 3),
+    ('entry1/sample/goniometer_theta_null',     0, "%Sample,SGNull",            None, 3),
+    ('entry1/sample/magnet_z',                  0, "%Sample,Z_Magnet",          None, 3),
+    ('entry1/sample/magnet_z_null',             0, "%Sample,Z_MagnetNull",      None, 3),
+    ('entry1/sample/magnet_omega',              0, "%Sample,Omega_Magnet",      None, 3),
+    ('entry1/sample/position',                  0, "%Sample,Position",          None, 3),
+    ('entry1/sample/position_null',             0, "%Sample,PositionNull",      None, 3),
+    ('entry1/sample/named_position',            0, "%Sample,SamplePosName",     None, 3),
+    ('entry1/sample/stick_rotation',            0, "%Sample,Dom",               None, 3),
+    ('entry1/sample/goniometer_theta',          0, "%Sample,Theta",             None, 3),
+    ('entry1/sample/goniometer_theta_null',     0, "%Sample,ThetaNull",         None, 3),
+    ('entry1/sample/goniometer_theta',          0, "%Sample,Phi",               None, 3),
+    ('entry1/sample/goniometer_theta_null',     0, "%Sample,PhiNull",           None, 3),
+    ('entry1/SANS/integrated_beam/counts',      0, "%Sample,IEEE6",             _sans1_beam, 3),
+    ('entry1/SANS/monitor1/counts',             0, "%Sample,IEEE1",             _sans1_monitor, 3),
+    ('entry1/SANS/monitor2/counts',             0, "%Sample,IEEE2",             _sans1_monitor, 3),
+    ('entry1/SANS/monitor3/counts',             0, "%Sample,IEEE3",             _sans1_deadtime, 3),
+    ('entry1/SANS/monitor4/counts',             0, "%Sample,IEEE4",             None, None),
+    ('entry1/SANS/monitor_5/counts',            0, "%Sample,IEEE5",             None, None),
+    ('entry1/SANS/monitor_7/counts',            0, "%Sample,IEEE7",             None, None),
+    ('entry1/SANS/monitor_8/counts',            0, "%Sample,IEEE8",             None, None),
+    ('entry1/SANS/Dornier-VS/rotation_speed',   0, "%Setup,LambdaC",            None, 3),
+    ('entry1/SANS/Dornier-VS/tilt_angle',       0, "%Setup,Tilting",            None, 3),
+    ('entry1/SANS/Dornier-VS/lambda',           0, "%Setup,Lambda",             None, 4),
+    ('entry1/SANS/collimator/length',           0, "%Setup,Collimation",        None, None),
+    ('entry1/SANS/attenuator/selection',        0, "%Setup,Attenuator",         _utf8, None),
+    ('entry1/SANS/beam_stop/out_flag',          0, "%Setup,Beamstop",           None, None),
+    ('entry1/SANS/beam_stop/x_position',        0, "%Setup,BeamstopX",          None, 2),
+    ('entry1/SANS/beam_stop/x_null',            0, "%Setup,BeamstopXNull",      None, 2),
+    ('entry1/SANS/beam_stop/y_position',        0, "%Setup,BeamstopY",          None, 2),
+    ('entry1/SANS/beam_stop/y_null',            0, "%Setup,BeamstopYNull",      None, 2),
+    ('entry1/SANS/detector/x_position',         0, "%Setup,SD",                 lambda v, d: v/1000, 2),
+    ('entry1/SANS/detector/x_null',             0, "%Setup,SDNull",             lambda v, d: v/1000, 2),
+    ('entry1/SANS/detector/y_position',         0, "%Setup,SY",                 lambda v, d: v/1000, 2),
+    ('entry1/SANS/detector/y_null',             0, "%Setup,SYNull",             lambda v, d: v/1000, 2),
+    ('entry1/SANS/integrated_beam/counts',      0, "%Counter,ProtonBeam",       _sans1_beam, 2),
+    ('entry1/SANS/monitor1/counts',             0, "%Counter,Moni1",            lambda v, d: int(_sans1_monitor(v, d)), None),
+    ('entry1/SANS/monitor2/counts',             0, "%Counter,Moni2",            lambda v, d: int(_sans1_monitor(v, d)), None),
+    ('entry1/SANS/monitor3/counts',             0, "%Counter,Moni3",            lambda v, d: int(_sans1_deadtime(v, d)), None),
+    ('entry1/SANS/monitor4/counts',             0, "%Counter,Moni4",            lambda v, d: int(v), None),
+    ('entry1/SANS/monitor_5/counts',            0, "%Counter,Moni5",            lambda v, d: int(v), None),
+    ('entry1/SANS/monitor_7/counts',            0, "%Counter,Moni7",            lambda v, d: int(v), None),
+    ('entry1/SANS/monitor_8/counts',            0, "%Counter,Moni8",            lambda v, d: int(v), None),
+    ('entry1/SANS/detector/counting_time',      0, "%Counter,Time",             lambda v, d: max([0.001, float(v)]), 3),
+]
+
+class HDFLazyArray:
+    __doc__ = """
+    HDFLazyArray(filename, path, dset=None) is a proxy for the dataset path in
+    the HDF file filename. Only shape, dtype and storage layout are read
+    during initialization, from dset if the file is already open.
+    Indexing reads just the requested hyperslab, e.g. a range of TOF channels,
+    and np.asarray() reads the whole dataset once and keeps it. Datasets with
+    contiguous, unfiltered storage are memory mapped instead of being read
+    through h5py. For TOF cubes (nx, ny, ntof) channels() reads single
+    channels or channel ranges and iter_channels() walks through the cube
+    in blocks of channels, so that the memory needed stays bounded.
+    """
+
+    def __init__(self, filename, path, dset=None):
+        self.filename = filename
+        self.path = path
+        self._array = None
+        if dset is None:
+            with h5py.File(filename, 'r') as HDF:
+                self.getlayout(HDF[path])
+        else:
+            self.getlayout(dset)
+
+    def getlayout(self, dset):
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.chunks = dset.chunks
+        self.offset = None
+        if dset.chunks is None and dset.dtype.kind in 'iuf':
+            self.offset = dset.id.get_offset()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def memmap(self):
+        """
+        Returns a read-only np.memmap of the dataset or None if the storage
+        layout does not allow it.
+        """
+        if self.offset is None:
+            return None
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+    def read(self):
+        """
+        Reads the whole dataset, the result is kept for later accesses.
+        """
+        if self._array is None:
+            mm = self.memmap()
+            if mm is not None:
+                self._array = np.array(mm)
+            else:
+                with h5py.File(self.filename, 'r') as HDF:
+                    self._array = np.empty(self.shape, dtype=self.dtype)
+                    HDF[self.path].read_direct(self._array)
+        return self._array
+
+    def __getitem__(self, key):
+        if self._array is not None:
+            # a copy, so that the cached data can't be modified through slices
+            return np.array(self._array[key])
+        mm = self.memmap()
+        if mm is not None:
+            return np.array(mm[key])
+        with h5py.File(self.filename, 'r') as HDF:
+            return HDF[self.path][key]
+
+    def __array__(self, dtype=None, copy=None):
+        """
+        Follows the numpy 2 protocol: copy=True always returns a copy, so
+        that np.array(proxy) can be modified without changing the cached
+        data, copy=False raises ValueError if a conversion to dtype is
+        needed and copy=None copies only for a conversion.
+        """
+        array = self.read()
+        if dtype is None or np.dtype(dtype) == array.dtype:
+            return array.copy() if copy else array
+        if copy is False:
+            raise ValueError(f'a copy is needed to convert {array.dtype} into {np.dtype(dtype)}')
+        return array.astype(dtype)
+
+    def channels(self, start, stop=None):
+        """
+        Reads the TOF channel start, or the channels start..stop-1, of all
+        pixels, i.e. [:, :, start] or [:, :, start:stop].
+        """
+        return self[:, :, start if stop is None else slice(start, stop)]
+
+    def iter_channels(self, blocksize=2**26):
+        """
+        Yields (start, counts[:, :, start:stop]) for consecutive blocks of
+        TOF channels of at most blocksize bytes (at least one channel).
+        For chunked datasets the blocks contain whole chunks along the TOF
+        axis if such a chunk fits into blocksize. Otherwise, e.g. for chunks
+        spanning all channels, the blocks cut through the chunks, which are
+        then decompressed once per block.
+        """
+        ntof = self.shape[2]
+        plane = self.dtype.itemsize*self.shape[0]*self.shape[1]
+        if self.chunks is not None and self.chunks[2]*plane <= blocksize:
+            step = self.chunks[2]*(blocksize//(self.chunks[2]*plane))
+        else:
+            step = max(1, blocksize//plane)
+        for start in range(0, ntof, step):
+            yield start, self.channels(start, min(start+step, ntof))
+
+    def sum(self, blocksize=2**26):
+        """
+        Sum of all values, for TOF cubes accumulated channel block by channel
+        block.
+        """
+        if self._array is not None or self.ndim != 3:
+            return np.asarray(self).sum()
+        acc = np.int64 if self.dtype.kind in 'iub' else np.float64
+        return sum(block.sum(dtype=acc) for start, block in self.iter_channels(blocksize))
+
 class SANSdata:
     __doc__ = """
     SANSdata(inputfn) needs as an argument a string to a valid filename inputfn.
     During initialization it will try to automatically determining its type.
+    With SANSdata(inputfn, lazy=True) the detector counts of hdf files are not
+    read. "%Counts,DetCounts" is then a HDFLazyArray which reads the data, or
+    only the requested part of it, on first access, and the "%Counter,Sum..."
+    entries which depend on the counts are only added by addCounterSums().
     """
     __author__ = "Joachim Kohlbrecher"
     __copyright__ = "Copyright 2024, The SASfit Project"
@@ -251,8 +851,11 @@ class SANSdata:
     infn = ''
     BerSANS = {}
     transmission = {}
+    lazy = False
+    hdfvalues = None
     
-    def deadtimecorrection(self, moni, etime, dt):
+    @staticmethod
+    def deadtimecorrection(moni, etime, dt):
         return moni / (1.0 - dt/etime * moni)
     
     def split_path(self,inputfn):
@@ -263,13 +866,21 @@ class SANSdata:
         
     def getSANS1hdf(self):
         HDF = h5py.File(self.infn)
-        detector_counts=np.array(HDF['entry1/SANS/detector/counts'])    
-        if detector_counts.shape != (128,128):
-            HDF.close()
-            raise RuntimeError(f'can\'t convert {self.infn} as it has the shape {detector_counts.shape}')
-        if np.sum(detector_counts) == 0 :
+        dset = HDF['entry1/SANS/detector/counts']
+        if dset.shape[:2] != (128,128) or dset.ndim not in (2,3):
             HDF.close()
-            raise RuntimeError(f'{self.infn} seems to be empty. Sum({np.sum(detector_counts)})')
+            raise RuntimeError(f'can\'t convert {self.infn} as it has the shape {dset.shape}')
+        # TOF cubes (128,128,ntof) are never read as a whole, they are
+        # accessed channel by channel through the HDFLazyArray
+        if self.lazy or dset.ndim == 3:
+            detector_counts = HDFLazyArray(self.infn, 'entry1/SANS/detector/counts', dset)
+        else:
+            detector_counts=np.array(dset)
+        if not self.lazy:
+            S = detector_counts.sum()
+            if S == 0:
+                HDF.close()
+                raise RuntimeError(f'{self.infn} seems to be empty. Sum({S})')
         self.BerSANS = {}
         self.BerSANS.update({"%Counts,DetCounts":detector_counts})
         self.BerSANS.update({"%File,Type"       : "SANSDRawhdf" })
@@ -278,187 +889,113 @@ class SANSdata:
         self.BerSANS.update({"%File,DataSizeX"  : 128})
         self.BerSANS.update({"%File,DataSizeY"  : 128})
         self.BerSANS.update({"%File,Definition" : str(HDF['entry1/definition'][0].decode('UTF-8'))})
-        if 'entry1/SANS/name' in HDF.keys():
-            self.BerSANS.update({"%File,Instrument": HDF['entry1/SANS/name'][0].decode(encoding='UTF-8')})
-        if 'entry1/SANS/SINQ/name' in HDF.keys():
-            self.BerSANS.update({"%File,Source" : HDF['entry1/SANS/SINQ/name'][0].decode('UTF-8')})
-        if 'entry1/user/name' in HDF.keys():
-            self.BerSANS.update({"%File,User" : HDF['entry1/user/name'][0].decode(encoding='UTF-8')})
-        if 'entry1/proposal_user/email' in HDF.keys():
-            self.BerSANS.update({"%File,Email" : HDF['entry1/proposal_user/email'][0].decode(encoding='UTF-8')})
-        if 'entry1/proposal_id' in HDF.keys():
-            self.BerSANS.update({"%File,ProposalID" : HDF['entry1/proposal_id'][0].decode('UTF-8')})
-        if 'entry1/proposal_title' in HDF.keys():
-            self.BerSANS.update({"%File,ProposalTitle" : HDF['entry1/proposal_title'][0].decode('UTF-8')})
-        if 'entry1/title' in HDF.keys():
-            self.BerSANS.update({"%File,Title=" : HDF['entry1/title'][0].decode('UTF-8')})
-        if 'entry1/start_time' in HDF.keys():
-            self.BerSANS.update({"%File,FromDate" : HDF['entry1/start_time'][0].decode('UTF-8')[:10]})
-        if 'entry1/start_time' in HDF.keys():
-            self.BerSANS.update({"%File,FromTime" : HDF['entry1/start_time'][0].decode('UTF-8')[11:]})
-        if 'entry1/end_time' in HDF.keys():
-            self.BerSANS.update({"%File,ToDate" : HDF['entry1/end_time'][0].decode('UTF-8')[:10]})
-        if 'entry1/end_time' in HDF.keys():
-            self.BerSANS.update({"%File,ToTime" : HDF['entry1/end_time'][0].decode('UTF-8')[11:]})
-            
-        if 'entry1/SANS/detector/x_pixel_size' in HDF.keys():
-            self.BerSANS.update({"%Detector,PixelSizeX" : HDF['entry1/SANS/detector/x_pixel_size'][0]})
-            self.BerSANS.update({"%Detector,PixelSizeXUnit": HDF['entry1/SANS/detector/x_pixel_size'].attrs['units'].decode('UTF-8')})
-        if 'entry1/SANS/detector/y_pixel_size' in HDF.keys():
-            self.BerSANS.update({"%Detector,PixelSizeY" : HDF['entry1/SANS/detector/y_pixel_size'][0]})
-            self.BerSANS.update({"%Detector,PixelSizeYUnit": HDF['entry1/SANS/detector/y_pixel_size'].attrs['units'].decode('UTF-8')})
-        if 'entry1/SANS/detector/x_position' in HDF.keys():
-            self.BerSANS.update({"%Detector,Distance":round(HDF['entry1/SANS/detector/x_position'][0]/1000,4)})
-        
-        if 'entry1/sample/name' in HDF.keys():
-            SNtmp = HDF['entry1/sample/name'][0].decode('UTF-8')
-            self.BerSANS.update({"%Sample,SampleName"    : SNtmp.strip() })
-        if 'entry1/sample/environment' in HDF.keys():
-            self.BerSANS.update({"%Sample,Environment"   : HDF['entry1/sample/environment'][0].decode('UTF-8')})
-        if 'entry1/sample/T' in HDF.keys():
-            self.BerSANS.update({"%Sample,Temperature"   : round(HDF['entry1/sample/T'][-1],2)})
-            self.BerSANS.update({"%Sample,Temp1"   : round(HDF['entry1/sample/T'][-1],2)})
-#            print(HDF['entry1/sample/temperature'][-1])
-        if 'entry1/sample/temperature' in HDF.keys():
-            self.BerSANS.update({"%Sample,Temp2"  : round(HDF['entry1/sample/temperature'][-1],2)})
-        if 'entry1/sample/magnetic_field' in HDF.keys():
-            self.BerSANS.update({"%Sample,Magnet"        : round(HDF['entry1/sample/magnetic_field'][0],4)})
-        if 'entry1/sample/x_position' in HDF.keys():
-            self.BerSANS.update({"%Sample,XPos="         : round(HDF['entry1/sample/x_position'][0],3)})
-        if 'entry1/sample/x_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,XPosNull="     : round(HDF['entry1/sample/x_null'][0],3)})
-        if 'entry1/sample/y_position' in HDF.keys():
-            self.BerSANS.update({"%Sample,YPos"          : round(HDF['entry1/sample/y_position'][0],3)})
-        if 'entry1/sample/y_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,YPosNull"      : round(HDF['entry1/sample/y_null'][0],3)})
-        if 'entry1/sample/z_position' in HDF.keys():
-            self.BerSANS.update({"%Sample,ZPos"          : round(HDF['entry1/sample/z_position'][0],3)})
-        if 'entry1/sample/z_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,ZPosNull"      : round(HDF['entry1/sample/z_null'][0],3)})
-        if 'entry1/sample/omega' in HDF.keys():
-            self.BerSANS.update({"%Sample,A3"            : round(HDF['entry1/sample/omega'][0],3)})
-        if 'entry1/sample/omega_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,A3Null"        : round(HDF['entry1/sample/omega_null'][0],3)})
-        if 'entry1/sample/omega' in HDF.keys():
-            self.BerSANS.update({"%Sample,Omega"         : round(HDF['entry1/sample/omega'][0],3)})
-        if 'entry1/sample/omega_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,OmegaNull"     : round(HDF['entry1/sample/omega_null'][0],3)})
-        if 'entry1/sample/goniometer_theta' in HDF.keys():
-            self.BerSANS.update({"%Sample,SG"            : round(HDF['entry1/sample/goniometer_theta'][0],3)})
-        if 'entry1/sample/goniometer_theta_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,SGNull"        : round(HDF['entry1/sample/goniometer_theta_null'][0],3)})
-        if 'entry1/sample/magnet_z' in HDF.keys():
-            self.BerSANS.update({"%Sample,Z_Magnet"      : round(HDF['entry1/sample/magnet_z'][0],3)})
-        if 'entry1/sample/magnet_z_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,Z_MagnetNull"  : round(HDF['entry1/sample/magnet_z_null'][0],3)})
-        if 'entry1/sample/magnet_omega' in HDF.keys():
-            self.BerSANS.update({"%Sample,Omega_Magnet"  : round(HDF['entry1/sample/magnet_omega'][0],3)})
-        if 'entry1/sample/position' in HDF.keys():
-            self.BerSANS.update({"%Sample,Position"      : round(HDF['entry1/sample/position'][0],3)})
-        if 'entry1/sample/position_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,PositionNull" : round(HDF['entry1/sample/position_null'][0],3)})
-        if 'entry1/sample/named_position' in HDF.keys():
-            self.BerSANS.update({"%Sample,SamplePosName" : round(HDF['entry1/sample/named_position'][0],3)})                                                                           
-        if 'entry1/sample/stick_rotation' in HDF.keys():
-            self.BerSANS.update({"%Sample,Dom"           : round(HDF['entry1/sample/stick_rotation'][0],3)})
-        if 'entry1/sample/goniometer_theta' in HDF.keys():
-            self.BerSANS.update({"%Sample,Theta"         : round(HDF['entry1/sample/goniometer_theta'][0],3)})
-        if 'entry1/sample/goniometer_theta_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,ThetaNull" : round(HDF['entry1/sample/goniometer_theta_null'][0],3)})
-        if 'entry1/sample/goniometer_theta' in HDF.keys():
-            self.BerSANS.update({"%Sample,Phi"         : round(HDF['entry1/sample/goniometer_theta'][0],3)})
-        if 'entry1/sample/goniometer_theta_null' in HDF.keys():
-            self.BerSANS.update({"%Sample,PhiNull" : round(HDF['entry1/sample/goniometer_theta_null'][0],3)})
-        
-        if 'entry1/SANS/detector/counting_time' in HDF.keys():
-            time=max([0.1,HDF['entry1/SANS/detector/counting_time'][0]])
-        if 'entry1/SANS/integrated_beam/counts' in HDF.keys():
-            pbeam=HDF['entry1/SANS/integrated_beam/counts'][0]/100.0/time
-            self.BerSANS.update({"%Sample,IEEE6"    : round(pbeam,3)})
-        if 'entry1/SANS/monitor1/counts' in HDF.keys():
-            moni1 = HDF['entry1/SANS/monitor1/counts'][0]
-            moni1 = self.deadtimecorrection(moni1, time, 3.3e-6)
-            moni1=max([moni1,1])
-            self.BerSANS.update({"%Sample,IEEE1"     : round(moni1,3)})
-        if 'entry1/SANS/monitor2/counts' in HDF.keys():
-            moni2 = HDF['entry1/SANS/monitor2/counts'][0]
-            moni2 = self.deadtimecorrection(moni2, time, 3.3e-6)
-            moni2=max([moni2,1])
-            self.BerSANS.update({"%Sample,IEEE2"     : round(moni2,3)})
-        if 'entry1/SANS/monitor3/counts' in HDF.keys():
-            moni3 = HDF['entry1/SANS/monitor3/counts'][0]
-            moni3 = self.deadtimecorrection(moni3, time, 3.3e-6)
-            self.BerSANS.update({"%Sample,IEEE3"     : round(moni3,3)})
-        if 'entry1/SANS/monitor4/counts' in HDF.keys():
-            moni4 = HDF['entry1/SANS/monitor4/counts'][0]
-            self.BerSANS.update({"%Sample,IEEE4"     : (moni4)})
-        if 'entry1/SANS/monitor_5/counts' in HDF.keys():
-            moni5 = HDF['entry1/SANS/monitor_5/counts'][0]
-            self.BerSANS.update({"%Sample,IEEE5"     : (moni5)})
-        if 'entry1/SANS/monitor_7/counts' in HDF.keys():
-            moni7 = HDF['entry1/SANS/monitor_7/counts'][0]
-            self.BerSANS.update({"%Sample,IEEE7"     : (moni7)})
-        if 'entry1/SANS/monitor_8/counts' in HDF.keys():
-            moni8=HDF['entry1/SANS/monitor_8/counts'][0]
-            self.BerSANS.update({"%Sample,IEEE8"     : (moni8)})
-            
-        if 'entry1/SANS/Dornier-VS/rotation_speed' in HDF.keys():
-            self.BerSANS.update({"%Setup,LambdaC"    : round(HDF['entry1/SANS/Dornier-VS/rotation_speed'][0],3)})
-        if 'entry1/SANS/Dornier-VS/tilt_angle' in HDF.keys():
-            self.BerSANS.update({"%Setup,Tilting"    : round(HDF['entry1/SANS/Dornier-VS/tilt_angle'][0],3)})
-        if 'entry1/SANS/Dornier-VS/lambda' in HDF.keys():
-            self.BerSANS.update({"%Setup,Lambda"     : round(HDF['entry1/SANS/Dornier-VS/lambda'][0],4)})
-        if 'entry1/SANS/collimator/length' in HDF.keys():
-            self.BerSANS.update({"%Setup,Collimation": HDF['entry1/SANS/collimator/length'][0]})
-        if 'entry1/SANS/attenuator/selection' in HDF.keys():
-            self.BerSANS.update({"%Setup,Attenuator" : HDF['entry1/SANS/attenuator/selection'][0].decode(encoding='UTF-8')})
-        if 'entry1/SANS/beam_stop/out_flag' in HDF.keys():
-            self.BerSANS.update({"%Setup,Beamstop"   : HDF['entry1/SANS/beam_stop/out_flag'][0]})
-        if 'entry1/SANS/beam_stop/x_position' in HDF.keys():
-            self.BerSANS.update({"%Setup,BeamstopX"  : round(HDF['entry1/SANS/beam_stop/x_position'][0],2)})
-        if 'entry1/SANS/beam_stop/x_null' in HDF.keys():
-            self.BerSANS.update({"%Setup,BeamstopXNull"  : round(HDF['entry1/SANS/beam_stop/x_null'][0],2)})
-        if 'entry1/SANS/beam_stop/y_position' in HDF.keys():
-            self.BerSANS.update({"%Setup,BeamstopY"  : round(HDF['entry1/SANS/beam_stop/y_position'][0],2)})
-        if 'entry1/SANS/beam_stop/y_null' in HDF.keys():
-            self.BerSANS.update({"%Setup,BeamstopYNull"  : round(HDF['entry1/SANS/beam_stop/y_null'][0],2)})
-        if 'entry1/SANS/detector/x_position' in HDF.keys():
-            self.BerSANS.update({"%Setup,SD"         : round(HDF['entry1/SANS/detector/x_position'][0]/1000,2)})
-        if 'entry1/SANS/detector/x_null' in HDF.keys():
-            self.BerSANS.update({"%Setup,SDNull"     : round(HDF['entry1/SANS/detector/x_null'][0]/1000,2)})
-        if 'entry1/SANS/detector/y_position' in HDF.keys():
-            self.BerSANS.update({"%Setup,SY"         : round(HDF['entry1/SANS/detector/y_position'][0]/1000,2)})
-        if 'entry1/SANS/detector/y_null' in HDF.keys():
-            self.BerSANS.update({"%Setup,SYNull"     : round(HDF['entry1/SANS/detector/y_null'][0]/1000,2)})
-
-        if 'entry1/SANS/detector/counting_time' in HDF.keys():
-            time=max([0.001,float(HDF['entry1/SANS/detector/counting_time'][0])])
-        if 'entry1/SANS/integrated_beam/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,ProtonBeam":round(pbeam,2)})
-        if 'entry1/SANS/monitor1/counts' in HDF.keys():
-            moni1=max([moni1,1])
-            self.BerSANS.update({"%Counter,Moni1":int(moni1)})
-        if 'entry1/SANS/monitor2/counts' in HDF.keys():
-            moni2=max([moni2,1])
-            self.BerSANS.update({"%Counter,Moni2" : int(moni2)})
-        if 'entry1/SANS/monitor3/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,Moni3" : int(moni3)})
-        if 'entry1/SANS/monitor4/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,Moni4" : int(moni4)})
-        if 'entry1/SANS/monitor_5/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,Moni5" : int(moni5)})
-        if 'entry1/SANS/monitor_7/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,Moni7" : int(moni7)})
-        if 'entry1/SANS/monitor_8/counts' in HDF.keys():
-            self.BerSANS.update({"%Counter,Moni8" : int(moni8)})
-        if 'entry1/SANS/detector/counting_time' in HDF.keys():
-            self.BerSANS.update({"%Counter,Time" : round(time,3)})
-        self.BerSANS.update({"%Counter,Sum"         : np.sum(detector_counts)})
-        self.BerSANS.update({"%Counter,Sum/Time"    : round(np.sum(detector_counts)/time, int(round(max([4,4-np.log10(np.sum(detector_counts)/time )]),0)))})
-        self.BerSANS.update({"%Counter,Sum/Moni1"   : round(np.sum(detector_counts)/moni1,int(round(max([4,4-np.log10(np.sum(detector_counts)/moni1)]),0)))})
-        self.BerSANS.update({"%Counter,Sum/Moni2"   : round(np.sum(detector_counts)/moni2,int(round(max([4,4-np.log10(np.sum(detector_counts)/moni2)]),0)))}) 
+        if dset.ndim == 3:
+            self.BerSANS.update(self.getSANS1tof(HDF, dset.shape[2]))
+        values = self.readHDFmap(HDF, SANS1hdfmap)
         HDF.close()
-    
+        self.BerSANS.update(self.applyHDFmap(values, SANS1hdfmap))
+        if self.lazy:
+            # the sums would require reading the detector counts, they are
+            # added on request by addCounterSums()
+            self.hdfvalues = values
+            return
+        self.BerSANS.update(self.counterSums(S, values))
+
+    @staticmethod
+    def counterSums(S, values):
+        """
+        Returns the %Counter,Sum... entries of a SANS-1 run for the sum S of
+        its detector counts, time and monitors are taken from the values
+        of readHDFmap.
+        """
+        time = max([0.001, float(values[(_SANS1time, 0)])])
+        moni1 = _sans1_monitor(values[('entry1/SANS/monitor1/counts', 0)], values)
+        moni2 = _sans1_monitor(values[('entry1/SANS/monitor2/counts', 0)], values)
+        return {"%Counter,Sum"         : S,
+                "%Counter,Sum/Time"    : round(S/time, int(round(max([4,4-np.log10(S/time )]),0))),
+                "%Counter,Sum/Moni1"   : round(S/moni1,int(round(max([4,4-np.log10(S/moni1)]),0))),
+                "%Counter,Sum/Moni2"   : round(S/moni2,int(round(max([4,4-np.log10(S/moni2)]),0)))}
+
+    def addCounterSums(self):
+        """
+        Adds the %Counter,Sum... entries to a SANS-1 run read with lazy=True,
+        which reads the detector counts (TOF cubes block by block).
+        """
+        if self.hdfvalues is None:
+            raise RuntimeError(f'{self.infn} is not a SANS-1 run read with lazy=True')
+        S = self.BerSANS["%Counts,DetCounts"].sum()
+        if S == 0:
+            raise RuntimeError(f'{self.infn} seems to be empty. Sum({S})')
+        self.BerSANS.update(self.counterSums(S, self.hdfvalues))
+
+    @staticmethod
+    def getSANS1tof(HDF, ntof):
+        """
+        Returns the TOF entries of a SANS-1 run with ntof channels:
+        %File,DataSizeTOF and the ntof+1 bin edges %Counts,TOFEdges, taken
+        from entry1/SANS/detector/time_of_flight (edges or channel centers,
+        a single channel gets a bin of width 1) and given as channel
+        numbers if it is missing.
+        """
+        tof = HDF.get('entry1/SANS/detector/time_of_flight')
+        if tof is None:
+            edges = np.arange(ntof+1, dtype=np.float64)
+        else:
+            tof = np.asarray(tof, dtype=np.float64).ravel()
+            if tof.size == ntof+1:
+                edges = tof
+            elif tof.size == ntof and ntof > 1:
+                mid = 0.5*(tof[1:]+tof[:-1])
+                edges = np.concatenate(([2*tof[0]-mid[0]], mid, [2*tof[-1]-mid[-1]]))
+            elif tof.size == 1 and ntof == 1:
+                # a single channel has no width, take a bin of width 1 around it
+                edges = np.array([tof[0]-0.5, tof[0]+0.5])
+            else:
+                raise RuntimeError(f'time_of_flight has {tof.size} values for {ntof} TOF channels')
+        return {"%File,DataSizeTOF": ntof, "%Counts,TOFEdges": edges}
+
+    @staticmethod
+    def readHDFmap(HDF, hdfmap):
+        """
+        Reads every (path, element) of the mapping table hdfmap that exists in
+        the open HDF file exactly once. element is the index of the single
+        value read from the dataset or '@name' for the attribute name.
+        Returns a dict {(path, element): value}
+        """
+        values = {}
+        datasets = {}
+        for path, element, key, convert, digits in hdfmap:
+            if (path, element) in values:
+                continue
+            if path not in datasets:
+                datasets[path] = HDF.get(path)
+            dset = datasets[path]
+            if dset is None:
+                continue
+            if isinstance(element, str):
+                values[(path, element)] = dset.attrs[element[1:]]
+            else:
+                values[(path, element)] = dset[element]
+        return values
+
+    @staticmethod
+    def applyHDFmap(values, hdfmap):
+        """
+        Converts the values read by readHDFmap into BerSANS entries, in the
+        order of the mapping table. Entries whose path is missing are skipped.
+        """
+        BerSANS = {}
+        for path, element, key, convert, digits in hdfmap:
+            if (path, element) not in values:
+                continue
+            value = values[(path, element)]
+            if convert is not None:
+                value = convert(value, values)
+            if digits is not None:
+                value = round(value, digits)
+            BerSANS[key] = value
+        return BerSANS
+
     def getHDFinstr(self):
         HDF = h5py.File(self.infn)
         if 'entry1/definition' in HDF.keys():
@@ -499,12 +1036,13 @@ class SANSdata:
         else:
             self.fformat = 'UNKNOWN'
     
-    def __init__(self, inputfn):
+    def __init__(self, inputfn, lazy=False):
         if not isinstance(inputfn, str):
             raise TypeError('argument of SANSdata is not a str')
         if not os.path.isfile(inputfn):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), inputfn)
         self.infn = inputfn
+        self.lazy = lazy
         self.split_path(inputfn)
         self.analyse()
         
@@ -543,101 +1081,157 @@ class SANSdata:
         return np.zeros((DataSizeX,DataSizeX))
 
     def BerSANStrans(self,BerSANStransfile):
+        """
+        Reads the BerSANS transmission file, or takes the file for the
+        wavelength of this run from a TransmissionStore, into
+        self.transmission. Parsed files are cached in transmission_store.
+        """
+        if isinstance(BerSANStransfile, TransmissionStore):
+            self.transmission = BerSANStransfile.transmissions(self.BerSANS["%Setup,Lambda"])
+            return
         if not os.path.isfile(BerSANStransfile):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), BerSANStransfile)
-        self.transmssion = readBerSANStrans(BerSANStransfile)
+        self.transmission = transmission_store.table(BerSANStransfile)
         return
 
+    def decodeBerSANSblock(self, group, lines):
+        """
+        Converts the raw text lines of a %Counts, %Errors or %Mask section in
+        one go:
+            SANSDIso: comma separated Q, I, dI, dQ per line, returned as (n,4) array
+            SANSDRaw: comma separated counts
+            SANSDAni: fixed width fields of 10 characters, 8 per line
+            SANSMAni: one character per pixel, # for masked and - for unmasked pixels
+        Except for SANSDIso the values are filled row by row into an empty
+        detector array. If a section deviates from the regular layout, the
+        lines are converted one by one with the same rules.
+        """
+        FileType = self.BerSANS['%File,Type']
+        if group == '%Counts':
+            if FileType == 'SANSDIso':
+                f = [x.split(",") for x in lines]
+                try:
+                    return np.array([x[0:4] for x in f]).astype(np.float64)
+                except ValueError:
+                    return np.array([[float(x[0]), float(x[1]), float(x[2]), float(x[3])] for x in f])
+            elif FileType == 'SANSDRaw':
+                f = ",".join(lines).split(",")
+                try:
+                    values = np.array(f).astype(np.float64)
+                except ValueError:
+                    values = np.array([float(x) for x in f])
+            elif FileType == 'SANSDAni':
+                values = self.decodeBerSANSfixed(lines, 80)
+            else:
+                raise RuntimeError(f'Unknown File Format >{FileType}<')
+        elif group == '%Errors':
+            if FileType != 'SANSDAni':
+                raise RuntimeError(f'Only SANSDAni File Format can have Error matrix, but we have: {FileType}')
+            values = self.decodeBerSANSfixed(lines, 79)
+        elif group == '%Mask':
+            if FileType != 'SANSMAni':
+                raise RuntimeError('Only SANSMAni File Format can have mask matrix, but we have: '+FileType)
+            DataSizeX = int(self.BerSANS['%File,DataSizeX'])
+            if not all(len(x) >= DataSizeX for x in lines):
+                raise RuntimeError(f'Definition of Mask smaller than detector x-size: {self.BerSANS["%File,DataSizeX"]}')
+            symbols = np.array(["".join(x[:DataSizeX] for x in lines)]).view('U1')
+            values = symbols == '#'
+            if not np.all(values | (symbols == '-')):
+                wrong = symbols[~(values | (symbols == '-'))][0]
+                raise RuntimeError('symbol for defining status of mask needs to be # or - but found '+wrong)
+        else:
+            return None
+        DetArray = self.ObtainEmptyDetectorArray()
+        if values.size > DetArray.size:
+            raise IndexError(f'index {DetArray.size} is out of bounds for axis 0 with size {DetArray.size}')
+        DetArray.flat[:values.size] = values
+        return DetArray
+
+    def decodeBerSANSfixed(self, lines, linelen):
+        """
+        Converts lines with 8 fixed width fields of 10 characters each. Only
+        the first linelen characters of a line are taken into account.
+        """
+        if all(len(x) >= linelen for x in lines):
+            # pad each line to 80 characters, so that the text can be viewed as
+            # an array of 10 character wide fields
+            text = "".join(x[:linelen].ljust(80) for x in lines)
+            try:
+                return np.array([text]).view('U10').astype(np.float64)
+            except ValueError:
+                pass
+        return np.array([float(f) for x in lines for f in self.slices(x[0:linelen],10,10,10,10,10,10,10,10)])
+
     def readBerSANS(self):
         group='%Comment'
         self.BerSANS = {}
-        Qdata = np.empty(0)
-        Idata = np.empty(0)
-        Edata = np.empty(0)
-        Rdata = np.empty(0)
-        npix = 0
+        block = []
+        blocks = {}
+        Isodata = []
+        def decode():
+            if not block:
+                return
+            decoded = self.decodeBerSANSblock(group, block)
+            if group == '%Counts' and self.BerSANS['%File,Type'] == 'SANSDIso':
+                Isodata.append(decoded)
+            else:
+                blocks[group] = decoded
         with open(os.path.join(self.infn)) as file:
             for x in file:
                 if len(x.strip()) == 0:
                     continue
                 if x[0] == '%':
+                    decode()
                     group = x.strip()
-                    npix = 0
+                    block = []
+                    continue
+                if group in ('%Counts', '%Errors', '%Mask'):
+                    block.append(x)
                     continue
-                if group == '%Counts':
-                    if self.BerSANS['%File,Type'] == 'SANSDIso':
-                        f = x.split(",")
-                        Qdata=np.append(Qdata,float(f[0]))
-                        Idata=np.append(Idata,float(f[1]))
-                        Edata=np.append(Edata,float(f[2]))
-                        Rdata=np.append(Rdata,float(f[3]))
-                        continue
-                    elif self.BerSANS['%File,Type'] == 'SANSDRaw':
-                        if npix == 0:
-                            DetCounts = self.ObtainEmptyDetectorArray()
-                        f = x.split(",")
-                        for i in range(len(f)):
-                            np.put(DetCounts,npix+i,f[i])
-                        npix=npix+len(f)
-                        continue
-                    elif self.BerSANS['%File,Type'] == 'SANSDAni':
-                        if npix == 0:
-                            DetCounts = self.ObtainEmptyDetectorArray()
-                        f = list(self.slices(x,10,10,10,10,10,10,10,10))
-                        for i in range(len(f)):
-                            np.put(DetCounts,npix+i,float(f[i]))
-                        npix=npix+len(f)
-                        continue
-                    else:
-                        raise RuntimeError(f'Unknown File Format >{self.BerSANS["%File,Type"]}<')
-                if group=='%Errors':
-                    if self.BerSANS['%File,Type'] == 'SANSDAni':
-                        #if not len(x)>=80:
-                        #    print(x.strip())
-                        if npix == 0:
-                            DetErrors = self.ObtainEmptyDetectorArray()
-                        f = list(self.slices(x[0:79],10,10,10,10,10,10,10,10))
-                        for i in range(len(f)):
-                            np.put(DetErrors,npix+i,float(f[i]))
-                        npix=npix+len(f)
-                        continue
-                    else:
-                        raise RuntimeError(f'Only SANSDAni File Format can have Error matrix, but we have: {self.BerSANS["%File,Type"]}')
-                if group=='%Mask':
-                    if self.BerSANS['%File,Type'] == 'SANSMAni':
-                        if not len(x)>=int(self.BerSANS['%File,DataSizeX']):
-                            #print(x.strip())
-                            raise RuntimeError(f'Definition of Mask smaller than detector x-size: {self.BerSANS["%File,DataSizeX"]}')
-                        if npix == 0:
-                            DetMask = self.ObtainEmptyDetectorArray()
-                        for i in range(int(self.BerSANS['%File,DataSizeX'])):
-                            if x[i]=='#':
-                                np.put(DetMask,npix+i,True)
-                            elif x[i]=='-':
-                                np.put(DetMask,npix+i,False)
-                            else:
-                                raise RuntimeError('symbol for defining status of mask needs to be # or - but found '+x[i])
-                        npix = npix + int(self.BerSANS['%File,DataSizeX'])
-                        continue
-                    else:
-                        raise RuntimeError('Only SANSMAni File Format can have mask matrix, but we have: '+self.BerSANS['%File,Type'])   
                 f = x.split("=")
                 if len(f) > 1:
                     self.BerSANS.update({group+','+f[0]:f[1].strip()})
-                    
+            decode()
+
         if self.BerSANS['%File,Type'] == 'SANSDRaw':
-            DetCounts=np.flipud(DetCounts) 
+            DetCounts=np.flipud(blocks['%Counts'])
             self.BerSANS.update({"%Counts,DetCounts":DetCounts})
         elif self.BerSANS['%File,Type'] == 'SANSDIso':
-            self.BerSANS[f"%Counts,Qdata"] = Qdata
-            self.BerSANS[f"%Counts,Idata"] = Idata
-            self.BerSANS[f"%Counts,Edata"] = Edata
-            self.BerSANS[f"%Counts,Rdata"] = Rdata
+            Isodata = np.concatenate(Isodata) if Isodata else np.empty((0, 4))
+            self.BerSANS[f"%Counts,Qdata"] = Isodata[:, 0].copy()
+            self.BerSANS[f"%Counts,Idata"] = Isodata[:, 1].copy()
+            self.BerSANS[f"%Counts,Edata"] = Isodata[:, 2].copy()
+            self.BerSANS[f"%Counts,Rdata"] = Isodata[:, 3].copy()
         elif self.BerSANS['%File,Type'] == 'SANSDAni':
-            DetCounts=np.flipud(DetCounts)
-            DetErrors=np.flipud(DetErrors)
+            DetCounts=np.flipud(blocks['%Counts'])
+            DetErrors=np.flipud(blocks['%Errors'])
             self.BerSANS.update({"%Counts,DetCounts":DetCounts})
             self.BerSANS.update({"%Errors,DetErrors":DetErrors})
         elif self.BerSANS['%File,Type'] == 'SANSMAni':
-            self.BerSANS.update({"%Mask,DetMask":DetMask})
-            #self.BerSANS.update({"%Mask,DetMask":np.flipud(DetMask)})
\ No newline at end of file
+            self.BerSANS.update({"%Mask,DetMask":blocks['%Mask']})
+            #self.BerSANS.update({"%Mask,DetMask":np.flipud(DetMask)})
+
+if __name__ == '__main__':
+    # Timing comparison of sasfit_guess_err against the former per-point loop
+    import timeit
+
+    def guess_err_loop(sw, po, x, y):
+        err = np.zeros(len(x))
+        for i in range(sw, len(x) - sw):
+            X = np.vander(x[i - sw:i + sw + 1], N=po + 1, increasing=True)
+            coeffs = np.linalg.lstsq(X, y[i - sw:i + sw + 1], rcond=None)[0]
+            err[i] = np.sqrt(np.sum((y[i - sw:i + sw + 1] - X @ coeffs) ** 2) / (2 * sw - po))
+        return err
+
+    rng = np.random.default_rng(12345)
+    print(f'{"npoints":>8} {"spacing":>8} {"loop [s]":>10} {"batched [s]":>12}')
+    for npoints in [1000, 10000, 100000, 1000000]:
+        for spacing, x in [('linear', np.linspace(0.01, 5, npoints)),
+                           ('log', np.logspace(-2, 0.7, npoints))]:
+            y = 1.0/(1.0 + (3*x)**4) + rng.normal(scale=1e-3, size=npoints)
+            t_batched = timeit.timeit(lambda: sasfit_guess_err(3, 2, x, y), number=1)
+            if npoints <= 100000:
+                t_loop = f'{timeit.timeit(lambda: guess_err_loop(3, 2, x, y), number=1):10.3f}'
+            else:
+                t_loop = f'{"skipped":>10}'
+            print(f'{npoints:8d} {spacing:>8} {t_loop} {t_batched:12.4f}')
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    catalog.py is part of pySASfit package
+"""
+__author__ = "Joachim Kohlbrecher"
+__copyright__ = "Copyright 2024, The SASfit Project"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Joachim Kohlbrecher"
+__email__ = "joachim.kohlbrecher@psi.ch"
+__status__ = "Production"
+
+from SASformats import SANSdata, HDFLazyArray
+import os
+import glob
+import sqlite3
+
+class SANScatalog:
+    __doc__ = """
+    SANScatalog(dbfile) is an on-disk SQLite catalog of the %File, %Setup,
+    %Sample and %Counter entries which SANSdata extracts from raw data and
+    BerSANS files. update() only reopens files whose modification time or
+    size has changed since they were indexed, query() answers questions like
+    "all runs at 18 m with Lambda=6 for sample X" without touching the files:
+
+        cat = SANScatalog('runs.sqlite')
+        cat.update('/data/2024', 'sans2024n*.hdf')
+        runs = cat.query({'%Setup,SD': 18, '%Setup,Lambda': (6, 0.05),
+                          '%Sample,SampleName': 'X'})
+    """
+    sections = ('%File', '%Setup', '%Sample', '%Counter')
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime REAL, size INTEGER, fformat TEXT, error TEXT);
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT, key TEXT, value TEXT, num REAL);
+            CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+            CREATE INDEX IF NOT EXISTS entries_num ON entries (key, num);
+            CREATE INDEX IF NOT EXISTS entries_value ON entries (key, value);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def extract(self, Data):
+        """
+        Returns the (key, value, numerical value) rows of the catalogued
+        sections of the SANSdata object Data.
+        """
+        rows = []
+        for key, val in Data.BerSANS.items():
+            if key.split(",")[0] not in self.sections:
+                continue
+            try:
+                num = float(val)
+            except (TypeError, ValueError):
+                num = None
+            rows.append((key, f'{val}', num))
+        return rows
+
+    def update(self, Data_path, pattern='*', prune=True, index_sums=True):
+        """
+        Indexes all files in Data_path matching the glob pattern which are
+        new or whose mtime or size has changed. Files which can't be read by
+        SANSdata are recorded with their error and retried once they change.
+        The files are read with lazy=True. For raw hdf runs with a single
+        detector frame the %Counter,Sum... entries are calculated from the
+        counts unless index_sums is False, TOF runs are indexed without them.
+        With prune=True files of Data_path which no longer exist are removed
+        from the catalog.
+        Returns the number of (re)indexed files.
+        """
+        known = {path: (mtime, size) for path, mtime, size in
+                 self.db.execute("SELECT path, mtime, size FROM files")}
+        found = set()
+        nindexed = 0
+        with self.db:
+            for path in sorted(glob.glob(os.path.join(Data_path, pattern))):
+                path = os.path.abspath(path)
+                st = os.stat(path)
+                found.add(path)
+                if known.get(path) == (st.st_mtime, st.st_size):
+                    continue
+                fformat, error, rows = 'UNKNOWN', None, []
+                try:
+                    Data = SANSdata(path, lazy=True)
+                    counts = Data.BerSANS.get('%Counts,DetCounts')
+                    if index_sums and isinstance(counts, HDFLazyArray) and counts.ndim == 2:
+                        Data.addCounterSums()
+                    fformat = Data.fformat
+                    rows = self.extract(Data)
+                except Exception as exc:
+                    error = f'{type(exc).__name__}: {exc}'
+                self.db.execute("DELETE FROM entries WHERE path = ?", (path,))
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                (path, st.st_mtime, st.st_size, fformat, error))
+                self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                                    [(path, key, val, num) for key, val, num in rows])
+                nindexed += 1
+            if prune:
+                root = os.path.join(os.path.abspath(Data_path), '')
+                gone = [(path,) for path in known
+                        if path.startswith(root) and path not in found and not os.path.isfile(path)]
+                self.db.executemany("DELETE FROM entries WHERE path = ?", gone)
+                self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+        return nindexed
+
+    def query(self, conditions=None, rtol=1e-6):
+        """
+        Returns the paths of all catalogued files fulfilling all conditions,
+        a dict {BerSANS key: value}. A number matches within the relative
+        tolerance rtol, a tuple (number, rtol) with its own tolerance, a
+        string matches exactly or as glob pattern if it contains * or ?.
+        """
+        sql = "SELECT path FROM files WHERE error IS NULL"
+        params = []
+        for key, val in (conditions or {}).items():
+            if isinstance(val, tuple):
+                val, tol = val
+            else:
+                tol = rtol
+            if isinstance(val, str):
+                op = "GLOB" if any(c in val for c in "*?[") else "="
+                sql += f" AND path IN (SELECT path FROM entries WHERE key = ? AND value {op} ?)"
+                params += [key, val]
+            else:
+                delta = abs(float(val))*tol
+                sql += " AND path IN (SELECT path FROM entries WHERE key = ? AND num BETWEEN ? AND ?)"
+                params += [key, float(val)-delta, float(val)+delta]
+        return [path for (path,) in self.db.execute(sql + " ORDER BY path", params)]
+
+    def entries(self, path, keys=None):
+        """
+        Returns the catalogued entries {key: value} of path, optionally only
+        those in keys. The values are the strings stored in the catalog, e.g.
+        a sample name "007" stays "007", numbers need to be converted by the
+        caller.
+        """
+        result = {}
+        for key, val in self.db.execute("SELECT key, value FROM entries WHERE path = ?",
+                                        (os.path.abspath(path),)):
+            if keys is None or key in keys:
+                result[key] = val
+        return result
+
+    def failed(self):
+        """
+        Returns {path: error} of the files SANSdata could not read.
+        """
+        return dict(self.db.execute("SELECT path, error FROM files WHERE error IS NOT NULL"))
@@ -2,33 +2,226 @@
 Helper utilities for fitting stacks of TOF sums.
 
 Provides `fit_stack` which fits a triangular peak model to a stack of
-SUMtof arrays. The function is written to be importable from notebooks
+SUMtof arrays, and the batched `fit_spectra` behind it. The function is written to be importable from notebooks
 and scripts and avoids use of `globals()` by accepting `tof` explicitly.
+matplotlib is only imported when plotting, `python fit_helpers.py` runs a
+benchmark of the import time and of the fits.
 """
 import numpy as np
+import os
+import concurrent.futures
+import warnings
+import h5py
 from scipy import constants as _scipy_constants
-import matplotlib.pyplot as plt
-from pySASfit.io_tools.SASformats import SANSdata
-
-def read_files_sumtof(file_tofs):
-    sum_tofs=[]
-    for fn in file_tofs:
-        #print(fn)
-        SASD=SANSdata(fn)
-        try:
-#            print(SASD.BerSANS["%File,DataSizeTOF"], SASD.BerSANS["%Setup,LambdaC"],SASD.BerSANS["%Setup,Collimation"])
-            DetData = SASD.BerSANS["%Counts,DetCounts"]
-            sum_tofsi=[]
-            for i in range(SASD.BerSANS["%File,DataSizeTOF"]):
-                #print(np.sum(DetData[:,:,i]))
-                sum_tofsi.append(np.sum(DetData[:,:,i]))
-            sum_tofs.append(sum_tofsi)
-        except Exception:
-            pass
-    return sum_tofs
+from pySASfit.io_tools.SASformats import HDFLazyArray, SANSdata, WavelengthCalibration
+
+def sum_tof(filename, path='entry1/SANS/detector/counts', blocksize=2**25):
+    """Sum the detector counts of a TOF hdf file over the detector pixels.
+
+    Only the counts dataset `path`, shaped (nx, ny, ntof), is read. Contiguous
+    datasets are memory mapped, chunked ones are read in slabs of whole
+    chunks along the first axis of about `blocksize` bytes, so that large TOF
+    cubes never have to be held in memory.
+
+    Returns a float64 array of length ntof.
+    """
+    with h5py.File(filename, 'r') as HDF:
+        dset = HDF[path]
+        if dset.ndim != 3:
+            raise RuntimeError(f'{filename} has no TOF data, its detector counts have the shape {dset.shape}')
+        acc = np.int64 if dset.dtype.kind in 'iub' else np.float64
+        mm = HDFLazyArray(filename, path, dset).memmap()
+        if mm is not None:
+            return mm.sum(axis=(0, 1), dtype=acc).astype(np.float64)
+        rows = dset.chunks[0] if dset.chunks is not None else 1
+        rowbytes = dset.dtype.itemsize*dset.shape[1]*dset.shape[2]
+        rows *= max(1, blocksize//(rowbytes*rows))
+        total = np.zeros(dset.shape[2], dtype=acc)
+        for i in range(0, dset.shape[0], rows):
+            total += dset[i:i+rows].sum(axis=(0, 1), dtype=acc)
+    return total.astype(np.float64)
+
+def _sum_tof_one(filename, path):
+    try:
+        return sum_tof(filename, path), 'summed', ''
+    except Exception as exc:
+        return None, 'failed', f'{type(exc).__name__}: {exc}'
+
+def _sum_tof_results(filenames, path, processes):
+    if processes == 1:
+        return [_sum_tof_one(fn, path) for fn in filenames]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_sum_tof_one, filenames, [path]*len(filenames)))
+
+def sum_tof_files(filenames, path='entry1/SANS/detector/counts', processes=None):
+    """TOF sums of a list of hdf files, see `sum_tof`.
+
+    The files are processed in a pool of `processes` worker processes
+    (default: number of cores), processes=1 sums them one after the other.
+
+    Returns
+    - sums: (n_files x n_tof) float64 array, rows of failed files are NaN;
+            shorter TOF spectra are padded with NaN
+    - status: list of (filename, status, message) with status 'summed' or 'failed'
+    """
+    results = _sum_tof_results(filenames, path, processes)
+    ntof = max([len(res[0]) for res in results if res[0] is not None], default=0)
+    sums = np.full((len(results), ntof), np.nan)
+    for row, (sumtof, _, _) in zip(sums, results):
+        if sumtof is not None:
+            row[:len(sumtof)] = sumtof
+    status = [(fn, st, msg) for fn, (_, st, msg) in zip(filenames, results)]
+    return sums, status
+
+def read_files_sumtof(file_tofs, processes=None):
+    """TOF sums of the files, one array per file with its own number of TOF
+    channels, in the order of file_tofs.
+
+    Kept for existing notebooks. A RuntimeError listing the files which
+    could not be summed is raised, so that the result always lines up with
+    the file labels; use `sum_tof_files` to get the status of every file.
+    """
+    results = _sum_tof_results(file_tofs, 'entry1/SANS/detector/counts', processes)
+    failed = [f"{fn}: {msg}" for fn, (_, st, msg) in zip(file_tofs, results) if st == 'failed']
+    if failed:
+        raise RuntimeError("can't sum the TOF channels of\n" + "\n".join(failed))
+    return [sumtof for sumtof, _, _ in results]
         
+fit_fields = [('center', np.float64), ('center_err', np.float64),
+              ('width', np.float64), ('width_err', np.float64),
+              ('amplitude', np.float64), ('amplitude_err', np.float64),
+              ('baseline', np.float64), ('baseline_err', np.float64),
+              ('rpm', np.float64), ('lambda', np.float64), ('lambda_err', np.float64),
+              ('DL/L', np.float64), ('DL/L_err', np.float64), ('SD', np.float64),
+              ('success', np.bool_)]
+
+def _spectrum_axis(y, tof):
+    if tof is not None and len(tof) == y.size:
+        return np.asarray(tof, dtype=float)
+    return np.arange(y.size, dtype=float)
+
+def _fit_spectra_chunk(tasks):
+    """Fit (x, y, p0) tasks, y normalized to its maximum and free of NaNs.
+    Returns (popt, perr, message) per task, NaNs for failed fits."""
+    from scipy.optimize import curve_fit
+    from pySASfit.io_tools.fit_triangle import triangle_model, triangle_jac, triangle_bounds
+    out = []
+    for x, y, p0 in tasks:
+        try:
+            lower, upper = triangle_bounds(x)
+            p0 = np.clip(p0, lower, upper)
+            popt, pcov = curve_fit(triangle_model, x, y, p0=p0, bounds=(lower, upper), jac=triangle_jac)
+            out.append((popt, np.sqrt(np.diag(pcov)), ''))
+        except Exception as exc:
+            out.append((np.full(4, np.nan), np.full(4, np.nan), f'triangle fit failed: {exc}'))
+    return out
+
+def fit_spectra(sum_tofs, labels, tof=None, L=None, rpm_start=12000, rpm_step=2000,
+                other_centers=None, constants_module=None, processes=None, chunksize=16):
+    """Batched triangle fits of a stack of SUMtof arrays, without plotting.
+
+    The spectra are normalized to their maximum like in `fit_triangle`.
+    Initial guesses of all spectra of equal length are computed in one
+    vectorized `triangle_guess` call, the fits use the analytic Jacobian
+    `triangle_jac` and run in chunks of `chunksize` spectra in a pool of
+    `processes` worker processes (default: number of cores, processes=1 fits
+    in the calling process).
+
+    Parameters as for `fit_stack`.
+
+    Returns a structured array with the fields 'name' and `fit_fields`, one
+    row per spectrum; failed or all-NaN spectra have success=False and NaN
+    values. `pandas.DataFrame(result)` turns it into a table.
+    """
+    from pySASfit.io_tools.fit_triangle import triangle_guess
+
+    consts = constants_module if constants_module is not None else _scipy_constants
+    spectra = [np.asarray(y_raw, dtype=float) for y_raw in sum_tofs]
+    labels = [str(name) for name in labels][:len(spectra)]
+    result = np.zeros(len(labels), dtype=[('name', f'U{max([1]+[len(n) for n in labels])}')] + fit_fields)
+    result['name'] = labels
+    result['rpm'] = rpm_start + np.arange(len(labels)) * rpm_step
+
+    tasks = []
+    rows = []
+    clean = [idx for idx, y in enumerate(spectra[:len(labels)])
+             if y.size > 0 and np.all(np.isfinite(y)) and np.max(y) != 0]
+    for size in set(spectra[idx].size for idx in clean):
+        same = [idx for idx in clean if spectra[idx].size == size]
+        x = _spectrum_axis(spectra[same[0]], tof)
+        Y = np.array([spectra[idx] / np.max(spectra[idx]) for idx in same])
+        for idx, y, p0 in zip(same, Y, triangle_guess(x, Y)):
+            tasks.append((x, y, p0))
+            rows.append(idx)
+    for idx, y in enumerate(spectra[:len(labels)]):
+        if idx in clean:
+            continue
+        valid = ~np.isnan(y)
+        if not np.any(valid):
+            continue
+        x = _spectrum_axis(y, tof)[valid]
+        y = y[valid] / np.max(y[valid])
+        tasks.append((x, y, triangle_guess(x, y)))
+        rows.append(idx)
+
+    chunks = [tasks[i:i+chunksize] for i in range(0, len(tasks), chunksize)]
+    if processes == 1 or len(chunks) <= 1:
+        fits = [fit for chunk in chunks for fit in _fit_spectra_chunk(chunk)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            fits = [fit for fitted in executor.map(_fit_spectra_chunk, chunks) for fit in fitted]
+
+    params = ('center', 'width', 'amplitude', 'baseline')
+    for name in params + ('lambda', 'DL/L', 'SD'):
+        result[name] = np.nan
+        result[name+'_err' if name != 'SD' else name] = np.nan
+    for idx, (popt, perr, message) in zip(rows, fits):
+        if message:
+            print(f"{labels[idx]}: {message}")
+        for name, val, err in zip(params, popt, perr):
+            result[name][idx] = val
+            result[name+'_err'][idx] = err
+        result['success'][idx] = not message
+
+    # Compute lambda using either L or other_centers (backwards compatibility)
+    center = result['center']
+    K = consts.Planck / consts.neutron_mass / consts.nano
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if other_centers is not None and L is None:
+            n = min(len(other_centers), len(result))
+            result['lambda'][:n] = (np.asarray(other_centers[:n], dtype=float) - center[:n]) / 4000.0 * K
+            result['SD'][:n] = center[:n] / result['lambda'][:n] * K
+        elif L is not None:
+            result['lambda'] = center / L * K
+            result['SD'] = L
+        result['lambda_err'] = result['lambda'] * result['center_err'] / center
+        result['DL/L'] = np.where(center != 0, result['width'] / center / 2.0, np.nan)
+        result['DL/L_err'] = np.where(center != 0, result['width_err'] / center / 2.0, np.nan)
+    return result
+
+def plot_fits(result, sum_tofs, tof=None, ax=None):
+    """Plot the normalized spectra and the triangle models of `fit_spectra`
+    into ax (a new figure if None). Returns ax."""
+    import matplotlib.pyplot as plt
+    from pySASfit.io_tools.fit_triangle import triangle_model
+    if ax is None:
+        fig, ax = plt.subplots(1, 1, figsize=(8, 4))
+    for row, y_raw in zip(result, sum_tofs):
+        y = np.asarray(y_raw, dtype=float)
+        x = _spectrum_axis(y, tof)
+        ax.plot(x, y / np.nanmax(y), marker='.', linestyle='none', alpha=0.6)
+        if row['success']:
+            xf = np.linspace(x.min(), x.max(), max(400, x.size*4))
+            popt = [row[name] for name in ('center', 'width', 'amplitude', 'baseline')]
+            ax.plot(xf, triangle_model(xf, *popt), label=row['name'])
+    ax.set_xlabel('tof [ms]')
+    ax.set_ylabel('Intensity (normalized)')
+    ax.legend()
+    plt.tight_layout()
+    return ax
+
 def fit_stack(sum_tofs, labels, tof=None, L=None, rpm_start=12000, rpm_step=2000,
-              plot=False, other_centers=None, constants_module=None):
+              plot=False, other_centers=None, constants_module=None, processes=1):
     """Fit a stack of SUMtof arrays using the triangular model.
 
     Parameters
@@ -38,89 +231,176 @@ def fit_stack(sum_tofs, labels, tof=None, L=None, rpm_start=12000, rpm_step=2000
     - L: optional flight path length used to compute lambda; if None, lambda may be
          calculated from `other_centers` if provided
     - rpm_start, rpm_step: used to fill `rpm` field in results
-    - plot: if True, calls the underlying `fit_triangle` with plot=True
+    - plot: if True, the spectra and fits are plotted with `plot_fits`
     - other_centers: optional list of center values used to compute lambda for
                      paired datasets (preserves previous notebook behavior)
     - constants_module: optional module providing `Planck` and `neutron_mass` etc.
+    - processes: number of worker processes of `fit_spectra`
 
-    Returns list of dicts with fit results (same schema as before).
+    Returns list of dicts with fit results (same schema as before), use
+    `fit_spectra` for a structured array.
     """
-    try:
-        # Local import to avoid heavy imports at module import time
-        from pySASfit.io_tools.fit_triangle import fit_triangle, triangle_model
-    except Exception:
-        raise ImportError("fit_triangle is required by fit_helpers.fit_stack")
-
-    consts = constants_module if constants_module is not None else _scipy_constants
-
-    results = []
+    sum_tofs = list(sum_tofs)
+    result = fit_spectra(sum_tofs, labels, tof=tof, L=L, rpm_start=rpm_start, rpm_step=rpm_step,
+                         other_centers=other_centers, constants_module=constants_module,
+                         processes=processes)
     if plot:
-        fig, ax = plt.subplots(1, 1, figsize=(8, 4))
-    for idx, (y_raw, name) in enumerate(zip(sum_tofs, labels)):
-        y = np.asarray(y_raw, dtype=float)
-
-        # Determine x-axis
-        if tof is not None and len(tof) == y.size:
-            x = np.asarray(tof, dtype=float)
-        else:
-            x = np.arange(y.size, dtype=float)
+        plot_fits(result, sum_tofs, tof=tof)
 
-        # Pre-clean NaNs
-        nan_mask = np.isnan(y)
-        if np.all(nan_mask):
+    results = []
+    for row, y_raw in zip(result, sum_tofs):
+        name = str(row['name'])
+        if np.all(np.isnan(np.asarray(y_raw, dtype=float))):
             print(f"{name}: all NaN, skipping")
             continue
-        if np.any(nan_mask):
-            x_fit = x[~nan_mask]; y_fit = y[~nan_mask]
-        else:
-            x_fit = x; y_fit = y
-
-        try:
-            popt, pcov = fit_triangle(x_fit, y_fit, plot=plot,ax=ax)
-            perr = np.sqrt(np.diag(pcov)) if pcov is not None else [np.nan]*4
-            center, width, amplitude, baseline = popt
-            center_err, width_err, amp_err, base_err = perr
-
-            # Dense model evaluation (returned only if needed later)
-            xf = np.linspace(x.min(), x.max(), max(400, x.size*4))
-            yf = triangle_model(xf, *popt)
-
-            # Compute lambda using either L or other_centers (backwards compatibility)
-            if other_centers is not None and idx < len(other_centers) and L is None:
-                lamb = (other_centers[idx] - center) / 4000.0 * consts.Planck / consts.neutron_mass / consts.nano
-                SD=center / lamb * consts.Planck / consts.neutron_mass / consts.nano
-            elif L is not None:
-                lamb = center / L * consts.Planck / consts.neutron_mass / consts.nano
-                SD=L
-            else:
-                lamb = None
-
+        if row['success']:
             results.append({
                 "name": name,
-                "center": center, #"center_err": center_err,
-                "width": width, #"width_err": width_err,
-                #"amplitude": amplitude, "amplitude_err": amp_err,
-                #"baseline": baseline, "baseline_err": base_err,
-                "rpm": (rpm_start + idx * rpm_step),
-                "lambda": lamb, "lambda_err":lamb*center_err/center,
-                "DL/L": width / center / 2.0 if center != 0 else np.nan,
-                "DL/L_err": width_err / center / 2.0 if center != 0 else np.nan,
-                "SD":SD,
+                "center": row['center'],
+                "width": row['width'],
+                "rpm": int(row['rpm']),
+                "lambda": row['lambda'], "lambda_err": row['lambda_err'],
+                "DL/L": row['DL/L'],
+                "DL/L_err": row['DL/L_err'],
+                "SD": row['SD'],
             })
-            if plot:
-                ax.plot(xf, yf, label=name)
-
-        except Exception as exc:
-            print(f"{name}: fit failed: {exc}")
+        else:
             results.append({
                 "name": name,
                 "center": np.nan, "center_err": np.nan,
                 "width": np.nan, "width_err": np.nan,
                 "amplitude": np.nan, "amplitude_err": np.nan,
                 "baseline": np.nan, "baseline_err": np.nan,
-                "rpm": (rpm_start + idx * rpm_step),
+                "rpm": int(row['rpm']),
                 "lambda": None,
                 "DL/L": np.nan,
             })
 
     return results
+
+def calibrate_wavelength(filenames, tof=None, offset=0.0, rpm_resolution=10.0, processes=None,
+                         calibration_file=None, constants_module=None):
+    """Wavelength calibration of the velocity selector from TOF chopper scans.
+
+    The rotation speed %Setup,LambdaC and %Setup,Collimation of every run
+    are read with SANSdata, the flight path of a run is
+    L = 1000*Collimation + offset in mm. The TOF spectra of all runs are
+    summed with `sum_tof_files` and fitted in one batch with `fit_spectra`.
+    Runs whose rotation speeds agree within rpm_resolution are combined: for
+    several flight paths the wavelength follows from the weighted slope of
+    the triangle centers versus L, lambda = h/m dt/dL, which is independent
+    of the time offset of the chopper, for a single flight path from
+    center/L, which includes this offset; such rows have npaths=1 in the
+    calibration table and a warning is issued. DL/L is the weighted mean
+    of the runs. Finally lambda is regressed jointly against 1/rpm with
+    `WavelengthCalibration.fit` and the calibration is saved to
+    calibration_file if given. The field 'SD' of the runs is left as
+    `fit_spectra` sets it.
+
+    Returns
+    - calibration: WavelengthCalibration
+    - runs: structured array of the fit results (see `fit_spectra`) with
+            the additional fields 'collimation' and 'L'
+    - status: list of (filename, status, message) with status 'fitted' or 'failed'
+    """
+    consts = constants_module if constants_module is not None else _scipy_constants
+    K = consts.Planck / consts.neutron_mass / consts.nano
+    status = {}
+    setup = {}
+    for fn in filenames:
+        try:
+            BerSANS = SANSdata(fn, lazy=True).BerSANS
+            setup[fn] = (float(BerSANS["%Setup,LambdaC"]), float(BerSANS["%Setup,Collimation"]))
+        except Exception as exc:
+            status[fn] = (fn, 'failed', f'{type(exc).__name__}: {exc}')
+    readable = [fn for fn in filenames if fn in setup]
+    sums, summed = sum_tof_files(readable, processes=processes)
+    for fn, st, msg in summed:
+        if st == 'failed':
+            status[fn] = (fn, st, msg)
+    todo = [i for i, (fn, st, msg) in enumerate(summed) if st == 'summed']
+    names = [os.path.basename(readable[i]) for i in todo]
+    result = fit_spectra(sums[todo], names, tof=tof, processes=processes)
+
+    runs = np.zeros(len(result), dtype=result.dtype.descr + [('collimation', np.float64), ('L', np.float64)])
+    for name in result.dtype.names:
+        runs[name] = result[name]
+    runs['rpm'] = [setup[readable[i]][0] for i in todo]
+    runs['collimation'] = [setup[readable[i]][1] for i in todo]
+    runs['L'] = 1000.0 * runs['collimation'] + offset
+    with np.errstate(divide='ignore', invalid='ignore'):
+        runs['lambda'] = runs['center'] / runs['L'] * K
+        runs['lambda_err'] = runs['center_err'] / runs['L'] * K
+    for i, row in zip(todo, runs):
+        fn = readable[i]
+        status[fn] = (fn, 'fitted', '') if row['success'] else (fn, 'failed', 'triangle fit failed')
+
+    ok = runs[runs['success'] & (runs['center_err'] > 0) & (runs['DL/L_err'] > 0)]
+    groups = np.round(ok['rpm'] / rpm_resolution)
+    table = np.zeros(len(np.unique(groups)), dtype=WavelengthCalibration.calibration_fields)
+    for row, group in zip(table, np.unique(groups)):
+        runs_rpm = ok[groups == group]
+        row['rpm'] = np.mean(runs_rpm['rpm'])
+        row['nruns'] = len(runs_rpm)
+        row['npaths'] = len(np.unique(runs_rpm['L']))
+        if row['npaths'] > 1:
+            coefficients, covariance, chi2 = WavelengthCalibration.line_fit(
+                runs_rpm['L'], runs_rpm['center'], runs_rpm['center_err'])
+            row['lambda'] = coefficients[1] * K
+            row['lambda_err'] = np.sqrt(covariance[1, 1]) * K
+        else:
+            w = 1.0 / runs_rpm['lambda_err']**2
+            row['lambda'] = np.sum(w * runs_rpm['lambda']) / np.sum(w)
+            row['lambda_err'] = 1.0 / np.sqrt(np.sum(w))
+        w = 1.0 / runs_rpm['DL/L_err']**2
+        row['DL/L'] = np.sum(w * runs_rpm['DL/L']) / np.sum(w)
+        row['DL/L_err'] = 1.0 / np.sqrt(np.sum(w))
+
+    single = table['rpm'][table['npaths'] == 1]
+    if len(single):
+        warnings.warn(f"the wavelengths at {', '.join(f'{rpm:g}' for rpm in single)} rpm are measured at a "
+                      "single flight path, they include the time offset of the chopper")
+    calibration = WavelengthCalibration.fit(table)
+    if calibration_file is not None:
+        calibration.save(calibration_file)
+    return calibration, runs, [status[fn] for fn in filenames]
+
+def benchmark(repeat=5, nspectra=200):
+    """
+    Compares the time to start python and import this module with the time
+    needed when matplotlib.pyplot is imported as well, as it was done before
+    it was loaded on demand, and the time per fit of `fit_triangle` with
+    plot=False and of `fit_spectra`.
+    """
+    import subprocess
+    import sys
+    import time
+    from pySASfit.io_tools.fit_triangle import fit_triangle, triangle_model
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    module = "pySASfit.io_tools.fit_helpers"
+    for label, statement in [("python", "pass"), ("import fit_helpers", f"import {module}"),
+                             ("import fit_helpers + pyplot", f"import {module}, matplotlib.pyplot")]:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], check=True, env=env)
+            times.append(time.perf_counter()-start)
+        print(f"{label:28s} {min(times):8.3f} s")
+    check = f"import sys, {module}; print('matplotlib' in sys.modules)"
+    loaded = subprocess.run([sys.executable, "-c", check], check=True, env=env, capture_output=True, text=True)
+    print(f"{'matplotlib loaded':28s} {loaded.stdout.strip():>8s}")
+
+    rng = np.random.default_rng(12345)
+    x = np.linspace(0, 100, 201)
+    Y = np.array([triangle_model(x, c, w, 10.0, 2.0) + rng.normal(scale=0.8, size=x.shape)
+                  for c, w in zip(rng.uniform(30, 70, nspectra), rng.uniform(10, 30, nspectra))])
+    start = time.perf_counter()
+    for y in Y:
+        fit_triangle(x, y, plot=False)
+    print(f"{'fit_triangle per fit':28s} {(time.perf_counter()-start)/nspectra*1e3:8.3f} ms")
+    start = time.perf_counter()
+    fit_spectra(Y, [str(i) for i in range(nspectra)], tof=x, processes=1)
+    print(f"{'fit_spectra per fit':28s} {(time.perf_counter()-start)/nspectra*1e3:8.3f} ms")
+
+if __name__ == '__main__':
+    benchmark()
@@ -13,11 +13,10 @@ params, cov = fit_triangle(x, SUMtof12000)
 Or run the script directly to demo with synthetic data:
 python fit_triangle.py
 
-Dependencies: numpy, scipy, matplotlib
+Dependencies: numpy, scipy, matplotlib (imported only when plotting)
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
 
@@ -43,6 +42,68 @@ def triangle_model(x, center, width, amplitude, baseline):
     return baseline + amplitude * tri
 
 
+def triangle_jac(x, center, width, amplitude, baseline):
+    """Analytic Jacobian of `triangle_model` with respect to
+    (center, width, amplitude, baseline), shape (len(x), 4).
+
+    The model is piecewise linear; on the flanks
+    d/dcenter = 2*amplitude*sign(x-center)/width and
+    d/dwidth = 2*amplitude*|x-center|/width**2, outside the triangle only the
+    baseline derivative is nonzero.
+    """
+    x = np.asarray(x, dtype=float)
+    w = float(width)
+    jac = np.zeros((x.size, 4))
+    jac[:, 3] = 1.0
+    if w <= 0:
+        return jac
+    d = x - center
+    tri = 1.0 - 2.0 * np.abs(d) / w
+    inside = tri > 0
+    jac[inside, 0] = 2.0 * amplitude * np.sign(d[inside]) / w
+    jac[inside, 1] = 2.0 * amplitude * np.abs(d[inside]) / w**2
+    jac[inside, 2] = tri[inside]
+    return jac
+
+
+def triangle_guess(x, y):
+    """Initial guess (center, width, amplitude, baseline) for a spectrum y(x)
+    or, row by row, for a stack of spectra y of shape (n, len(x)) sharing x.
+
+    center is the position of the maximum, baseline the 5th percentile,
+    width 1.5 times the range where y exceeds half of the peak above the
+    baseline, but at least 4 sample spacings.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    Y = np.atleast_2d(y)
+    # center ~ location of maximum
+    center0 = x[np.argmax(Y, axis=1)]
+    peak = np.max(Y, axis=1)
+    baseline0 = np.percentile(Y, 5, axis=1)
+    amp0 = peak - baseline0
+    # approximate width: range of x where y > baseline + amp0/2
+    half_mask = Y > (baseline0 + amp0 / 2.0)[:, np.newaxis]
+    xs_min = np.where(half_mask, x, np.inf).min(axis=1)
+    xs_max = np.where(half_mask, x, -np.inf).max(axis=1)
+    width0 = np.where(half_mask.sum(axis=1) > 1, (xs_max - xs_min) * 1.5,
+                      max(1.0, (x.max() - x.min()) / 10.0))
+    # a triangle covering a single sample has no slope the fit could follow
+    if x.size > 1:
+        width0 = np.maximum(width0, 4.0 * np.median(np.abs(np.diff(x))))
+    amp0 = np.where(amp0 > 0, amp0, Y.max(axis=1) - Y.min(axis=1))
+    p0 = np.column_stack((center0, width0, amp0, baseline0))
+    return p0[0] if y.ndim == 1 else p0
+
+
+def triangle_bounds(x):
+    """Default curve_fit bounds of the triangle parameters for the axis x."""
+    x = np.asarray(x, dtype=float)
+    lower = [x.min(), 1e-8, -np.inf, -np.inf]
+    upper = [x.max(), x.max() - x.min() + 1e-8, np.inf, np.inf]
+    return (lower, upper)
+
+
 def fit_triangle(x, y, p0=None, bounds=None, plot=True, ax=None):
     """Fit a triangular model to y(x).
 
@@ -65,35 +126,21 @@ def fit_triangle(x, y, p0=None, bounds=None, plot=True, ax=None):
 
     # sensible defaults for initial guess
     if p0 is None:
-        # center ~ weighted mean or location of maximum
-        center0 = x[np.argmax(y)]
-        # width ~ half-range or FWHM-ish: take where y falls below half of peak
-        peak = np.max(y)
-        baseline0 = np.percentile(y, 5)
-        amp0 = peak - baseline0
-        # approximate width: find indices where y > baseline + amp0/2
-        half_mask = y > (baseline0 + amp0 / 2.0)
-        if np.any(half_mask):
-            xs = x[half_mask]
-            width0 = (xs.max() - xs.min()) * 1.5 if xs.size > 1 else max(1.0, (x.max() - x.min()) / 10.0)
-        else:
-            width0 = max(1.0, (x.max() - x.min()) / 10.0)
-        p0 = (center0, width0, amp0 if amp0 > 0 else (y.max() - y.min()), baseline0)
+        p0 = triangle_guess(x, y)
 
     # sensible bounds if not provided
     if bounds is None:
-        lower = [x.min(), 1e-8, -np.inf, -np.inf]
-        upper = [x.max(), x.max() - x.min() + 1e-8, np.inf, np.inf]
-        bounds = (lower, upper)
+        bounds = triangle_bounds(x)
 
     # perform fit
     try:
-        popt, pcov = curve_fit(triangle_model, x, y, p0=p0, bounds=bounds)
+        popt, pcov = curve_fit(triangle_model, x, y, p0=p0, bounds=bounds, jac=triangle_jac)
     except Exception as e:
         raise RuntimeError(f"triangle fit failed: {e}")
 
     if plot:
         # create plot
+        import matplotlib.pyplot as plt
         if ax is None:
             fig, ax = plt.subplots(1, 1, figsize=(8, 4))
         ax.plot(x, y, marker='.', linestyle='none', alpha=0.6)
@@ -111,7 +158,7 @@ def fit_triangle(x, y, p0=None, bounds=None, plot=True, ax=None):
 
 if __name__ == '__main__':
     # Demo with synthetic data
-    import numpy as np
+    import matplotlib.pyplot as plt
 
     rng = np.random.default_rng(12345)
     x = np.linspace(0, 100, 201)
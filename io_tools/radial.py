@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    radial.py is part of pySASfit package
+"""
+__author__ = "Joachim Kohlbrecher"
+__copyright__ = "Copyright 2024, The SASfit Project"
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Joachim Kohlbrecher"
+__email__ = "joachim.kohlbrecher@psi.ch"
+__status__ = "Production"
+
+from SASformats import SANSdata
+from PSISANS1toHMI import BerSANSsections
+import os
+import datetime
+import numpy as np
+
+class RadialAverager:
+    __doc__ = """
+    RadialAverager(shape, center, SD, Lambda, pixelsize=(7.5,7.5), mask=None,
+    RadialSteps=1.0, dlambda=0.1) reduces detector images of the given shape
+    to I(Q) curves. center=[x,y] is the beam center in pixels, counted like
+    in SASazimuthal (x along the columns, y from the last row upwards), SD
+    the sample detector distance in m, Lambda the wavelength in nm and
+    pixelsize the pixel size in mm, i.e. %Setup,SD, %Setup,Lambda and
+    %Detector,PixelSizeX/Y of SANSdata. The rings are RadialSteps pixels
+    wide, pixels where mask is nonzero are left out.
+    The ring index of every pixel is calculated once, average() then only
+    needs np.bincount. Q is taken at the middle of the ring as in the
+    BerSANS reduction, dQ combines the width of the ring and the relative
+    wavelength spread dlambda (FWHM).
+    """
+    def __init__(self, shape, center, SD, Lambda, pixelsize=(7.5, 7.5), mask=None, RadialSteps=1.0, dlambda=0.1):
+        self.shape = tuple(shape)
+        self.center = list(center)
+        self.SD = float(SD)
+        self.Lambda = float(Lambda)
+        self.pixelsize = [float(pixelsize[0]), float(pixelsize[1])]
+        self.RadialSteps = float(RadialSteps)
+        self.dlambda = dlambda
+        row, col = np.indices(self.shape).reshape(2, -1)
+        x = (col-self.center[0])*self.pixelsize[0]
+        y = (self.shape[1]-1-self.center[1]-row)*self.pixelsize[1]
+        r = np.hypot(x, y)
+        step = self.RadialSteps*min(self.pixelsize)
+        index = (r/step).astype(int)
+        self.nbins = index.max()+1
+        if mask is not None:
+            index[np.asarray(mask).ravel() != 0] = self.nbins
+        self.index = index
+        self.count = np.bincount(index, minlength=self.nbins+1)[:self.nbins]
+        self.valid = self.count > 0
+        self.Q = self.q(step*(np.arange(self.nbins)+0.5))
+        width = self.q(step*(np.arange(self.nbins)+1))-self.q(step*np.arange(self.nbins))
+        self.dQ = np.sqrt(width**2/12+(self.Q*self.dlambda/2.3548)**2)
+
+    def q(self, r):
+        """
+        Q in 1/nm at the distance r in mm from the beam center.
+        """
+        return 4*np.pi/self.Lambda*np.sin(0.5*np.arctan(r/(1000*self.SD)))
+
+    def sums(self, values):
+        """
+        Sums of values over the rings for a frame or a stack of frames,
+        returned as (nbins,) or (nframes, nbins).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        flat = values.reshape(-1, self.shape[0]*self.shape[1])
+        nframes = flat.shape[0]
+        index = (self.index+(self.nbins+1)*np.arange(nframes)[:, np.newaxis]).ravel()
+        sums = np.bincount(index, weights=flat.ravel(), minlength=nframes*(self.nbins+1))
+        sums = sums.reshape(nframes, self.nbins+1)[:, :self.nbins]
+        return sums.reshape(values.shape[:-2]+(self.nbins,))
+
+    def average(self, counts, errors=None, efficiency=None, efficiency_error=None):
+        """
+        Returns Q, I, dI, dQ of the rings which contain unmasked pixels for
+        the image counts, or I and dI as (nframes, nrings) for a stack of
+        images. Without errors the counts are taken as Poisson distributed.
+        counts and errors are divided by the detector efficiency map, whose
+        uncertainty efficiency_error is propagated.
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        if errors is None:
+            variance = np.abs(counts)
+        else:
+            variance = np.asarray(errors, dtype=np.float64)**2
+        if efficiency is not None:
+            efficiency = np.asarray(efficiency, dtype=np.float64)
+            counts = counts/efficiency
+            variance = variance/efficiency**2
+            if efficiency_error is not None:
+                variance = variance+(counts*np.asarray(efficiency_error)/efficiency)**2
+        n = self.count[self.valid]
+        I = self.sums(counts)[..., self.valid]/n
+        dI = np.sqrt(self.sums(variance)[..., self.valid])/n
+        return self.Q[self.valid], I, dI, self.dQ[self.valid]
+
+def writeBerSANSIso(filename, BerSANS, Q, I, dI, dQ, history=None):
+    """
+    Writes Q, I, dI, dQ with the %File, %Sample, %Setup and %History entries
+    of the BerSANS dict of the reduced run as SANSDIso file, as read by
+    SANSdata. history adds or replaces %History entries.
+    """
+    sections = BerSANSsections(BerSANS)
+    now = datetime.datetime.now()
+    File = {'FileName': os.path.basename(filename),
+            'FileDate': now.strftime('%d-%m-%Y'),
+            'FileTime': now.strftime('%H:%M:%S'),
+            'Type': 'SANSDIso'}
+    for name, val in sections['%File']:
+        if name not in File and not name.startswith('DataSize') and name not in ('Definition', 'ContentY'):
+            File[name] = val
+    File.update({'ContentX': 'Q', 'ContentY': 'AvgFull'})
+    History = dict(sections['%History'])
+    if history is not None:
+        History.update(history)
+    out = ['%File\n']
+    out.extend(f'{name}={val}\n' for name, val in File.items())
+    for section in ('%Sample', '%Setup'):
+        out.append(f'{section}\n')
+        out.extend(f'{name}={val}\n' for name, val in sections[section])
+    out.append('%History\n')
+    out.extend(f'{name}={val}\n' for name, val in History.items())
+    out.append('%Counts\n')
+    out.extend(f'{q: .3e},{i: .3e},{e: .3e}, {r: .3e}\n' for q, i, e, r in zip(Q, I, dI, dQ))
+    with open(filename, 'w', encoding="utf-8") as f:
+        f.write("".join(out))
+
+def reduce_runs(filenames, center, mask=None, efficiency=None, efficiency_error=None, Out_path=None,
+                ext='020', RadialSteps=1.0, pixelsize=(7.5, 7.5), MaskFile=''):
+    """
+    Radial averages of a run series. Each file is read by SANSdata,
+    averaged around center with the mask (array or BerSANS mask file) and
+    the efficiency map, and written as SANSDIso file with the extension ext
+    into Out_path (default: the directory of the run). %Detector,PixelSizeX/Y
+    are used if present, pixelsize otherwise. The RadialAverager of a
+    geometry is set up only once for all runs sharing it.
+    Returns a list of (input file, output file, status, message) with status
+    'reduced' or 'failed'.
+    """
+    if isinstance(mask, str):
+        MaskFile = os.path.basename(mask)
+        mask = SANSdata(mask).BerSANS['%Mask,DetMask']
+    averagers = {}
+    summary = []
+    for filename in filenames:
+        base = os.path.basename(filename).split('.')[0]
+        outfile = os.path.join(os.path.dirname(filename) if Out_path is None else Out_path, f'{base}.{ext}')
+        try:
+            Data = SANSdata(filename)
+            BerSANS = Data.BerSANS
+            counts = np.asarray(BerSANS['%Counts,DetCounts'], dtype=np.float64)
+            psize = (float(BerSANS.get('%Detector,PixelSizeX', pixelsize[0])),
+                     float(BerSANS.get('%Detector,PixelSizeY', pixelsize[1])))
+            key = (counts.shape, float(BerSANS['%Setup,SD']), float(BerSANS['%Setup,Lambda']), psize)
+            if key not in averagers:
+                averagers[key] = RadialAverager(counts.shape, center, key[1], key[2], psize, mask, RadialSteps)
+            Q, I, dI, dQ = averagers[key].average(counts, BerSANS.get('%Errors,DetErrors'),
+                                                  efficiency, efficiency_error)
+            writeBerSANSIso(outfile, BerSANS, Q, I, dI, dQ,
+                            {'BeamcenterX': f'{center[0]:.2f}', 'BeamcenterY': f'{center[1]:.2f}',
+                             'RadialSteps': f'{RadialSteps:.2f}', 'SectorWidth': '180.0', 'MaskFile': MaskFile})
+        except Exception as exc:
+            summary.append((filename, outfile, 'failed', f'{type(exc).__name__}: {exc}'))
+            continue
+        summary.append((filename, outfile, 'reduced', ''))
+    return summary
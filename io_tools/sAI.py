@@ -1,25 +1,373 @@
 import numpy as np
 import sys
 import os
-print(os.path.dirname(os.getcwd()))
+import importlib
 try:
     from SASformats import SANSdata
-    import smoothing
 except:
     sys.path.insert(0, 'c:\\Users\\kohlbrecher\\switchdrive')
     from pySASfit.io_tools.SASformats import SANSdata
-    import pySASfit.tools.smoothing
-import cv2
-import fabio
-import pyFAI, pyFAI.azimuthalIntegrator, pyFAI.detectors
-from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
-from pyFAI.gui import jupyter
-import polarTransform as pT
-from scipy.ndimage import geometric_transform
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
-import scipy.integrate as integrate
+from scipy.special import ive
+import scipy.sparse
+import functools
+import itertools
+import warnings
+import concurrent.futures
+
+# modules needed by the modes of SASazimuthal, they are only imported when
+# the mode is used, matplotlib only by showresults
+backends = {"cv2": ["cv2"],
+            "scipy": ["scipy.ndimage"],
+            "polarTransform": ["polarTransform"],
+            "pyFAI": ["pyFAI", "pyFAI.detectors"]}
+
+def load_backend(mode):
+    """
+    Imports the modules of mode, raises RuntimeError if one is not installed.
+    """
+    for name in backends.get(mode, []):
+        try:
+            importlib.import_module(name)
+        except ImportError as exc:
+            raise RuntimeError(f'mode {mode} needs the module {name}: {exc}')
+
+class PolarIntegrator:
+    __doc__ = """
+    PolarIntegrator(shape, center, polarres=360, nradius=None, split=4, mask=None) maps
+    detector images of the given shape onto polar images with polarres
+    angular and nradius (default shape[1]) radial bins of one pixel, oriented
+    like the polar images of SASazimuthal: row i belongs to
+    psi=(polarres-i-1)*360/polarres and column j to the radius j around
+    center=[x,y].
+    Each pixel is split into split x split sub-pixels, which are assigned to
+    the bin they fall in, i.e. a pixel contributes to all bins it overlaps
+    with the fraction of its area inside them. Bins which are not hit by any
+    sub-pixel take the pixel at their center, like the meshgrid mode.
+    Pixels where mask is nonzero are left out of the weights, bins without
+    any unmasked pixel are nan and ignored by azimuthal().
+    The normalized weights are kept as sparse CSR matrix, so that the polar
+    image of any frame with this geometry is one sparse matrix product:
+
+        integrator = PolarIntegrator(img.shape, [61.3,62.42])
+        polarimg = integrator.polar(img)
+        psi, Ipsi, DIpsi = integrator.azimuthal(img, [45,50])
+    """
+    blocksize = 16
+
+    def __init__(self, shape, center, polarres=360, nradius=None, split=4, mask=None):
+        self.shape = tuple(shape)
+        self.mask = None if mask is None else np.asarray(mask).reshape(self.shape) != 0
+        self.center = list(center)
+        self.polarres = polarres
+        self.nradius = self.shape[1] if nradius is None else nradius
+        self.split = split
+        self.psi = (polarres-np.arange(polarres)-1)*360/polarres
+        self.matrix = self.weights()
+        self.shells = {}
+
+    def weights(self):
+        ny, nx = self.shape
+        npix = ny*nx
+        nbins = self.polarres*self.nradius
+        xc = self.center[0]
+        yc = self.shape[1]-1-self.center[1]
+        dpsi = 360/self.polarres
+        row, col = np.indices(self.shape).reshape(2, -1)
+        pix = np.arange(npix)
+        valid = np.ones(npix, dtype=bool) if self.mask is None else ~self.mask.ravel()
+        offsets = (np.arange(self.split)+0.5)/self.split-0.5
+        W = scipy.sparse.csr_matrix((nbins, npix))
+        for dy in offsets:
+            for dx in offsets:
+                x = col+dx-xc
+                y = yc-row-dy
+                rbin = np.rint(np.hypot(x, y)).astype(int)
+                abin = np.rint(np.degrees(np.arctan2(y, x))/dpsi).astype(int) % self.polarres
+                ok = (rbin < self.nradius) & valid
+                W = W + scipy.sparse.csr_matrix((np.full(ok.sum(), 1.0/self.split**2),
+                                                 ((self.polarres-1-abin[ok])*self.nradius+rbin[ok], pix[ok])),
+                                                shape=(nbins, npix))
+        # bins without any sub-pixel take the pixel at their center
+        empty = np.flatnonzero(np.diff(W.indptr) == 0)
+        theta = np.radians(self.psi[empty // self.nradius])
+        radius = empty % self.nradius
+        x = np.rint(xc+radius*np.cos(theta)).astype(int)
+        y = np.rint(yc-radius*np.sin(theta)).astype(int)
+        ok = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+        ok[ok] = valid[y[ok]*nx+x[ok]]
+        W = W + scipy.sparse.csr_matrix((np.ones(ok.sum()), (empty[ok], y[ok]*nx+x[ok])), shape=(nbins, npix))
+        norm = np.asarray(W.sum(axis=1)).ravel()
+        norm[norm == 0] = 1
+        return (scipy.sparse.diags(1.0/norm) @ W).tocsr()
+
+    def apply(self, matrix, frames):
+        """
+        Returns matrix @ frame for each frame as array (nframes, nbins).
+        The frames are processed in blocks of blocksize, which keeps the
+        sparse products in cache. With a mask, empty bins are nan.
+        """
+        frames = np.asarray(frames)
+        if frames.shape[-2:] != self.shape:
+            raise RuntimeError(f'frames of shape {frames.shape[-2:]} do not fit the geometry {self.shape}')
+        flat = frames.reshape(-1, self.shape[0]*self.shape[1])
+        result = np.empty((flat.shape[0], matrix.shape[0]))
+        for i in range(0, flat.shape[0], self.blocksize):
+            result[i:i+self.blocksize] = (matrix @ flat[i:i+self.blocksize].T).T
+        if self.mask is not None:
+            result[:, np.diff(matrix.indptr) == 0] = np.nan
+        return result
+
+    def polar(self, frames):
+        """
+        Returns the polar image (polarres, nradius) of a frame, or the polar
+        images (nframes, polarres, nradius) of a stack of frames.
+        """
+        polarimg = self.apply(self.matrix, frames)
+        return polarimg.reshape(np.shape(frames)[:-2]+(self.polarres, self.nradius))
+
+    def shell(self, Rrange):
+        """
+        Returns the rows of the weight matrix for the radii Rrange[0]..Rrange[1]-1.
+        """
+        key = (int(Rrange[0]), int(Rrange[1]))
+        if key not in self.shells:
+            radius = np.arange(self.polarres*self.nradius) % self.nradius
+            self.shells[key] = self.matrix[(radius >= key[0]) & (radius < key[1])]
+        return self.shells[key]
+
+    def azimuthal(self, frames, Rrange):
+        """
+        Returns psi and the sum and standard deviation over the radial bins
+        Rrange of the polar image, as calc_Ipsi of SASazimuthal, for a frame
+        (polarres,) or a stack of frames (nframes, polarres).
+        Only the bins inside Rrange are calculated. With a mask, the sum is
+        the mean of the non-empty bins times the number of bins.
+        """
+        nR = len(range(self.nradius)[int(Rrange[0]):int(Rrange[1])])
+        polarimg = self.apply(self.shell(Rrange), frames)
+        polarimg = polarimg.reshape(np.shape(frames)[:-2]+(self.polarres, nR))
+        if self.mask is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return self.psi, np.nanmean(polarimg, axis=-1)*nR, np.nanstd(polarimg, axis=-1)
+        return self.psi, polarimg.sum(axis=-1), polarimg.std(axis=-1)
+
+# The normalization of the Maier-Saupe distribution has the closed form
+#   int_0^pi/2 exp(kappa*cos(x)^2) dx = pi/2*exp(kappa/2)*I0(kappa/2),
+# so that pi/(2*norm)*exp(kappa*cos(u)^2) = exp(-kappa*sin(u)^2)/ive(0,kappa/2)
+# with the exponentially scaled Bessel function ive, which can't overflow.
+
+def _sign(p):
+    return np.where(np.asarray(p) < 0, -1.0, 1.0)
+
+def _MSshape(x, kappa, Offset):
+    """
+    Normalized Maier-Saupe distribution exp(-kappa*sin(u)^2)/ive(0,kappa/2)
+    with u=(x-Offset) in degrees, and its derivatives with respect to kappa
+    and Offset.
+    """
+    kappa = np.abs(kappa)
+    u = (np.asarray(x)-Offset)*np.pi/180
+    g = np.exp(-kappa*np.sin(u)**2)/ive(0, kappa/2.)
+    dkappa = g*(-np.sin(u)**2-0.5*(ive(1, kappa/2.)/ive(0, kappa/2.)-1))
+    dOffset = g*kappa*np.sin(2*u)*np.pi/180
+    return g, dkappa, dOffset
+
+def MaierSaupe2(x, A1, A2, Ibckg, kappa1, kappa2, Offset):
+    g1 = _MSshape(x, kappa1, Offset)[0]
+    g2 = _MSshape(x, kappa2, Offset)[0]
+    return np.abs(Ibckg)+np.abs(A1)*g1+np.abs(A2)*g2
+
+def MaierSaupe2_jac(x, A1, A2, Ibckg, kappa1, kappa2, Offset):
+    g1, dk1, dO1 = _MSshape(x, kappa1, Offset)
+    g2, dk2, dO2 = _MSshape(x, kappa2, Offset)
+    return np.stack([_sign(A1)*g1,
+                     _sign(A2)*g2,
+                     _sign(Ibckg)*np.ones_like(g1),
+                     np.abs(A1)*_sign(kappa1)*dk1,
+                     np.abs(A2)*_sign(kappa2)*dk2,
+                     np.abs(A1)*dO1+np.abs(A2)*dO2], axis=-1)
+
+def MaierSaupe1(x, A1, Ibckg, kappa1, Offset):
+    return np.abs(Ibckg)+np.abs(A1)*_MSshape(x, kappa1, Offset)[0]
+
+def MaierSaupe1_jac(x, A1, Ibckg, kappa1, Offset):
+    g, dk, dO = _MSshape(x, kappa1, Offset)
+    return np.stack([_sign(A1)*g,
+                     _sign(Ibckg)*np.ones_like(g),
+                     np.abs(A1)*_sign(kappa1)*dk,
+                     np.abs(A1)*dO], axis=-1)
+
+def fit_MaierSaupe(psi, Ipsi, p0=None):
+    """
+    Fits MaierSaupe1 to the azimuthal profile Ipsi(psi), starting from the
+    extrema of the smoothed profile or from the parameters p0, e.g. the
+    result of a neighbouring profile, and returns the parameters
+    [A1, Ibckg, kappa1, Offset], their covariance and the smoothed profile.
+    nan values of masked angles are left out of the fit and interpolated
+    for the smoothing.
+    """
+    try:
+        from smoothing import smooth_data_gaussian_filter1d_wrap, smooth_data_fft
+    except ImportError:
+        from pySASfit.tools.smoothing import smooth_data_gaussian_filter1d_wrap, smooth_data_fft
+    psi = np.asarray(psi)
+    Ipsi = np.asarray(Ipsi)
+    ok = np.isfinite(Ipsi)
+    if not ok.all():
+        Ipsi = Ipsi.copy()
+        Ipsi[~ok] = np.interp(psi[~ok], psi[ok], Ipsi[ok], period=360)
+    #SMIpsi = smooth_data_savgol_n(Ipsi, 15, 2)
+    SMIpsi = smooth_data_gaussian_filter1d_wrap(Ipsi, 3)
+    #SMIpsi = smooth_data_fft(Ipsi, 0.1*np.average(Ipsi))
+    Dmin = np.min(SMIpsi)
+    Dmax = np.max(SMIpsi)
+    if p0 is None:
+        p0 = [Dmax-Dmin,Dmin,0.3, psi[SMIpsi.argmax()]]
+    MSparameters, MScovariance = curve_fit(MaierSaupe1, psi[ok], Ipsi[ok], p0=p0, jac=MaierSaupe1_jac)
+    while  MSparameters[3] > 180:
+        MSparameters[3] = MSparameters[3]-180
+    while  MSparameters[3] < 0:
+        MSparameters[3] = MSparameters[3]+180
+    MSparameters, MScovariance = curve_fit(MaierSaupe1, psi[ok], Ipsi[ok], p0=MSparameters, jac=MaierSaupe1_jac)
+    return MSparameters, MScovariance, SMIpsi
+
+# one row per (frame, shell) of SASazimuthal.orientation
+orientation_dtype = np.dtype([('frame', int), ('Rmin', int), ('Rmax', int),
+                              ('MSparameters', float, 4), ('MScovariance', float, (4, 4)),
+                              ('offset', float), ('kappa', float),
+                              ('MSvisibility', float), ('visibility', float), ('success', bool)])
+
+def _fit_profiles(psi, profiles, warmstart=True):
+    """
+    Fits the profiles (nframes, polarres) of one shell one after the other.
+    Each fit starts from the result of the previous frame, if that fails it
+    is repeated with the default start parameters.
+    Returns the table rows (without frame and shell) as list of tuples.
+    """
+    rows = []
+    p0 = None
+    for Ipsi in profiles:
+        result = None
+        for start in ([p0, None] if warmstart and p0 is not None else [None]):
+            try:
+                result = fit_MaierSaupe(psi, Ipsi, p0=start)
+                break
+            except (RuntimeError, ValueError):
+                continue
+        if result is None or not np.all(np.isfinite(result[0])):
+            rows.append((np.full(4, np.nan), np.full((4, 4), np.nan), np.nan, np.nan, np.nan, np.nan, False))
+            continue
+        MSparameters, MScovariance, SMIpsi = result
+        p0 = MSparameters
+        MSIpsi = MaierSaupe1(psi, *MSparameters)
+        rows.append((MSparameters, MScovariance, MSparameters[3], np.abs(MSparameters[2]),
+                     (np.max(MSIpsi)-np.min(MSIpsi))/np.average(MSIpsi),
+                     (np.max(SMIpsi)-np.min(SMIpsi))/np.average(SMIpsi), True))
+    return rows
+
+def shell_profile(polarimg, Rrange):
+    """
+    Ipsi of the radial bins Rrange of a polar image (polarres, nradius) or
+    a stack of polar images like calc_Ipsi, nan bins are ignored.
+    """
+    shell = np.asarray(polarimg)[..., Rrange[0]:Rrange[1]]
+    if not np.isnan(shell).any():
+        return shell.sum(axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(shell, axis=-1)*shell.shape[-1]
+
+def _frame_blocks(frames, nblock):
+    """
+    Returns the frame shape and an iterator over blocks of at most nblock
+    frames of a 3D array (frames x Y x X), e.g. a HDF dataset or
+    HDFLazyArray, which is read block by block, or of an iterator of 2D
+    frames. A single 2D frame is a stack of one frame.
+    """
+    if hasattr(frames, 'shape') and len(frames.shape) == 2:
+        frames = np.asarray(frames)[np.newaxis]
+    if hasattr(frames, 'shape') and len(frames.shape) == 3:
+        blocks = (frames[i:i+nblock] for i in range(0, frames.shape[0], nblock))
+        return tuple(frames.shape[1:]), blocks
+    frames = iter(frames)
+    first = np.asarray(next(frames))
+    chunks = itertools.chain([first], frames)
+    return first.shape, iter(lambda: [np.asarray(f) for f in itertools.islice(chunks, nblock)], [])
+
+@functools.lru_cache(maxsize=8)
+def _slice_index(shape, zero, Rmin, Rmax, slices):
+    """
+    Angular slice index of each pixel for SASazimuthal.azimuthal_average,
+    slices for pixels outside Rmin <= r < Rmax. Slice n is centered at
+    psi=n*360/slices like the angular bins of PolarIntegrator.
+    """
+    row, col = np.indices(shape).reshape(2, -1)
+    x = col-zero[0]
+    y = shape[1]-1-zero[1]-row
+    r = np.hypot(x, y)
+    index = np.rint(np.degrees(np.arctan2(y, x))*slices/360).astype(int) % slices
+    index[(r < Rmin) | (r >= Rmax)] = slices
+    return index
+
+def maskkey(mask):
+    """
+    Hashable form of a mask for the geometry caches, None for no mask.
+    """
+    if mask is None or len(mask) == 0:
+        return None
+    mask = np.asarray(mask) != 0
+    return mask.shape, np.packbits(mask).tobytes()
+
+def _unpackmask(key):
+    if key is None:
+        return None
+    shape, bits = key
+    return np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=shape[0]*shape[1]).reshape(shape)
+
+@functools.lru_cache(maxsize=8)
+def polar_integrator(shape, center, polarres=360, nradius=None, split=4, mask=None):
+    """
+    Returns a PolarIntegrator for the geometry, the last 8 ones are kept.
+    center must be given as tuple and mask as maskkey(mask).
+    """
+    return PolarIntegrator(shape, center, polarres, nradius, split, _unpackmask(mask))
+
+@functools.lru_cache(maxsize=8)
+def pyFAI_integrator(shape, center, pixelsize, distance, polarres, Rrange, mask=None):
+    """
+    Returns the pyFAI AzimuthalIntegrator for the geometry of the pyFAI mode,
+    pixelsize in mm and distance in m. polarres, Rrange and the mask (as
+    maskkey) are part of the key as pyFAI keeps the lookup tables of the
+    integrations it did inside the integrator. The last 8 integrators are
+    kept, pyFAI_integrator.cache_info() gives the hits and misses.
+    """
+    import pyFAI.detectors
+    try:
+        from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+    except ImportError:
+        from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+    detector = pyFAI.detectors.Detector(pixelsize[0]/1000,pixelsize[1]/1000)
+    detector.max_shape=shape
+    ai = AzimuthalIntegrator(dist=distance, detector=detector)
+    ai.poni1=ai.pixel1*(shape[0]-center[0]-1)
+    #ai.poni1=ai.pixel1*center[0]
+    ai.poni2=ai.pixel2*(shape[1]-center[1]-1)
+    ai.poni2=ai.pixel2*(center[1])
+    if mask is not None:
+        # bins without unmasked pixels are nan instead of 0
+        ai.empty = np.nan
+    return ai
+
+@functools.lru_cache(maxsize=8)
+def _polar_valid(mode, shape, center, Rrange, polarres, order, mask):
+    """
+    Polar image of the unmasked pixels for the interpolating modes, which
+    is the normalization of the polar image of the masked data.
+    """
+    valid = 1.0-_unpackmask(mask)
+    return SASazimuthal(valid, mode=mode, center=list(center), Rrange=list(Rrange), polarres=polarres, order=order, fit=False).polarimg
 
 class SASazimuthal:
     __doc__ = """
@@ -27,10 +375,13 @@ class SASazimuthal:
     
     The `SASazimuthal` class is used for calculating azimuthal averages of 2D data. It provides
     different methods for calculating the azimuthal average, such as using OpenCV (`cv2`), Scipy
-    (`scipy`), meshgrid (`meshgrid`), pyFAI ('pyFAI') or a custom implementation called `polarTransform`. The
+    (`scipy`), meshgrid (`meshgrid`), pyFAI ('pyFAI'), a custom implementation called `polarTransform` or
+    a precomputed sparse pixel to polar bin matrix (`sparse`, see PolarIntegrator). The
     class takes a 2D array as input and calculates the azimuthal average using the specified
     method. It also provides methods for converting between Cartesian and polar coordinates, as
     well as calculating the intensity profile along the azimuthal direction.
+    The Maier-Saupe fit of the profile (calcAnsisotropy) is skipped with fit=False.
+    SASazimuthal.stack() integrates a whole stack of frames at once.
     """
     __author__ = "Joachim Kohlbrecher"
     __copyright__ = "Copyright 2024 The SASfit Project"
@@ -40,7 +391,7 @@ class SASazimuthal:
     __email__ = "joachim.kohlbrecher@psi.ch"
     __status__ = "Production"
     
-    algorithms = ["cv2", "scipy", "meshgrid", 'polarTransform', 'pyFAI']
+    algorithms = ["cv2", "scipy", "meshgrid", 'polarTransform', 'pyFAI', 'sparse']
     maskimg = []
     cartimg = []
     polarimg = []
@@ -54,6 +405,7 @@ class SASazimuthal:
     pixelsize = [7.5, 7.5]
     order = 0
     polarres=360
+    split = 4
     visibility = 0
     MSvisibility = 0
     offset = 0
@@ -64,7 +416,7 @@ class SASazimuthal:
     name = 'unknown'
     output=None
 
-    def __init__(self, array2D, mode=None, center=None,Rrange=None, polarres=None, order=None, distance=None, pixelsize=None):
+    def __init__(self, array2D, mode=None, center=None,Rrange=None, polarres=None, order=None, distance=None, pixelsize=None, fit=True, mask=None):
         try:
             self.cartimg = np.asarray(array2D)
             if self.cartimg.ndim != 2:
@@ -79,6 +431,7 @@ class SASazimuthal:
             self.mode = mode
             if mode == "pyFAI" and distance == None and pixelsize == None:
                 raise RuntimeError(f'for the methods pyFAI both the sample detector distance as well as the pixel size needs to be supplied')
+        load_backend(self.mode)
         if center == None:
             self.center = [self.cartimg.shape[0]/2.,self.cartimg.shape[1]/2.]
         else:
@@ -95,6 +448,12 @@ class SASazimuthal:
             self.polarres = 360
         else:
             self.polarres = polarres
+        if distance != None:
+            self.distance = distance
+        if pixelsize != None:
+            self.pixelsize = pixelsize
+        if mask is not None:
+            self.applyMask(mask)
                    
         if self.mode == "polarTransform":
             self.azimuthal_average_polarTransform()
@@ -106,40 +465,58 @@ class SASazimuthal:
             self.azimuthal_average_scipy()
         elif self.mode == "pyFAI":
             self.azimuthal_average_pyFAI()
+        elif self.mode == "sparse":
+            self.azimuthal_average_sparse()
         else:
             self.azimuthal_average_meshgrid()
-        self.calcAnsisotropy()
+        if fit:
+            self.calcAnsisotropy()
     
+    @staticmethod
+    def cache_info():
+        """
+        Hits and misses of the geometry caches of the sparse and pyFAI modes.
+        """
+        return {'sparse': polar_integrator.cache_info(), 'pyFAI': pyFAI_integrator.cache_info()}
+
     def applyMask(self, array2D):
-        print('Hello',array2D)
+        """
+        Sets the mask of the image, e.g. %Mask,DetMask of a BerSANS mask file
+        read by SANSdata. Pixels where array2D is nonzero are excluded from
+        the polar image and from Ipsi, DIpsi. The mask is part of the cached
+        geometry of the sparse and interpolating modes and is passed on to
+        pyFAI.
+        """
+        mask = np.asarray(array2D) != 0
+        if mask.shape != self.cartimg.shape:
+            raise RuntimeError(f'mask of shape {mask.shape} does not fit the image of shape {self.cartimg.shape}')
+        self.maskimg = mask
+
+    def maskedimg(self):
+        """
+        Returns the image with masked pixels set to zero.
+        """
+        if len(self.maskimg) == 0:
+            return self.cartimg
+        return np.where(self.maskimg, 0, self.cartimg)
+
+    def normalize_masked(self):
+        """
+        Divides the polar image of the masked image by the polar image of
+        the unmasked pixels, bins without unmasked pixels become nan.
+        """
+        if len(self.maskimg) == 0:
+            return
+        valid = _polar_valid(self.mode, self.cartimg.shape, tuple(self.center), tuple(self.Rrange),
+                             self.polarres, self.order, maskkey(self.maskimg))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.polarimg = np.where(valid > 0.5, self.polarimg/valid, np.nan)
         
     def calcAnsisotropy(self):
-        def MaierSaupe2(x, A1, A2, Ibckg, kappa1, kappa2, Offset):
-            kappa1 = np.abs(kappa1)
-            kappa1 = np.abs(kappa2)
-            I0 = np.abs(Ibckg)
-            MSnorm1 = integrate.quad(lambda x: np.exp(np.abs(kappa1)*np.cos(x)**2), 0, np.pi/2.)
-            MSnorm2 = integrate.quad(lambda x: np.exp(np.abs(kappa2)*np.cos(x)**2), 0, np.pi/2.)
-            return I0+np.abs(A1)*np.pi/(2.0*MSnorm1[0])* np.exp(np.abs(kappa1)*np.cos((x-Offset)*np.pi/180)**2) \
-                     +np.abs(A2)*np.pi/(2.0*MSnorm2[0])* np.exp(np.abs(kappa2)*np.cos((x-Offset)*np.pi/180)**2)
-        def MaierSaupe1(x, A1, Ibckg, kappa1, Offset):
-            kappa1 = np.abs(kappa1)
-            I0 = np.abs(Ibckg)
-            MSnorm1 = integrate.quad(lambda x: np.exp(np.abs(kappa1)*np.cos(x)**2), 0, np.pi/2.)
-            return I0+np.abs(A1)*np.pi/(2.0*MSnorm1[0])* np.exp(np.abs(kappa1)*np.cos((x-Offset)*np.pi/180)**2) 
-        from pySASfit.tools.smoothing import smooth_data_gaussian_filter1d_wrap, smooth_data_fft
-        #self.SMIpsi = smooth_data_savgol_n(self.Ipsi, 15, 2)
-        self.SMIpsi = smooth_data_gaussian_filter1d_wrap(self.Ipsi, 3)
-        #self.SMIpsi = smooth_data_fft(self.Ipsi, 0.1*np.average(self.Ipsi))
+        self.MSparameters, self.MScovariance, self.SMIpsi = fit_MaierSaupe(self.psi, self.Ipsi)
         Dmin = np.min(self.SMIpsi)
         Dmax = np.max(self.SMIpsi)
         Davg = np.average(self.SMIpsi)
-        self.MSparameters, self.MScovariance = curve_fit(MaierSaupe1, self.psi, self.Ipsi, p0=[Dmax-Dmin,Dmin,0.3, self.psi[self.SMIpsi.argmax()]])
-        while  self.MSparameters[3] > 180:
-            self.MSparameters[3] = self.MSparameters[3]-180
-        while  self.MSparameters[3] < 0:
-            self.MSparameters[3] = self.MSparameters[3]+180
-        self.MSparameters, self.MScovariance = curve_fit(MaierSaupe1, self.psi, self.Ipsi, p0=self.MSparameters)
         self.visibility = (Dmax-Dmin)/(Davg) 
         #print(self.visibility, Dmax, Dmin)
         self.MSIpsi = MaierSaupe1(self.psi, *self.MSparameters)
@@ -149,8 +526,125 @@ class SASazimuthal:
         self.MSvisibility = (MSmax-MSmin)/(MSavg)
         #print(self.MSvisibility, MSmax, MSmin)
         self.offset = self.MSparameters[3]
+
+    @classmethod
+    def stack(cls, frames, center=None, Rrange=None, polarres=None, fit=False, nblock=256, mask=None):
+        """
+        Azimuthal averages of a stack of frames with the same geometry, either
+        a 3D array (frames x Y x X), e.g. a HDF dataset or HDFLazyArray which
+        is read in blocks of nblock frames, or an iterator of 2D frames. A
+        single 2D frame gives matrices with one row.
+        The frames are integrated with the PolarIntegrator of the geometry,
+        center, Rrange, polarres and mask have the same meaning as for single images.
+        Returns psi and the matrices Ipsi and DIpsi (nframes x polarres).
+        With fit=True the Maier-Saupe fit of each frame is done as well and
+        a dict with the arrays MSparameters, MScovariance, visibility,
+        MSvisibility and offset (nan if the fit failed) is returned in addition.
+        """
+        shape, blocks = _frame_blocks(frames, nblock)
+        if center is None:
+            center = [shape[0]/2., shape[1]/2.]
+        if Rrange is None:
+            Rrange = [0, shape[1]]
+        if polarres is None:
+            polarres = cls.polarres
+        integrator = polar_integrator(shape, tuple(center), polarres, shape[1], cls.split, maskkey(mask))
+        Ipsi = []
+        DIpsi = []
+        for block in blocks:
+            psi, I, DI = integrator.azimuthal(np.asarray(block), Rrange)
+            Ipsi.append(I)
+            DIpsi.append(DI)
+        psi = integrator.psi
+        Ipsi = np.concatenate(Ipsi) if Ipsi else np.empty((0, polarres))
+        DIpsi = np.concatenate(DIpsi) if DIpsi else np.empty((0, polarres))
+        if not fit:
+            return psi, Ipsi, DIpsi
+        nframes = Ipsi.shape[0]
+        fits = {'MSparameters': np.full((nframes, 4), np.nan),
+                'MScovariance': np.full((nframes, 4, 4), np.nan),
+                'visibility': np.full(nframes, np.nan),
+                'MSvisibility': np.full(nframes, np.nan)}
+        for i in range(nframes):
+            try:
+                MSparameters, MScovariance, SMIpsi = fit_MaierSaupe(psi, Ipsi[i])
+            except (RuntimeError, ValueError):
+                continue
+            MSIpsi = MaierSaupe1(psi, *MSparameters)
+            fits['MSparameters'][i] = MSparameters
+            fits['MScovariance'][i] = MScovariance
+            fits['visibility'][i] = (np.max(SMIpsi)-np.min(SMIpsi))/np.average(SMIpsi)
+            fits['MSvisibility'][i] = (np.max(MSIpsi)-np.min(MSIpsi))/np.average(MSIpsi)
+        fits['offset'] = fits['MSparameters'][:, 3]
+        return psi, Ipsi, DIpsi, fits
         
+    @classmethod
+    def orientation(cls, data, shells, center=None, polarres=None, mask=None, polar=False,
+                    processes=None, warmstart=True, nblock=256):
+        """
+        Maier-Saupe analysis of many radial shells, e.g. [[20,25],[25,30]],
+        and frames. data is a frame, a stack of frames (3D array, HDF
+        dataset or HDFLazyArray, read in blocks of nblock frames), or with
+        polar=True a polar image (polarres, nradius) as SASazimuthal.polarimg
+        or a stack of them. Each block of frames is integrated only once
+        into polar images with the PolarIntegrator of the geometry, center,
+        polarres and mask as for SASazimuthal.stack(), and all shells are
+        taken from them.
+        The frames of every shell are split into contiguous chunks, so that
+        there are about as many chunks as processes worker processes
+        (default: number of cores, 1 fits in this process). Within a chunk
+        each fit starts from the result of the previous frame if warmstart
+        is True.
+        Returns psi and a table, a structured array with the orientation_dtype
+        fields frame, Rmin, Rmax, MSparameters, MScovariance, offset, kappa,
+        MSvisibility, visibility and success, one row per frame and shell.
+        """
+        shells = [(int(R[0]), int(R[1])) for R in shells]
+        if polar:
+            polarimg = np.asarray(data)
+            polarimg = polarimg.reshape((-1,)+polarimg.shape[-2:])
+            psi = (polarimg.shape[1]-np.arange(polarimg.shape[1])-1)*360/polarimg.shape[1]
+            profiles = [shell_profile(polarimg, R) for R in shells]
+        else:
+            shape, blocks = _frame_blocks(data, nblock)
+            if center is None:
+                center = [shape[0]/2., shape[1]/2.]
+            if polarres is None:
+                polarres = cls.polarres
+            integrator = polar_integrator(shape, tuple(center), polarres, shape[1], cls.split, maskkey(mask))
+            psi = integrator.psi
+            profiles = [[] for R in shells]
+            for block in blocks:
+                polarimg = integrator.polar(np.asarray(block))
+                for profile, R in zip(profiles, shells):
+                    profile.append(shell_profile(polarimg, R))
+            profiles = [np.concatenate(profile) if profile else np.empty((0, polarres)) for profile in profiles]
+        nframes = profiles[0].shape[0] if profiles else 0
+        nworkers = processes if processes is not None else (os.cpu_count() or 1)
+        nchunks = min(max(1, nframes), max(1, -(-nworkers//max(1, len(shells)))))
+        chunks = [chunk for chunk in np.array_split(np.arange(nframes), nchunks) if chunk.size]
+        tasks = [(shell, chunk) for shell in range(len(shells)) for chunk in chunks]
+        if processes == 1:
+            fitted = [_fit_profiles(psi, profiles[shell][chunk], warmstart) for shell, chunk in tasks]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(_fit_profiles, psi, profiles[shell][chunk], warmstart)
+                           for shell, chunk in tasks]
+                fitted = [future.result() for future in futures]
+        results = [[None]*nframes for R in shells]
+        for (shell, chunk), rows in zip(tasks, fitted):
+            for frame, row in zip(chunk, rows):
+                results[shell][frame] = row
+        table = np.zeros(nframes*len(shells), dtype=orientation_dtype)
+        i = 0
+        for frame in range(nframes):
+            for (Rmin, Rmax), rows in zip(shells, results):
+                table[i] = (frame, Rmin, Rmax)+rows[frame]
+                i += 1
+        return psi, table
+
     def showresults(self):
+        import matplotlib.pyplot as plt
         ThisMin = np.min(self.cartimg)
         fig, ax = plt.subplots(1,3,figsize=(10, 3))
         fig.tight_layout()
@@ -159,7 +653,7 @@ class SASazimuthal:
         im = ax[1].imshow(np.log1p(self.polarimg-ThisMin), interpolation='none',cmap='turbo',origin='upper',aspect=self.polarimg.shape[1]/self.polarimg.shape[0])
         plt.colorbar(im, ax=ax[1])
         ax[2].plot(self.psi,self.Ipsi)
-        ax[2].set_ylim([0,1.2*np.max(self.Ipsi)])
+        ax[2].set_ylim([0,1.2*np.nanmax(self.Ipsi)])
         ax[2].plot(self.psi, self.MSIpsi)
         ax[2].plot(self.psi, self.SMIpsi)
         
@@ -210,11 +704,12 @@ class SASazimuthal:
         Xncart = np.where((Ycart >= 0), Xcart, int(self.center[1]))
         Ycart = np.where((Xncart >= 0), Yncart, int(self.center[0]))
         Xcart = np.where((Xncart >= 0), Xncart, int(self.center[1]))
-        self.polarimg = self.cartimg[Ycart,Xcart]
+        self.polarimg = self.maskedimg()[Ycart,Xcart]
         self.polarimg = np.reshape(self.polarimg,(max_radius,self.polarres))
         self.polarimg = (np.transpose(self.polarimg))
 
     def topolar(self):
+        from scipy.ndimage import geometric_transform
         max_radius = 0.5*np.linalg.norm( self.cartimg.shape )
         def transform(coords):
             theta = 2.0*np.pi*coords[1] / (self.cartimg.shape[1] - 1.)
@@ -223,10 +718,11 @@ class SASazimuthal:
             i = self.cartimg.shape[1]-1-self.center[1] - radius*np.sin(theta)
             j = radius*np.cos(theta) + self.center[0]
             return i,j
-        self.polarimg = np.flipud(np.transpose(geometric_transform(self.cartimg, transform, order=self.order,mode='nearest',prefilter=True)))
+        self.polarimg = np.flipud(np.transpose(geometric_transform(self.maskedimg(), transform, order=self.order,mode='nearest',prefilter=True)))
 
     """convert polar to cartesian"""
     def tocart(self):
+        from scipy.ndimage import geometric_transform
         max_radius = 0.5*np.linalg.norm( self.polarimg.shape )
         def transform(coords):
             xindex,yindex = coords
@@ -241,6 +737,13 @@ class SASazimuthal:
 
     def calc_Ipsi(self):
         self.psi = (self.polarres-np.arange(self.polarres)-1)*360/self.polarres
+        if len(self.maskimg) != 0:
+            shell = self.polarimg[:,self.Rrange[0]:self.Rrange[1]]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.Ipsi  = np.nanmean(shell, axis=1)*shell.shape[1]
+                self.DIpsi = np.nanstd(shell, axis=1)
+            return
         self.Ipsi  = self.polarimg[:,self.Rrange[0]:self.Rrange[1]].sum(axis=1) 
         self.DIpsi = self.polarimg[:,self.Rrange[0]:self.Rrange[1]].std(axis=1)
 
@@ -249,9 +752,11 @@ class SASazimuthal:
         updates:
             self.polarimg, self.psi, self.Ipsi
         """
-        self.polarimg = np.array(cv2.linearPolar(self.cartimg,
+        import cv2
+        self.polarimg = np.array(cv2.linearPolar(self.maskedimg(),
                                                  (self.center[0],self.cartimg.shape[1]-self.center[1]-1),
                                                  self.cartimg.shape[1],cv2.WARP_FILL_OUTLIERS))
+        self.normalize_masked()
         self.calc_Ipsi()
 
     def azimuthal_average_meshgrid(self):
@@ -260,6 +765,7 @@ class SASazimuthal:
             self.polarimg, self.psi, self.Ipsi
         """
         self.img2polar()
+        self.normalize_masked()
         self.calc_Ipsi()
 
     def azimuthal_average_polarTransform(self):
@@ -268,7 +774,8 @@ class SASazimuthal:
         updates:
             self.polarimg, self.psi, self.Ipsi
         """
-        self.polarimg, ptSettings = pT.convertToPolarImage(self.cartimg,
+        import polarTransform as pT
+        self.polarimg, ptSettings = pT.convertToPolarImage(self.maskedimg(),
                                                            center=(self.center[0],self.cartimg.shape[1]-self.center[1]-1),
                                                            angleSize=self.polarres,
                                                            radiusSize=self.cartimg.shape[1],
@@ -276,6 +783,7 @@ class SASazimuthal:
                                                            finalRadius=self.cartimg.shape[1],
                                                            order=self.order,
                                                            useMultiThreading=True)
+        self.normalize_masked()
         self.calc_Ipsi()
 
     def azimuthal_average_scipy(self):
@@ -285,6 +793,20 @@ class SASazimuthal:
             self.polarimg, self.psi, self.Ipsi
         """
         self.topolar()
+        self.normalize_masked()
+        self.calc_Ipsi()
+
+    def azimuthal_average_sparse(self):
+        """_summary_
+        The pixel to polar bin weights are calculated once per geometry by
+        PolarIntegrator and reused for all further images.
+
+        updates:
+            self.polarimg, self.psi, self.Ipsi
+        """
+        integrator = polar_integrator(self.cartimg.shape, tuple(self.center), self.polarres,
+                                      self.cartimg.shape[1], self.split, maskkey(self.maskimg))
+        self.polarimg = integrator.polar(self.cartimg)
         self.calc_Ipsi()
 
     def azimuthal_average_pyFAI(self):
@@ -303,18 +825,14 @@ class SASazimuthal:
                                                            order=self.order,
                                                            useMultiThreading=True)
         """
-        detector = pyFAI.detectors.Detector(self.pixelsize[0]/1000,self.pixelsize[1]/1000)
-        detector.max_shape=self.cartimg.shape
-        ai = AzimuthalIntegrator(dist=self.distance, detector=detector)
-        ai.poni1=ai.pixel1*(self.cartimg.shape[0]-self.center[0]-1)
-        #ai.poni1=ai.pixel1*self.center[0]
-        ai.poni2=ai.pixel2*(self.cartimg.shape[1]-self.center[1]-1)
-        ai.poni2=ai.pixel2*(self.center[1])
-        self.polarimg, tth, self.psi = ai.integrate2d(self.cartimg, self.cartimg.shape[1], self.polarres,unit="2th_deg")
+        ai = pyFAI_integrator(self.cartimg.shape, tuple(self.center), tuple(self.pixelsize), float(self.distance),
+                              self.polarres, tuple(self.Rrange), maskkey(self.maskimg))
+        mask = self.maskimg if len(self.maskimg) else None
+        self.polarimg, tth, self.psi = ai.integrate2d(self.cartimg, self.cartimg.shape[1], self.polarres,unit="2th_deg", mask=mask)
         self.polarimg = np.flipud(self.polarimg)
         self.psi, self.Ipsi = ai.integrate_radial(self.cartimg, self.polarres, \
                                                   npt_rad=self.cartimg.shape[1], \
-                                                  correctSolidAngle=True, azimuth_range=(-180,180),\
+                                                  correctSolidAngle=True, azimuth_range=(-180,180), mask=mask,\
                                                   radial_range=(ai.pixel1*self.Rrange[0]*1e3,ai.pixel2*self.Rrange[1]*1e3),\
                                                   method='csr', radial_unit='r_mm')
         self.Ipsi = self.Ipsi*(self.Rrange[1]-self.Rrange[0])
@@ -323,51 +841,76 @@ class SASazimuthal:
         self.psi = self.psi[ind]
         self.Ipsi = self.Ipsi[ind]
         
-    def azimuthal_average(Data_array, Rmin=20,Rmax=50,zero=(-999,-999),slices=128):
-        sorted_data=[]
-        data = np.array(Data_array)
+    @staticmethod
+    def azimuthal_average(Data_array, Rmin=20,Rmax=50,zero=(-999,-999),slices=128, mask=None):
+        """
+        Mean and standard deviation of the pixels with Rmin <= r < Rmax around
+        zero=[x,y] (default: center of the image) in slices angular slices.
+        psi is counted like in SASazimuthal and PolarIntegrator, slice n holds
+        the pixel centers with (n-0.5)*360/slices <= psi < (n+0.5)*360/slices
+        and is reported at psi=n*360/slices. Pixels where mask is nonzero are
+        ignored. The average times Rmax-Rmin agrees with Ipsi of the polar
+        image modes for Rrange=[Rmin,Rmax] and polarres=slices, up to the
+        discretization of the pixels (about 1-2% for 360 slices of a smooth
+        pattern). Here every pixel counts once, so that larger radii have
+        more weight than in the polar images, which differs if the intensity
+        changes strongly within Rmin..Rmax.
+        The slice index of each pixel only depends on the geometry and is
+        cached, the averages are calculated with np.bincount, the standard
+        deviation from the deviations of the slice mean.
+        Returns psi, average, st_dev (nan for empty slices).
+        """
+        data = np.asarray(Data_array, dtype=np.float64)
         if zero[0] == -999 or zero[1] == -999:
-            zero[0] = data.shape[0]/2
-            zero[1] = data.shape[1]/2
-        for i in range (slices):
-            sorted_data.append([])
-        for i in range(data.shape[1]):
-            for j in range(data.shape[0]):  
-                d=np.sqrt((data.shape[0]-i+1-zero[1])**2+(j+1-zero[0])**2)
-                if(d>R_min and d<R_max):
-                    n=int((np.arctan2(j-zero[0],len(data[0])-i-zero[1])+np.pi)*(Angular_slices/(2*np.pi)))
-
-                    try:
-                        sorted_data[n].append(data[i][j])
-                    except:
-                        if (n==Angular_slices):
-                            sorted_data[0].append(data[i][j])
-                        else:
-                            print("Error...")
-        psi=np.linspace(-np.pi,np.pi,Angular_slices, endpoint=False)+np.pi/Angular_slices
-        average=[]
-        st_dev=[]
-        for i in range(Angular_slices):
-            average.append(np.mean(np.array(sorted_data[i])))
-            st_dev.append(np.std(np.array(sorted_data[i])))
-        return average, st_dev
-
-ThisData = SANSdata('C:\\Users\\kohlbrecher\\switchdrive\\SANS\\user\\Saegesser\\20222544\\D0021227.018')
-ThisMin = np.min(ThisData.BerSANS["%Counts,DetCounts"])
-ThisMax = np.max(ThisData.BerSANS["%Counts,DetCounts"])
-ThisMask = SANSdata('C:\\Users\\kohlbrecher\\switchdrive\\SANS\\user\\Saegesser\\20222544\\18m.sma')
-MaskBerSANS = ThisMask.BerSANS['%Mask,DetMask']
-ThisMin=np.min(np.where(1- MaskBerSANS,ThisData.BerSANS["%Counts,DetCounts"],ThisMax))
-MaskedData=np.where(1- MaskBerSANS,ThisData.BerSANS["%Counts,DetCounts"],ThisMin)
-
-
-AIntcv2 = SASazimuthal(MaskedData,mode='cv2',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=128)
-AIntcv2.showresults()
-AIntscipy = SASazimuthal(MaskedData,mode='scipy',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=360)
-AIntscipy.showresults()
-AIntpolarTransform = SASazimuthal(MaskedData,mode='polarTransform',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=360)
-AIntpolarTransform.showresults()
-AIntmeshgrid = SASazimuthal(MaskedData,mode='meshgrid',center=[61.3,62.42], Rrange=[45,50],polarres=360)
-AIntmeshgrid.showresults()
-AIntmeshgrid = SASazimuthal(MaskedData,mode='pyFAI',center=[61.3,62.42], Rrange=[45,50],polarres=180, pixelsize=[7.5,7.5], distance=ThisData.BerSANS["%Setup,SD"])
-AIntmeshgrid.showresults()
+            zero = (data.shape[0]/2, data.shape[1]/2)
+        index = _slice_index(data.shape, tuple(zero), Rmin, Rmax, slices)
+        if mask is not None:
+            index = np.where(np.asarray(mask).ravel() != 0, slices, index)
+        count = np.bincount(index, minlength=slices+1)
+        total = np.bincount(index, weights=data.ravel(), minlength=slices+1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = total/count
+            average[slices] = 0
+            squares = np.bincount(index, weights=(data.ravel()-average[index])**2, minlength=slices+1)
+            st_dev = np.sqrt(squares/count)
+        psi = np.arange(slices)*360/slices
+        return psi, average[:slices], st_dev[:slices]
+
+def import_benchmark(repeat=5):
+    """
+    Compares the time to start python and import this module with the time
+    needed when all backends are imported as well, as it was done before
+    they were loaded on demand.
+    """
+    import subprocess
+    import time
+    path = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))]+sys.path)
+    eager = "import sAI, matplotlib.pyplot, fabio, " + ", ".join(name for names in backends.values() for name in names)
+    for label, statement in [("python", "pass"), ("import sAI", "import sAI"), ("import sAI + all backends", eager)]:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], check=True, env=dict(os.environ, PYTHONPATH=path))
+            times.append(time.perf_counter()-start)
+        print(f"{label:28s} {min(times):8.3f} s")
+
+if __name__ == '__main__':
+    if '--importtime' in sys.argv:
+        import_benchmark()
+        sys.exit()
+    ThisData = SANSdata('C:\\Users\\kohlbrecher\\switchdrive\\SANS\\user\\Saegesser\\20222544\\D0021227.018')
+    ThisMask = SANSdata('C:\\Users\\kohlbrecher\\switchdrive\\SANS\\user\\Saegesser\\20222544\\18m.sma')
+    MaskBerSANS = ThisMask.BerSANS['%Mask,DetMask']
+    DetCounts=ThisData.BerSANS["%Counts,DetCounts"]
+
+
+    AIntcv2 = SASazimuthal(DetCounts,mode='cv2',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=128, mask=MaskBerSANS)
+    AIntcv2.showresults()
+    AIntscipy = SASazimuthal(DetCounts,mode='scipy',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=360, mask=MaskBerSANS)
+    AIntscipy.showresults()
+    AIntpolarTransform = SASazimuthal(DetCounts,mode='polarTransform',center=[61.3,62.42], Rrange=[45,50], order=0, polarres=360, mask=MaskBerSANS)
+    AIntpolarTransform.showresults()
+    AIntmeshgrid = SASazimuthal(DetCounts,mode='meshgrid',center=[61.3,62.42], Rrange=[45,50],polarres=360, mask=MaskBerSANS)
+    AIntmeshgrid.showresults()
+    AIntmeshgrid = SASazimuthal(DetCounts,mode='pyFAI',center=[61.3,62.42], Rrange=[45,50],polarres=180, pixelsize=[7.5,7.5], distance=ThisData.BerSANS["%Setup,SD"], mask=MaskBerSANS)
+    AIntmeshgrid.showresults()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'io_tools')))
+
+import h5py
+import numpy as np
+import pytest
+
+import PSISANS1toHMI
+import SASformats
+
+datafile = os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf')
+
+
+def test_tof_run_is_rejected_without_reading_counts(tmp_path, monkeypatch):
+    tofile = str(tmp_path / 'tof.hdf')
+    shutil.copy(datafile, tofile)
+    with h5py.File(tofile, 'r+') as HDF:
+        del HDF['entry1/SANS/detector/counts']
+        HDF['entry1/SANS/detector/counts'] = np.ones((128, 128, 4), dtype=np.uint32)
+
+    def no_sum(self, *args, **kwargs):
+        raise AssertionError('the TOF cube was read')
+    monkeypatch.setattr(SASformats.HDFLazyArray, 'sum', no_sum)
+    with pytest.raises(RuntimeError, match='TOF'):
+        PSISANS1toHMI.rawhdf2hmi(tofile, str(tmp_path / 'D0000001.001'))
+    assert not os.path.exists(str(tmp_path / 'D0000001.001'))
+
+
+def test_raw_run_is_converted(tmp_path):
+    PSISANS1toHMI.rawhdf2hmi(datafile, str(tmp_path / 'D0021192.001'))
+    Data = SASformats.SANSdata(str(tmp_path / 'D0021192.001'))
+    assert Data.BerSANS['%File,Type'] == 'SANSDRaw'
+    assert Data.BerSANS['%Counts,DetCounts'].sum() == SASformats.SANSdata(datafile).BerSANS['%Counter,Sum']
+
+
+def test_raw_run_is_read_once(tmp_path, monkeypatch):
+    opened = []
+
+    class CountingSANSdata(SASformats.SANSdata):
+        def __init__(self, *args, **kwargs):
+            opened.append(args)
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(PSISANS1toHMI, 'SANSdata', CountingSANSdata)
+    PSISANS1toHMI.rawhdf2hmi(datafile, str(tmp_path / 'D0021192.001'))
+    assert len(opened) == 1
+
+
+def expected_lines():
+    # written by the baseline rawhdf2hmi, which wrote the file line by line
+    with open(os.path.join(os.path.dirname(__file__), 'expected', 'sans2023n021192.001'), 'rb') as f:
+        return f.read().splitlines(keepends=True)
+
+
+def test_raw_run_expected_bytes(tmp_path):
+    PSISANS1toHMI.rawhdf2hmi(datafile, str(tmp_path / 'D0000001.001'))
+    with open(str(tmp_path / 'D0000001.001'), 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    expected = expected_lines()
+    assert expected[2] == b'FileName=D0021192\n'
+    assert lines[2] == b'FileName=D0000001\n'
+    assert lines[:2]+lines[3:] == expected[:2]+expected[3:]
+
+
+def test_raw_run_expected_bytes_with_transmission(tmp_path):
+    with open(str(tmp_path / 'trans.dat'), 'w') as f:
+        f.write('Transmissions\nheader\nheader\n21190, K-0, 0.8123\n21191, EC, 0.95\n')
+    PSISANS1toHMI.rawhdf2hmi(datafile, str(tmp_path / 'D0021192.001'), Tfiles={'0.5': str(tmp_path / 'trans.dat')},
+                             thickness={'K-0': 1.5})
+    with open(str(tmp_path / 'D0021192.001'), 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    expected = expected_lines()
+    history = expected.index(b'%History\n')
+    assert expected[history+1:history+4] == [b'Attenuation=1\n', b'Probability=0\n', b'Scaling=0.2\n']
+    expected[history+1:history+4] = [b'Transmission=0.8123\n', b'Attenuation=1\n', b'Probability=0\n', b'Scaling=0.15\n']
+    assert lines == expected
@@ -0,0 +1,36 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools')))
+
+import numpy as np
+import pytest
+
+from SANS1utils import EfficiencyCorrection
+
+
+def reference(counts, errors, efficiency, efficiency_error):
+    I = counts/efficiency
+    return I, np.sqrt((errors/efficiency)**2+(I*efficiency_error/efficiency)**2)
+
+
+def test_correct_strided_stack_in_place():
+    rng = np.random.default_rng(3)
+    efficiency = rng.uniform(0.8, 1.2, (4, 4))
+    efficiency_error = rng.uniform(0.01, 0.02, (4, 4))
+    corr = EfficiencyCorrection(efficiency=efficiency, efficiency_error=efficiency_error)
+    counts = np.full((3, 2, 4, 4), 8.).transpose(1, 0, 2, 3)
+    I, dI = reference(counts, np.sqrt(counts), efficiency, efficiency_error)
+    corrected, errors = corr.correct(counts)
+    assert corrected is counts
+    assert np.allclose(counts, I)
+    assert np.allclose(errors, dI)
+
+
+def test_correct_rejects_before_writing():
+    corr = EfficiencyCorrection(efficiency=np.full((4, 4), 0.5))
+    counts = np.full((2, 4, 4), 8.)
+    with pytest.raises(RuntimeError):
+        corr.correct(counts, np.ones((2, 4, 4), dtype=np.int64))
+    with pytest.raises(RuntimeError):
+        corr.correct(counts, np.ones((3, 4, 4)))
+    assert np.all(counts == 8.)
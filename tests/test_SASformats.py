@@ -0,0 +1,274 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'io_tools')))
+
+import h5py
+import numpy as np
+import pytest
+
+from SASformats import HDFLazyArray
+
+
+def lazy_array(tmp_path, data, **kwargs):
+    filename = str(tmp_path / 'counts.hdf')
+    with h5py.File(filename, 'w') as HDF:
+        HDF.create_dataset('entry1/SANS/detector/counts', data=data, **kwargs)
+    return HDFLazyArray(filename, 'entry1/SANS/detector/counts')
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'chunks': (4, 4), 'compression': 'gzip'}])
+def test_array_copy_does_not_change_cache(tmp_path, kwargs):
+    data = np.arange(64, dtype=np.float64).reshape(8, 8)
+    proxy = lazy_array(tmp_path, data, **kwargs)
+    first = np.array(proxy)
+    first[:] = -1
+    np.array(proxy, copy=True)[0, 0] = -1
+    proxy[:2, :2][:] = -1
+    assert np.array_equal(np.asarray(proxy), data)
+    assert np.array_equal(proxy[:, 3], data[:, 3])
+    assert np.array_equal(np.array(proxy), data)
+
+
+def test_array_dtype_and_copy_false(tmp_path):
+    data = np.arange(16, dtype=np.uint32).reshape(4, 4)
+    proxy = lazy_array(tmp_path, data)
+    assert np.array(proxy, dtype=np.float64).dtype == np.float64
+    assert np.asarray(proxy, dtype=np.uint32) is np.asarray(proxy)
+    with pytest.raises(ValueError):
+        np.asarray(proxy, dtype=np.float64, copy=False)
+
+
+@pytest.mark.parametrize('ntof, tof, edges', [(1, [2.5], [2.0, 3.0]),
+                                              (3, [1.0, 2.0, 3.0], [0.5, 1.5, 2.5, 3.5]),
+                                              (3, [0.0, 1.0, 2.0, 3.0], [0.0, 1.0, 2.0, 3.0]),
+                                              (2, None, [0.0, 1.0, 2.0])])
+def test_tof_edges(tmp_path, ntof, tof, edges):
+    from SASformats import SANSdata
+    with h5py.File(str(tmp_path / 'tof.hdf'), 'w') as HDF:
+        if tof is not None:
+            HDF['entry1/SANS/detector/time_of_flight'] = tof
+        TOF = SANSdata.getSANS1tof(HDF, ntof)
+    assert TOF['%File,DataSizeTOF'] == ntof
+    assert np.allclose(TOF['%Counts,TOFEdges'], edges)
+
+
+@pytest.mark.parametrize('chunks', [(16, 16, 400), (16, 16, 8), None])
+def test_iter_channels_block_size(tmp_path, chunks):
+    data = np.random.default_rng(4).poisson(2, (128, 128, 400)).astype(np.int32)
+    kwargs = {'chunks': chunks, 'compression': 'gzip'} if chunks else {}
+    proxy = lazy_array(tmp_path, data, **kwargs)
+    blocksize = 2**20
+    blocks = list(proxy.iter_channels(blocksize))
+    assert all(block.nbytes <= blocksize for start, block in blocks)
+    assert [start for start, block in blocks] == list(range(0, 400, blocks[0][1].shape[2]))
+    assert np.array_equal(np.concatenate([block for start, block in blocks], axis=2), data)
+    assert proxy.sum(blocksize) == data.sum()
+
+
+def utf8_copy(tmp_path, name):
+    # the user name in the headers of data/ is latin-1, read_Ascii expects utf-8
+    with open(os.path.join(os.path.dirname(__file__), '..', 'data', name), encoding='latin-1') as f:
+        text = f.read()
+    filename = str(tmp_path / name)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return filename
+
+
+def expected(name):
+    return os.path.join(os.path.dirname(__file__), 'expected', name)
+
+
+@pytest.mark.parametrize('fmt, LineSkip', [('xye', 42), ('xy', 42), ('xy', 0)])
+@pytest.mark.parametrize('chunksize', [5, 7, 1000])
+def test_iter_Ascii_equals_read_Ascii(tmp_path, fmt, LineSkip, chunksize):
+    from SASformats import create_ASCIIData, iter_Ascii, read_Ascii
+    filename = utf8_copy(tmp_path, 'D0021192.020')
+    data = create_ASCIIData()
+    data.InputFormat, data.LineSkip = fmt, LineSkip
+    status, data = read_Ascii(filename, data)
+    assert status == 1
+    chunks = create_ASCIIData()
+    chunks.InputFormat, chunks.LineSkip = fmt, LineSkip
+    x, y, e, res = (np.concatenate(c) for c in zip(*iter_Ascii(filename, chunks, chunksize=chunksize)))
+    assert len(x) == data.npoints == chunks.npoints == 82
+    assert np.array_equal(x, data.x)
+    assert np.array_equal(y, data.y)
+    assert np.allclose(e, data.e, rtol=1e-12)
+    assert np.array_equal(res, data.res)
+    assert chunks.Comment == data.Comment
+
+
+def test_iter_Ascii_errors(tmp_path):
+    from SASformats import create_ASCIIData, iter_Ascii
+    filename = str(tmp_path / 'short.dat')
+    with open(filename, 'w') as f:
+        f.write('header\n1 2 3\n')
+    data = create_ASCIIData()
+    data.LineSkip = 5
+    with pytest.raises(EOFError):
+        list(iter_Ascii(filename, data))
+    with pytest.raises(FileNotFoundError):
+        list(iter_Ascii(str(tmp_path / 'missing.dat')))
+
+
+def write_transmissions(filename, transmissions):
+    with open(filename, 'w') as f:
+        f.write('header\nheader\nheader\n')
+        for i, (name, T) in enumerate(transmissions.items()):
+            f.write(f'{i}, {name}, {T}\n')
+
+
+def test_transmission_tables_are_copies(tmp_path):
+    from SASformats import TransmissionStore
+    filename = str(tmp_path / 'trans5A.txt')
+    write_transmissions(filename, {'H2O': 0.5, 'K-0': 0.8})
+    store = TransmissionStore({0.5: filename})
+    store.transmissions(0.5)['H2O'] = '1.0'
+    store.table(filename).clear()
+    assert store.transmissions(0.51) == {'H2O': '0.5', 'K-0': '0.8'}
+    assert store.lookup(['K-0', 'D2O'], [0.5, 0.5]) == ['0.8', None]
+
+
+def test_transmission_store_is_bounded(tmp_path):
+    from SASformats import TransmissionStore
+    Tfiles = {}
+    for i in range(5):
+        Tfiles[0.5+i] = str(tmp_path / f'trans{i}.txt')
+        write_transmissions(Tfiles[0.5+i], {'H2O': i})
+    store = TransmissionStore(Tfiles, maxfiles=3)
+    assert len(store.tables) == 3
+    assert store.transmissions(0.5) == {'H2O': '0'}
+    assert os.path.abspath(Tfiles[0.5]) in store.tables
+    assert os.path.abspath(Tfiles[1.5]) not in store.tables
+    store.clear()
+    assert not store.tables
+    assert store.transmissions(4.5) == {'H2O': '4'}
+
+
+def test_line_fit_with_very_different_errors():
+    from SASformats import WavelengthCalibration
+    coefficients, covariance, chi2 = WavelengthCalibration.line_fit([4000.0, 8000.0], [7.1, 14.0], [3e-17, 3e-7])
+    assert np.allclose(coefficients, [0.2, 6.9/4000], rtol=1e-12)
+    assert np.all(np.diag(covariance) > 0)
+    x = np.array([1.0, 2.0, 3.0, 4.0])
+    coefficients, covariance, chi2 = WavelengthCalibration.line_fit(x, 1+2*x+np.array([0.1, -0.1, -0.1, 0.1]), np.ones(4))
+    A = np.column_stack((np.ones_like(x), x))
+    assert np.allclose(covariance, np.linalg.inv(A.T @ A))
+    assert np.allclose(coefficients, np.linalg.lstsq(A, 1+2*x+np.array([0.1, -0.1, -0.1, 0.1]), rcond=None)[0])
+    assert np.isclose(chi2, 0.04)
+
+
+def test_read_Ascii_expected_values(tmp_path):
+    from SASformats import create_ASCIIData, read_Ascii
+    filename = utf8_copy(tmp_path, 'D0021192.020')
+    data = create_ASCIIData()
+    data.InputFormat, data.LineSkip, data.in_out = 'xyer', 42, 'Ångström^-1->nm^-1'
+    status, data = read_Ascii(filename, data)
+    assert status == 1
+    x, y, e, res = np.loadtxt(expected('D0021192.020.xyer'), unpack=True)
+    assert data.npoints == 82
+    assert np.array_equal(data.x, x)
+    assert np.array_equal(data.y, y)
+    assert np.array_equal(data.e, e)
+    assert np.array_equal(data.res, res)
+    assert data.res_available == 1
+    with open(filename) as f:
+        assert data.Comment == [next(f).rstrip() for i in range(42)]
+    assert data.unit == 'nm^-1'
+
+
+@pytest.mark.parametrize('nonneg, zero_int_chkb, accepted, comment', [
+    (0, False, [0, 1, 2, 4, 5], ['foo bar baz qux', '4.0, 5.0, 0, 0.5', '5.0 6.0 0.2']),
+    (0, True, [0, 1, 4, 5], ['4.0, 5.0, 0, 0.5', '5.0 6.0 0.2']),
+    (1, False, [0, 2, 4, 5], ['2.0 -1.0 0.1 0.5', 'foo bar baz qux', '4.0, 5.0, 0, 0.5', '5.0 6.0 0.2']),
+    (1, True, [0, 4, 5], ['2.0 -1.0 0.1 0.5', '4.0, 5.0, 0, 0.5', '5.0 6.0 0.2']),
+])
+def test_read_Ascii_rejected_lines(tmp_path, nonneg, zero_int_chkb, accepted, comment):
+    from SASformats import create_ASCIIData, read_Ascii
+    filename = str(tmp_path / 'mixed.dat')
+    with open(filename, 'w') as f:
+        f.write('%Counts\n1.0, 2.0, 0.1, 0.5\n\n  2.0   -1.0  0.1 0.5\n3.0, 0.0, 0.1, 0.5\nfoo bar baz qux\n'
+                '4.0, 5.0, 0, 0.5\n5.0 6.0 0.2\n6.0, 7.0, 0.3, 0.1, extra\n7.0\t8.0\t0.4\t0.2\n')
+    data = create_ASCIIData()
+    data.InputFormat, data.nonneg, data.zero_int_chkb = 'xyer', nonneg, zero_int_chkb
+    status, data = read_Ascii(filename, data)
+    assert status == 1
+    # x y e res of the lines which can be parsed
+    table = np.array([[1.0, 2.0, 0.1, 0.5], [2.0, -1.0, 0.1, 0.5], [3.0, 0.0, 0.1, 0.5],
+                      [4.0, 5.0, 0.0, 0.5], [6.0, 7.0, 0.3, 0.1], [7.0, 8.0, 0.4, 0.2]])
+    assert np.array_equal(np.column_stack([data.x, data.y, data.e, data.res]), table[accepted])
+    assert data.Comment == ['%Counts']+comment
+
+
+@pytest.mark.parametrize('blocksize', [5, 65536])
+def test_sasfit_guess_err_expected_values(tmp_path, blocksize, monkeypatch):
+    import SASformats
+    # the expected errors were computed with one polynomial fit per window
+    q, I = np.genfromtxt(utf8_copy(tmp_path, 'D0021192.020'), delimiter=',', skip_header=42, usecols=(0, 1), unpack=True)
+    err = np.loadtxt(expected('D0021192.020.guess_err'), unpack=True)
+    chisq = SASformats._guess_err_chisq
+    monkeypatch.setattr(SASformats, '_guess_err_chisq', lambda xw, yw, ncoeffs: chisq(xw, yw, ncoeffs, blocksize))
+    assert np.allclose(SASformats.sasfit_guess_err(3, 2, q, I), err[0], rtol=1e-10, atol=0)
+    assert np.allclose(SASformats.sasfit_guess_err(3, 2, np.arange(len(I)), I), err[1], rtol=1e-10, atol=0)
+    assert np.allclose(SASformats.sasfit_guess_err(5, 3, q, I), err[2], rtol=1e-10, atol=0)
+    data = SASformats.create_ASCIIData()
+    data.InputFormat, data.LineSkip = 'xy', 42
+    status, data = SASformats.read_Ascii(utf8_copy(tmp_path, 'D0021192.020'), data)
+    assert np.allclose(data.e, err[0], rtol=1e-10, atol=0)
+
+
+@pytest.mark.parametrize('name', ['D0021192.001', 'D0021179.001', 'D0021192.002', 'D0021192.020', '2m.sma', '8m.sma', '18m.sma'])
+def test_BerSANS_expected_values(tmp_path, name):
+    import json
+    from SASformats import SANSdata
+    # written by the baseline line-by-line decoder of the %Counts, %Errors and %Mask sections
+    with open(expected('BerSANS.json'), encoding='utf-8') as f:
+        headers = json.load(f)[name]
+    with np.load(expected('BerSANS.npz')) as npz:
+        arrays = {key.split('/', 1)[1]: npz[key] for key in npz.files if key.startswith(name+'/')}
+    BerSANS = SANSdata(utf8_copy(tmp_path, name)).BerSANS
+    assert set(BerSANS) == set(headers) | set(arrays)
+    assert {key: BerSANS[key] for key in headers} == headers
+    for key, value in arrays.items():
+        assert BerSANS[key].dtype == value.dtype
+        assert np.array_equal(BerSANS[key], value)
+
+
+def hdf_expected_values():
+    import json
+    # written by the baseline getSANS1hdf with one explicit lookup per entry
+    with open(expected('sans2023n021192.json'), encoding='utf-8') as f:
+        headers = json.load(f)
+    with np.load(expected('sans2023n021192.npz')) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    return headers, arrays
+
+
+def assert_headers_equal(BerSANS, headers):
+    for key, (typename, value) in headers.items():
+        assert type(BerSANS[key]).__name__ == typename, key
+        assert BerSANS[key] == value or (np.isnan(value) and np.isnan(BerSANS[key])), key
+
+
+def test_SANS1hdf_expected_values():
+    from SASformats import SANSdata
+    headers, arrays = hdf_expected_values()
+    BerSANS = SANSdata(os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf')).BerSANS
+    assert set(BerSANS) == set(headers) | set(arrays)
+    assert_headers_equal(BerSANS, headers)
+    for key, value in arrays.items():
+        assert BerSANS[key].dtype == value.dtype
+        assert np.array_equal(BerSANS[key], value)
+
+
+def test_SANS1hdf_lazy_expected_values():
+    from SASformats import SANSdata
+    headers, arrays = hdf_expected_values()
+    S = SANSdata(os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf'), lazy=True)
+    counters = {key for key in headers if key.startswith('%Counter,Sum')}
+    assert set(S.BerSANS) == (set(headers) - counters) | set(arrays)
+    S.addCounterSums()
+    assert_headers_equal(S.BerSANS, headers)
+    assert isinstance(S.BerSANS['%Counts,DetCounts'], HDFLazyArray)
+    assert np.array_equal(np.asarray(S.BerSANS['%Counts,DetCounts']), arrays['%Counts,DetCounts'])
@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'io_tools')))
+
+import h5py
+import numpy as np
+
+import SASformats
+from catalog import SANScatalog
+from SASformats import SANSdata
+
+datafile = os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf')
+
+
+def test_counter_sums_are_indexed(tmp_path):
+    shutil.copy(datafile, tmp_path)
+    Data = SANSdata(datafile)
+    with SANScatalog(str(tmp_path / 'runs.sqlite')) as cat:
+        assert cat.update(str(tmp_path), '*.hdf') == 1
+        path = os.path.abspath(str(tmp_path / 'sans2023n021192.hdf'))
+        for key in ('%Counter,Sum', '%Counter,Sum/Time', '%Counter,Sum/Moni1', '%Counter,Sum/Moni2'):
+            assert cat.query({key: float(Data.BerSANS[key])}) == [path]
+        assert cat.query({'%Counter,Sum': float(Data.BerSANS['%Counter,Sum'])+100}) == []
+        assert cat.entries(path, ['%Counter,Sum']) == {'%Counter,Sum': f"{Data.BerSANS['%Counter,Sum']}"}
+
+
+def test_tof_runs_are_indexed_without_reading_counts(tmp_path, monkeypatch):
+    tofile = str(tmp_path / 'tof.hdf')
+    shutil.copy(datafile, tofile)
+    with h5py.File(tofile, 'r+') as HDF:
+        del HDF['entry1/SANS/detector/counts']
+        HDF['entry1/SANS/detector/counts'] = np.ones((128, 128, 4), dtype=np.uint32)
+
+    def no_sum(self, *args, **kwargs):
+        raise AssertionError('the TOF cube was read')
+    monkeypatch.setattr(SASformats.HDFLazyArray, 'sum', no_sum)
+    with SANScatalog(str(tmp_path / 'runs.sqlite')) as cat:
+        assert cat.update(str(tmp_path), '*.hdf') == 1
+        assert cat.failed() == {}
+        entries = cat.entries(tofile)
+        assert entries['%File,DataSizeTOF'] == '4'
+        assert '%Counter,Sum' not in entries
+
+
+def test_entries_keep_numeric_looking_strings(tmp_path):
+    shutil.copy(datafile, tmp_path)
+    with h5py.File(str(tmp_path / 'sans2023n021192.hdf'), 'r+') as HDF:
+        HDF['entry1/sample/name'][0] = b'007'
+    with SANScatalog(str(tmp_path / 'runs.sqlite')) as cat:
+        cat.update(str(tmp_path), '*.hdf', index_sums=False)
+        path = str(tmp_path / 'sans2023n021192.hdf')
+        assert cat.entries(path)['%Sample,SampleName'] == '007'
+        assert '%Counter,Sum' not in cat.entries(path)
+        assert cat.query({'%Sample,SampleName': '007'}) == [os.path.abspath(path)]
@@ -0,0 +1,144 @@
+import os
+import sys
+# fit_helpers is imported from the package, i.e. the checkout needs to be named pySASfit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import h5py
+import numpy as np
+import pytest
+
+fit_helpers = pytest.importorskip('pySASfit.io_tools.fit_helpers')
+
+
+def write_tof(filename, counts):
+    with h5py.File(filename, 'w') as HDF:
+        HDF.create_dataset('entry1/SANS/detector/counts', data=counts, chunks=(16, 16, counts.shape[2]),
+                           compression='gzip')
+
+
+def test_read_files_sumtof_keeps_the_number_of_channels(tmp_path):
+    rng = np.random.default_rng(5)
+    counts = [rng.poisson(3, (128, 128, ntof)).astype(np.uint32) for ntof in (20, 12)]
+    filenames = [str(tmp_path / f'tof{i}.hdf') for i in range(2)]
+    for filename, c in zip(filenames, counts):
+        write_tof(filename, c)
+    sums = fit_helpers.read_files_sumtof(filenames, processes=1)
+    assert [len(s) for s in sums] == [20, 12]
+    for s, c in zip(sums, counts):
+        assert np.array_equal(s, c.sum(axis=(0, 1)))
+    with pytest.raises(RuntimeError, match='missing.hdf'):
+        fit_helpers.read_files_sumtof(filenames+[str(tmp_path / 'missing.hdf')], processes=1)
+    table, status = fit_helpers.sum_tof_files(filenames, processes=1)
+    assert table.shape == (2, 20)
+    assert np.isnan(table[1, 12:]).all()
+
+
+def write_tof_run(filename, rpm, collimation, spectrum):
+    datafile = os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf')
+    with h5py.File(datafile, 'r') as source, h5py.File(filename, 'w') as HDF:
+        for name in source:
+            source.copy(name, HDF)
+        del HDF['entry1/SANS/detector/counts']
+        counts = np.zeros((128, 128, len(spectrum)), dtype=np.uint32)
+        counts[64, 64] = spectrum
+        HDF.create_dataset('entry1/SANS/detector/counts', data=counts, chunks=(16, 16, len(spectrum)),
+                           compression='gzip')
+        HDF['entry1/SANS/Dornier-VS/rotation_speed'][0] = rpm
+        HDF['entry1/SANS/collimator/length'][0] = collimation
+
+
+def chopper_scan(tmp_path, collimations, a=0.01, b=8000.0, t0=0.3):
+    """TOF runs with lambda = a + b/rpm in nm, a chopper time offset t0 in
+    ms, DL/L = 10% and Poisson noise."""
+    from scipy import constants
+    from pySASfit.io_tools.fit_triangle import triangle_model
+    K = constants.Planck / constants.neutron_mass / constants.nano
+    rng = np.random.default_rng(6)
+    tof = 0.05 + 0.1*np.arange(200)
+    filenames = []
+    for rpm in (12000, 15000, 18000, 21000, 24000):
+        for collimation in collimations:
+            center = 1000.0*collimation*(a + b/rpm)/K + t0
+            spectrum = rng.poisson(triangle_model(tof, center, 0.2*center, 1e5, 100.0))
+            filenames.append(str(tmp_path / f'tof_{rpm}_{collimation}.hdf'))
+            write_tof_run(filenames[-1], rpm, collimation, spectrum)
+    return filenames, tof
+
+
+def test_calibrate_wavelength(tmp_path):
+    filenames, tof = chopper_scan(tmp_path, (8, 4))
+    calfile = str(tmp_path / 'lambda_calibration.txt')
+    calibration, runs, status = fit_helpers.calibrate_wavelength(filenames, tof=tof, processes=1,
+                                                                  calibration_file=calfile)
+    assert [st for fn, st, msg in status] == ['fitted']*len(filenames)
+    assert np.allclose(calibration.coefficients, [0.01, 8000.0], rtol=1e-3, atol=5e-4)
+    assert np.allclose(calibration.table['DL/L'], 0.1, rtol=1e-2)
+    assert np.all(calibration.table['npaths'] == 2)
+    assert np.all(calibration.table['nruns'] == 2)
+    assert np.array_equal(np.unique(runs['L']), [4000.0, 8000.0])
+    assert np.all(np.isnan(runs['SD']))
+    loaded = fit_helpers.WavelengthCalibration.load(calfile)
+    assert np.allclose(loaded.coefficients, calibration.coefficients, rtol=1e-9)
+    assert np.allclose(loaded.covariance, calibration.covariance, rtol=1e-9)
+    for name in loaded.table.dtype.names:
+        assert np.allclose(loaded.table[name], calibration.table[name], rtol=1e-9)
+    assert np.allclose(loaded.wavelength(18000)[0], 0.01+8000.0/18000, rtol=2e-3)
+
+
+def test_calibrate_wavelength_single_flight_path(tmp_path):
+    filenames, tof = chopper_scan(tmp_path, (8,))
+    with pytest.warns(UserWarning, match='single flight path'):
+        calibration, runs, status = fit_helpers.calibrate_wavelength(filenames, tof=tof, processes=1)
+    assert np.all(calibration.table['npaths'] == 1)
+
+
+def old_fit_triangle(x, y):
+    """Per-spectrum fit of the former fit_stack: guess of the old
+    fit_triangle and curve_fit with a numerical Jacobian."""
+    from scipy.optimize import curve_fit
+    from pySASfit.io_tools.fit_triangle import triangle_model
+    y = y/np.max(y)
+    peak = np.max(y)
+    baseline0 = np.percentile(y, 5)
+    amp0 = peak-baseline0
+    xs = x[y > baseline0+amp0/2.0]
+    width0 = (xs.max()-xs.min())*1.5 if xs.size > 1 else max(1.0, (x.max()-x.min())/10.0)
+    p0 = (x[np.argmax(y)], width0, amp0, baseline0)
+    bounds = ([x.min(), 1e-8, -np.inf, -np.inf], [x.max(), x.max()-x.min()+1e-8, np.inf, np.inf])
+    popt, pcov = curve_fit(triangle_model, x, y, p0=p0, bounds=bounds)
+    return popt, np.sqrt(np.diag(pcov))
+
+
+def test_fit_spectra_matches_per_spectrum_fits():
+    from scipy import constants
+    from pySASfit.io_tools.fit_triangle import triangle_model
+    rng = np.random.default_rng(9)
+    tof = np.linspace(0, 20, 161)
+    spectra = [rng.poisson(triangle_model(tof, c, w, 5e3, 50.0)).astype(float)
+               for c, w in zip(rng.uniform(6, 14, 12), rng.uniform(1, 4, 12))]
+    spectra[3][10:20] = np.nan
+    labels = [f'run{i}' for i in range(len(spectra))]
+    result = fit_helpers.fit_spectra(spectra, labels, tof=tof, L=8000.0, processes=1)
+    assert result['success'].all()
+    K = constants.Planck/constants.neutron_mass/constants.nano
+    for row, y in zip(result, spectra):
+        ok = np.isfinite(y)
+        x, norm = tof[ok], y[ok]/np.max(y[ok])
+        popt, perr = old_fit_triangle(x, y[ok])
+        fitted = np.array([row[name] for name in ('center', 'width', 'amplitude', 'baseline')])
+        errors = np.array([row[name+'_err'] for name in ('center', 'width', 'amplitude', 'baseline')])
+        # the piecewise linear model has kinks at the samples, so both fits
+        # may stop at slightly different points of the same minimum: they
+        # must agree to a fraction of the fit error and the new fit must not
+        # end up with a larger chi^2
+        assert np.all(np.abs(fitted-popt) <= 0.25*perr)
+        assert np.allclose(errors, perr, rtol=0.05)
+        chi2 = np.sum((triangle_model(x, *fitted)-norm)**2)
+        assert chi2 <= np.sum((triangle_model(x, *popt)-norm)**2)*(1+1e-9)
+        assert np.isclose(row['lambda'], row['center']/8000.0*K, rtol=1e-12)
+        assert np.isclose(row['DL/L'], row['width']/row['center']/2.0, rtol=1e-12)
+    results = fit_helpers.fit_stack(spectra, labels, tof=tof, L=8000.0)
+    assert [r['name'] for r in results] == labels
+    assert set(results[0]) == {'name', 'center', 'width', 'rpm', 'lambda', 'lambda_err', 'DL/L', 'DL/L_err', 'SD'}
+    assert [r['rpm'] for r in results] == [12000+2000*i for i in range(len(spectra))]
+    assert np.allclose([r['center'] for r in results], result['center'])
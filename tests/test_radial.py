@@ -0,0 +1,57 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'io_tools')))
+
+import numpy as np
+import pytest
+
+from radial import RadialAverager, writeBerSANSIso
+from SASformats import SANSdata
+
+datafile = os.path.join(os.path.dirname(__file__), '..', 'data', 'sans2023n021192.hdf')
+
+
+@pytest.mark.parametrize('RadialSteps', [1.0, 2.5])
+def test_ring_average_against_pixel_loop(RadialSteps):
+    rng = np.random.default_rng(8)
+    counts = rng.poisson(30, (48, 48)).astype(np.float64)
+    mask = np.zeros(counts.shape, dtype=bool)
+    mask[20:28, 30:40] = True
+    center, SD, Lambda, pixelsize = [22.7, 25.1], 4.0, 0.6, (7.5, 5.0)
+    averager = RadialAverager(counts.shape, center, SD, Lambda, pixelsize, mask, RadialSteps)
+    step = RadialSteps*min(pixelsize)
+    rings = {}
+    for row in range(counts.shape[0]):
+        for col in range(counts.shape[1]):
+            if mask[row, col]:
+                continue
+            r = np.hypot((col-center[0])*pixelsize[0], (counts.shape[1]-1-center[1]-row)*pixelsize[1])
+            rings.setdefault(int(r/step), []).append(counts[row, col])
+    k = np.array(sorted(rings))
+    Q, I, dI, dQ = averager.average(counts)
+    assert np.allclose(Q, 4*np.pi/Lambda*np.sin(0.5*np.arctan(step*(k+0.5)/(1000*SD))))
+    assert np.allclose(I, [np.mean(rings[i]) for i in k])
+    assert np.allclose(dI, [np.sqrt(np.sum(rings[i]))/len(rings[i]) for i in k])
+    assert np.all(dQ > 0)
+    Qs, Is, dIs, dQs = averager.average(np.stack([counts, 2*counts]))
+    assert Is.shape == (2, len(k))
+    assert np.allclose(Is[1], 2*I)
+
+
+def test_writeBerSANSIso_round_trip(tmp_path):
+    Data = SANSdata(datafile)
+    BerSANS = Data.BerSANS
+    counts = np.asarray(BerSANS['%Counts,DetCounts'], dtype=np.float64)
+    averager = RadialAverager(counts.shape, [61.3, 62.42], BerSANS['%Setup,SD'], BerSANS['%Setup,Lambda'])
+    Q, I, dI, dQ = averager.average(counts)
+    filename = str(tmp_path / 'D0021192.020')
+    writeBerSANSIso(filename, BerSANS, Q, I, dI, dQ, {'BeamcenterX': '61.30', 'MaskFile': ''})
+    Iso = SANSdata(filename).BerSANS
+    assert Iso['%File,Type'] == 'SANSDIso'
+    assert Iso['%File,FileName'] == 'D0021192.020'
+    assert Iso['%History,BeamcenterX'] == '61.30'
+    for key in ('%Sample,SampleName', '%Setup,SD', '%Setup,Lambda', '%Setup,Collimation'):
+        assert Iso[key] == f'{BerSANS[key]}'
+    # the values are written with 4 significant digits
+    for key, values in (('Qdata', Q), ('Idata', I), ('Edata', dI), ('Rdata', dQ)):
+        assert np.allclose(Iso[f'%Counts,{key}'], values, rtol=5e-4, atol=0)
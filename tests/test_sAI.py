@@ -0,0 +1,189 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'io_tools')))
+# smoothing for fit_MaierSaupe
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools')))
+
+import numpy as np
+import pytest
+
+from sAI import SASazimuthal
+
+
+def anisotropic_pattern(shape=(128, 128), center=(61.3, 62.42), offset=30):
+    row, col = np.indices(shape)
+    psi = np.degrees(np.arctan2(shape[1]-1-center[1]-row, col-center[0]))
+    return 1000*(1+0.8*np.cos(np.radians(psi-offset))**2)
+
+
+def test_sparse_agrees_with_meshgrid():
+    data = anisotropic_pattern()
+    sparse = SASazimuthal(data, mode='sparse', center=[61.3, 62.42], Rrange=[30, 50], polarres=360, fit=False)
+    meshgrid = SASazimuthal(data, mode='meshgrid', center=[61.3, 62.42], Rrange=[30, 50], polarres=360, fit=False)
+    assert sparse.polarimg.shape == meshgrid.polarimg.shape
+    assert np.array_equal(sparse.psi, meshgrid.psi)
+    # the meshgrid mode samples single pixels along rays, 2% covers its
+    # pixel and angle discretization for 1 degree slices
+    assert np.allclose(sparse.Ipsi, meshgrid.Ipsi, rtol=0.02)
+    psi, Ipsi, DIpsi = SASazimuthal.stack(data, center=[61.3, 62.42], Rrange=[30, 50], polarres=360)
+    assert np.allclose(Ipsi[0], sparse.Ipsi)
+
+
+def test_stack_of_a_single_frame():
+    rng = np.random.default_rng(1)
+    frame = rng.poisson(100, (64, 64)).astype(np.float64)
+    psi, Ipsi, DIpsi = SASazimuthal.stack(frame, center=[31.5, 32.5], Rrange=[10, 20], polarres=90)
+    psi3, Ipsi3, DIpsi3 = SASazimuthal.stack(frame[np.newaxis], center=[31.5, 32.5], Rrange=[10, 20], polarres=90)
+    assert Ipsi.shape == (1, 90)
+    assert np.array_equal(Ipsi, Ipsi3)
+    assert np.array_equal(DIpsi, DIpsi3)
+
+
+def test_azimuthal_average_pixel_binning():
+    # pixel by pixel reference of the documented binning convention
+    rng = np.random.default_rng(2)
+    data = rng.poisson(50, (40, 40)).astype(np.float64)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[5:12, 20:30] = True
+    zero, Rmin, Rmax, slices = (18.3, 21.7), 4, 15, 24
+    binned = [[] for n in range(slices)]
+    for row in range(data.shape[0]):
+        for col in range(data.shape[1]):
+            x = col-zero[0]
+            y = data.shape[1]-1-zero[1]-row
+            if mask[row, col] or not Rmin <= np.hypot(x, y) < Rmax:
+                continue
+            binned[int(np.rint(np.degrees(np.arctan2(y, x))/(360/slices))) % slices].append(data[row, col])
+    psi, average, st_dev = SASazimuthal.azimuthal_average(data, Rmin, Rmax, zero, slices, mask=mask)
+    assert np.allclose(psi, np.arange(slices)*360/slices)
+    assert np.allclose(average, [np.mean(b) for b in binned])
+    assert np.allclose(st_dev, [np.std(b) for b in binned])
+
+
+def test_azimuthal_average_st_dev_of_high_counts():
+    rng = np.random.default_rng(3)
+    data = 1e9+rng.normal(0, 1, (64, 64))
+    psi, average, st_dev = SASazimuthal.azimuthal_average(data, 5, 25, (31.5, 31.5), 8)
+    assert np.allclose(st_dev, 1, rtol=0.2)
+
+
+@pytest.mark.parametrize('mode, rtol', [('sparse', 0.005), ('meshgrid', 0.02), ('pyFAI', 0.02)])
+def test_azimuthal_average_agrees_with_polar_modes(mode, rtol):
+    if mode == 'pyFAI':
+        pytest.importorskip('pyFAI')
+    center, Rrange, slices = [61.3, 62.42], [30, 50], 360
+    row, col = np.indices((128, 128))
+    psi = np.degrees(np.arctan2(128-1-center[1]-row, col-center[0]))
+    data = 1000*(1+0.8*np.cos(np.radians(psi-30))**2)
+    psi, average, st_dev = SASazimuthal.azimuthal_average(data, Rrange[0], Rrange[1], center, slices)
+    polar = SASazimuthal(data, mode=mode, center=center, Rrange=Rrange, polarres=slices,
+                         distance=18.0, pixelsize=[7.5, 7.5], fit=False)
+    Ipsi = np.interp(psi, polar.psi, polar.Ipsi, period=360)
+    assert np.allclose(average*(Rrange[1]-Rrange[0]), Ipsi, rtol=rtol)
+
+
+@pytest.mark.parametrize('mode, backend', [('sparse', None), ('meshgrid', None), ('scipy', None),
+                                           ('cv2', 'cv2'), ('polarTransform', 'polarTransform'),
+                                           ('pyFAI', 'pyFAI')])
+def test_masked_pixels_are_excluded(mode, backend):
+    if backend is not None:
+        pytest.importorskip(backend)
+    data = anisotropic_pattern()
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[10:40, 70:100] = True
+    mask[60:70, :] = True
+    kwargs = dict(mode=mode, center=[61.3, 62.42], Rrange=[30, 50], polarres=180, fit=False,
+                  distance=18.0, pixelsize=[7.5, 7.5])
+    masked = SASazimuthal(data, mask=mask, **kwargs)
+    hot = SASazimuthal(np.where(mask, 1e9, data), mask=mask, **kwargs)
+    unmasked = SASazimuthal(data, **kwargs)
+    assert np.array_equal(masked.Ipsi, hot.Ipsi, equal_nan=True)
+    ok = np.isfinite(hot.Ipsi)
+    assert 0 < ok.sum() < len(ok)
+    assert np.allclose(hot.Ipsi[ok], unmasked.Ipsi[ok], rtol=0.02)
+    if mode == 'sparse':
+        psi, Ipsi, DIpsi = SASazimuthal.stack(np.where(mask, 1e9, data), center=[61.3, 62.42], Rrange=[30, 50],
+                                              polarres=180, mask=mask)
+        assert np.array_equal(Ipsi[0], hot.Ipsi, equal_nan=True)
+
+
+def numerical_jac(f, x, p, h=1e-6):
+    p = np.asarray(p, dtype=np.float64)
+    columns = []
+    for i in range(len(p)):
+        dp = np.zeros_like(p)
+        dp[i] = h*max(1.0, abs(p[i]))
+        columns.append((f(x, *(p+dp))-f(x, *(p-dp)))/(2*dp[i]))
+    return np.stack(columns, axis=-1)
+
+
+@pytest.mark.parametrize('p', [[100.0, 20.0, 3.0, 40.0], [-50.0, -5.0, -0.7, 170.0], [10.0, 1.0, 80.0, 95.0]])
+def test_MaierSaupe1_jac(p):
+    from sAI import MaierSaupe1, MaierSaupe1_jac
+    psi = np.linspace(0, 360, 181)
+    assert np.allclose(MaierSaupe1_jac(psi, *p), numerical_jac(MaierSaupe1, psi, p), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('p', [[100.0, 30.0, 20.0, 3.0, 0.5, 40.0], [-50.0, 10.0, -5.0, -0.7, 12.0, 170.0]])
+def test_MaierSaupe2_jac(p):
+    from sAI import MaierSaupe2, MaierSaupe2_jac
+    psi = np.linspace(0, 360, 181)
+    assert np.allclose(MaierSaupe2_jac(psi, *p), numerical_jac(MaierSaupe2, psi, p), rtol=1e-5, atol=1e-6)
+
+
+def test_MaierSaupe1_normalization():
+    from scipy import integrate
+    from sAI import MaierSaupe1
+    psi = np.linspace(0, 360, 73)
+    for kappa in (0.3, 5.0, 50.0):
+        norm = integrate.quad(lambda x: np.exp(kappa*np.cos(x)**2), 0, np.pi/2.)[0]
+        reference = 2.0+7.0*np.pi/(2.0*norm)*np.exp(kappa*np.cos((psi-25)*np.pi/180)**2)
+        assert np.allclose(MaierSaupe1(psi, 7.0, 2.0, kappa, 25), reference, rtol=1e-10)
+    assert np.all(np.isfinite(MaierSaupe1(psi, 7.0, 2.0, 2000.0, 25)))
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_orientation_matches_independent_fits(processes):
+    from sAI import MaierSaupe1, fit_MaierSaupe
+    rng = np.random.default_rng(7)
+    center = [31.3, 32.4]
+    row, col = np.indices((64, 64))
+    psi = np.degrees(np.arctan2(64-1-center[1]-row, col-center[0]))
+    # the orientation turns and sharpens from frame to frame
+    frames = np.array([rng.poisson(MaierSaupe1(psi, 400.0, 50.0, 2.0+0.2*i, 20+3*i)) for i in range(12)], dtype=float)
+    shells = [[8, 16], [16, 28]]
+    psi, table = SASazimuthal.orientation(frames, shells, center=center, polarres=90, processes=processes)
+    assert len(table) == len(frames)*len(shells)
+    assert table['success'].all()
+    for Rrange in shells:
+        psi, Ipsi, DIpsi = SASazimuthal.stack(frames, center=center, Rrange=Rrange, polarres=90)
+        rows = table[table['Rmin'] == Rrange[0]]
+        assert np.array_equal(rows['frame'], np.arange(len(frames)))
+        for row, I in zip(rows, Ipsi):
+            MSparameters, MScovariance, SMIpsi = fit_MaierSaupe(psi, I)
+            MSIpsi = MaierSaupe1(psi, *MSparameters)
+            assert np.isclose(row['offset'] % 180, MSparameters[3] % 180, rtol=1e-6)
+            assert np.isclose(row['kappa'], abs(MSparameters[2]), rtol=1e-6)
+            assert np.isclose(row['MSvisibility'], (np.max(MSIpsi)-np.min(MSIpsi))/np.average(MSIpsi), rtol=1e-6)
+            assert np.isclose(row['visibility'], (np.max(SMIpsi)-np.min(SMIpsi))/np.average(SMIpsi))
+
+
+def test_pyFAI_integrator_cache():
+    pytest.importorskip('pyFAI')
+    from sAI import pyFAI_integrator
+    pyFAI_integrator.cache_clear()
+    data = anisotropic_pattern()
+    kwargs = dict(mode='pyFAI', center=[61.3, 62.42], Rrange=[30, 50], polarres=180, fit=False)
+    first = SASazimuthal(data, distance=18.0, pixelsize=[7.5, 7.5], **kwargs)
+    second = SASazimuthal(2*data, distance=18.0, pixelsize=[7.5, 7.5], **kwargs)
+    info = pyFAI_integrator.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert np.allclose(second.Ipsi, 2*first.Ipsi)
+    SASazimuthal(data, distance=8.0, pixelsize=[5.0, 7.5], **kwargs)
+    assert pyFAI_integrator.cache_info().misses == 2
+    ai = pyFAI_integrator((128, 128), (61.3, 62.42), (5.0, 7.5), 8.0, 180, (30, 50), None)
+    assert pyFAI_integrator.cache_info().hits == 2
+    assert ai.dist == 8.0
+    assert (ai.pixel1, ai.pixel2) == (5.0e-3, 7.5e-3)
+    assert np.isclose(ai.poni1, 5.0e-3*(128-61.3-1))
+    assert np.isclose(ai.poni2, 7.5e-3*62.42)
@@ -39,43 +39,153 @@ def read_SANS1_eff_map(file):
         print('Error')
 """
 
-#print(read_SANS1_eff_map())
-effMapSANS1, errMapSANS1 = read_SANS1_eff_map('c:/Users/kohlbrecher/switchdrive/pySASfit/data/detector_efficiency_extrapolate_SINQ_SANS_I_HDF.mat')
-plt.imshow(np.clip(effMapSANS1,0.5,1.3), interpolation='none',origin='lower')
-plt.colorbar()
-plt.show()
+_eff_maps = {}
 
-f=open("c:/Users/kohlbrecher/switchdrive/pySASfit/data/D0000001.999","w")
-f.write("%Counts\n")
-ii = 0
-for j in range(128):
-    for ir in range(16):
-        for i in range(8):
-            f.write(f"{effMapSANS1[ir*8+i][j]:+1.3e}")
-        ii = ii+8
-        f.write("\n")
-f.write("%Errors\n")
-ii = 0
-for j in range(128):
-    for ir in range(16):
-        for i in range(8):
-            f.write(f"{errMapSANS1[ir*8+i][j]:+1.3e}")
-        ii = ii+8
-        f.write("\n")
-f.close()
+def load_SANS1_eff_map(file, cachefile=None):
+    """
+    Returns the efficiency map and its error of the MATLAB file as float64
+    arrays in the layout of the %Counts block of the detector, i.e. like
+    the counts of the hdf files. The .mat file is converted only once into
+    the binary NumPy file cachefile (default: same name with extension
+    .npz), which is used as long as the modification time of the .mat file
+    is unchanged. Within a session the map is kept in memory.
+    """
+    file = os.path.abspath(file)
+    mtime = os.stat(file).st_mtime
+    if file in _eff_maps and _eff_maps[file][0] == mtime:
+        return _eff_maps[file][1:]
+    if cachefile is None:
+        cachefile = os.path.splitext(file)[0]+'.npz'
+    eff = None
+    if os.path.isfile(cachefile):
+        with np.load(cachefile) as cache:
+            if cache['mtime'] == mtime:
+                eff, err = cache['eff'], cache['err']
+    if eff is None:
+        mat = loadmat(file)
+        # the maps are stored transposed to the detector layout
+        eff = np.ascontiguousarray(mat['eff_data'].T, dtype=np.float64)
+        err = np.ascontiguousarray(mat['eff_err_data'].T, dtype=np.float64)
+        try:
+            with open(cachefile, 'wb') as f:
+                np.savez(f, eff=eff, err=err, mtime=mtime)
+        except OSError:
+            pass
+    _eff_maps[file] = (mtime, eff, err)
+    return eff, err
+
+class EfficiencyCorrection:
+    __doc__ = """
+    EfficiencyCorrection(file=None, efficiency=None, efficiency_error=None)
+    divides detector counts by the efficiency map of the MATLAB file file,
+    loaded with load_SANS1_eff_map, or by the given arrays, and propagates
+    the errors of counts and map:
+        dI_corr**2 = (dI/eff)**2 + (I_corr*deff/eff)**2
+    Counts and errors are corrected in place, a stack of frames (..., ny, nx)
+    is corrected frame by frame with a single frame sized buffer.
+
+        corr = EfficiencyCorrection('detector_efficiency.mat')
+        corr.apply(SANSdata('sans2023n021192.hdf'))
+    """
+    def __init__(self, file=None, efficiency=None, efficiency_error=None):
+        if file is not None:
+            efficiency, efficiency_error = load_SANS1_eff_map(file)
+        if efficiency is None:
+            raise RuntimeError('neither an efficiency map file nor an efficiency map is given')
+        self.efficiency = np.asarray(efficiency, dtype=np.float64)
+        if efficiency_error is None:
+            efficiency_error = np.zeros_like(self.efficiency)
+        # relative error of the map, only needed once
+        self.relerror = np.asarray(efficiency_error, dtype=np.float64)/self.efficiency
+
+    def correct(self, counts, errors=None, flipped=False):
+        """
+        Corrects the float array counts, a frame or a stack of frames, in
+        place and returns counts and errors. Without errors the counts are
+        taken as Poisson distributed and a new error array is returned,
+        otherwise errors is corrected in place as well. flipped=True is for
+        counts read from BerSANS files, whose rows are in reverse order.
+        """
+        if counts.dtype.kind != 'f' or (errors is not None and errors.dtype.kind != 'f'):
+            raise RuntimeError('counts and errors have to be float arrays to be corrected in place')
+        if errors is not None and errors.shape != counts.shape:
+            raise RuntimeError(f'errors of shape {errors.shape} do not fit the counts of shape {counts.shape}')
+        efficiency = self.efficiency[::-1] if flipped else self.efficiency
+        relerror = self.relerror[::-1] if flipped else self.relerror
+        if errors is None:
+            errors = np.abs(counts)
+            np.sqrt(errors, out=errors)
+        buffer = np.empty(counts.shape[-2:])
+        # frame by frame, so that any strided stack is corrected in place
+        for index in np.ndindex(counts.shape[:-2]):
+            frame, frame_error = counts[index], errors[index]
+            np.divide(frame, efficiency, out=frame)
+            np.divide(frame_error, efficiency, out=frame_error)
+            np.multiply(frame, relerror, out=buffer)
+            np.hypot(frame_error, buffer, out=frame_error)
+        return counts, errors
 
-def rad_avg_pyFAI(detx, bcx, bcy, wl=6.e-10, npt=100):
-    from pyFAI import load
-    from pyFAI import azimuthalIntegrator
+    def apply(self, Data):
+        """
+        Corrects %Counts,DetCounts and %Errors,DetErrors (Poisson errors if
+        not present) of the SANSdata object Data. Integer counts are
+        converted once to float64, counts of a HDFLazyArray are copied, so
+        that the data cached by it stay untouched.
+        """
+        BerSANS = Data.BerSANS
+        counts = BerSANS['%Counts,DetCounts']
+        if not (isinstance(counts, np.ndarray) and counts.dtype.kind == 'f'):
+            counts = np.array(counts, dtype=np.float64)
+        errors = BerSANS.get('%Errors,DetErrors')
+        if errors is not None and errors.dtype.kind != 'f':
+            errors = np.asarray(errors, dtype=np.float64)
+        counts, errors = self.correct(counts, errors, flipped=BerSANS['%File,Type'] != 'SANSDRawhdf')
+        BerSANS['%Counts,DetCounts'] = counts
+        BerSANS['%Errors,DetErrors'] = errors
+        return Data
+
+def write_SANS1_eff_map(filename, efficiency, efficiency_error):
+    """
+    Writes the efficiency map and its error in the layout of
+    load_SANS1_eff_map as %Counts and %Errors blocks of a BerSANS .999
+    file, 8 values of 10 characters per line.
+    """
+    line = "{:+1.3e}"*8 + "\n"
+    with open(filename, 'w') as f:
+        for section, values in (('%Counts', efficiency), ('%Errors', efficiency_error)):
+            values = np.asarray(values, dtype=np.float64).ravel().tolist()
+            f.write(f"{section}\n" + (line*(len(values)//8)).format(*values))
+
+def rad_avg_pyFAI(data, detx, bcx, bcy, wl=6.e-10, npt=100, pixelsize=7.5e-3, mask=None, qmin=0, qmax=np.inf):
+    """
+    Radial average of the detector image data with pyFAI, detx is the sample
+    detector distance in m, bcx, bcy the beam center in pixels, wl the
+    wavelength and pixelsize the pixel size in m. Pixels where mask is
+    nonzero are ignored. Returns q in 1/nm, I and its error for qmin<q<qmax.
+    """
+    try:
+        from pyFAI.integrator.azimuthal import AzimuthalIntegrator
+    except ImportError:
+        from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
     ai = AzimuthalIntegrator(
         dist=detx,              # Detector distance in meters
-        poni1=0.05,            # Beam center Y in meters
-        poni2=0.05,            # Beam center X in meters
-        pixel1=7.5e-3,           # Pixel size Y in meters
-        pixel2=7.5e-3,           # Pixel size X in meters
+        poni1=bcy*pixelsize,    # Beam center Y in meters
+        poni2=bcx*pixelsize,    # Beam center X in meters
+        pixel1=pixelsize,       # Pixel size Y in meters
+        pixel2=pixelsize,       # Pixel size X in meters
         wavelength=wl    # Wavelength in meters
     )
+    result = ai.integrate1d(np.asarray(data, dtype=np.float64), npt, unit='q_nm^-1', method='csr',
+                            mask=mask, error_model='poisson', polarization_factor=1.0)
+    q, I, err = result.radial, result.intensity, result.sigma
+    select = (q > qmin) & (q < qmax)
+    return q[select], I[select], err[select]
+
+if __name__ == '__main__':
+    #print(read_SANS1_eff_map())
+    effMapSANS1, errMapSANS1 = load_SANS1_eff_map('c:/Users/kohlbrecher/switchdrive/pySASfit/data/detector_efficiency_extrapolate_SINQ_SANS_I_HDF.mat')
+    plt.imshow(np.clip(effMapSANS1.T,0.5,1.3), interpolation='none',origin='lower')
+    plt.colorbar()
+    plt.show()
 
-    q, I, err = ai.radial_average(npt=npt, unit='q_nm^-1', method='csr', mask=None, polarization_factor=1.0)
-    mask = (q < qmin) | (q > qmax)
-    return q[~mask], I[~mask], err[~mask]
\ No newline at end of file
+    write_SANS1_eff_map("c:/Users/kohlbrecher/switchdrive/pySASfit/data/D0000001.999", effMapSANS1, errMapSANS1)